@@ -0,0 +1,231 @@
+# Copyright (c) The Libra Core Contributors
+# SPDX-License-Identifier: Apache-2.0
+
+# Archival of finished payments to a cold store.
+
+from .payment import PaymentObject
+from .payment_command import PaymentCommand
+from .payment_logic import payment_is_final
+from .protocol_messages import CommandRequestObject
+from .shared_object import SharedObject
+
+from itertools import islice
+import asyncio
+import logging
+
+logger = logging.getLogger(name='libra_off_chain_api.archive')
+
+
+class PaymentArchiver:
+    ''' Moves payments in a final state (both sides ready_for_settlement, or
+    either side aborted), all their versions, and the records of the
+    sequenced requests that created them, from the storage of a VASP to a
+    separate cold store. This keeps the working set of the VASP bounded by
+    the payments in flight, rather than by all payments ever processed.
+
+    The containers of the processor and of the channels read through to
+    the cold store (see ``StorableDict.set_archive``), so that archived
+    payments remain available through ``get_latest_payment_by_ref_id``
+    and ``get_payment_history_by_ref_id``, and that retransmitted requests
+    are still recognised. Records are first committed to the cold store,
+    and then removed from the storage of the VASP, so that a crash in
+    between only leads to the move being repeated.
+
+    Payments are recorded for archival as they reach a final state, once
+    the archiver is attached. Those already final before (eg. when the
+    archiver is first enabled on an existing store) are found by a scan
+    when the archiver starts running (see ``scan_finished_payments``).
+
+    Parameters:
+        * vasp : the OffChainVASP whose payments are archived.
+        * cold_factory : a StorableFactory for the cold store.
+        * batch_size : the max number of payments archived in one pass.
+    '''
+
+    def __init__(self, vasp, cold_factory, batch_size=100):
+        self.vasp = vasp
+        self.processor = vasp.processor
+        self.cold_factory = cold_factory
+        self.batch_size = batch_size
+
+        # The cursors of the first requests not yet archived per channel.
+        self.cursors = {}
+
+        processor = self.processor
+        with cold_factory.atomic_writes():
+            root = cold_factory.make_value('processor', None)
+            processor.reference_id_index.set_archive(cold_factory.make_dict(
+                'reference_id_index', PaymentObject, root))
+            processor.object_store.set_archive(cold_factory.make_dict(
+                'object_store', SharedObject, root))
+
+        storage = processor.storage_factory
+        with storage.atomic_writes():
+            root = storage.make_value('processor', None)
+            processor.finished_payments = storage.make_dict(
+                'finished_payments', str, root, hot=True)
+
+        # Attach to the channels open now, and those opened later.
+        vasp.archiver = self
+        for channel in list(vasp.channel_store.values()):
+            self.attach_channel(channel)
+
+    def attach_channel(self, channel):
+        ''' Makes the request records of the channel read through to
+            the cold store. '''
+        cold = self.cold_factory
+        with cold.atomic_writes():
+            root = cold.make_value(channel.myself.as_str(), None)
+            other_vasp = cold.make_value(
+                channel.other_address_str, None, root=root)
+            channel.command_sequence.set_archive(cold.make_dict(
+                'command_sequence', CommandRequestObject, other_vasp))
+            channel.my_request_index.set_archive(cold.make_dict(
+                'my_request_index', CommandRequestObject, other_vasp))
+            channel.other_request_index.set_archive(cold.make_dict(
+                'other_request_index', CommandRequestObject, other_vasp))
+
+        storage = channel.storage
+        with storage.atomic_writes():
+            root = storage.make_value(channel.myself.as_str(), None)
+            other_vasp = storage.make_value(
+                channel.other_address_str, None, root=root)
+            self.cursors[channel.other_address_str] = storage.make_value(
+                'archive_cursor', int, root=other_vasp, default=0)
+
+    def archive_requests(self, channel, ref_ids):
+        ''' Moves the sequenced requests of the channel for payments with
+            the given reference_ids to the cold store. Returns the
+            number of requests archived. '''
+        cursor = self.cursors[channel.other_address_str]
+        sequence = channel.command_sequence
+        my_address = channel.get_my_address()
+
+        with channel.rlock:
+            # All requests before the cursor have been archived.
+            moved = []
+            for position in range(cursor.get_value(), len(sequence)):
+                if sequence.is_evicted(position):
+                    continue
+                request = sequence[position]
+                command = request.command
+                if isinstance(command, PaymentCommand):
+                    ref_id, _ = command.writes_version_map[0]
+                    if ref_id in ref_ids:
+                        moved += [(position, request)]
+
+            if not moved:
+                return 0
+
+            with self.cold_factory.atomic_writes():
+                for position, request in moved:
+                    index = channel.my_request_index \
+                        if request.command.get_origin() == my_address \
+                        else channel.other_request_index
+                    sequence.archive[str(position)] = request
+                    index.archive[request.cid] = request
+            self.cold_factory.flush()
+
+            with channel.storage.atomic_writes():
+                for position, request in moved:
+                    index = channel.my_request_index \
+                        if request.command.get_origin() == my_address \
+                        else channel.other_request_index
+                    sequence.evict(position)
+                    try:
+                        del index[request.cid]
+                    except KeyError:
+                        pass  # Removed before a crash.
+
+                next_position = cursor.get_value()
+                while next_position < len(sequence) and \
+                        sequence.is_evicted(next_position):
+                    next_position += 1
+                cursor.set_value(next_position)
+
+        return len(moved)
+
+    def archive_payments(self):
+        ''' Moves up to ``batch_size`` finished payments, and their
+            requests, to the cold store. Returns the number of payments
+            archived. '''
+        processor = self.processor
+        finished = processor.finished_payments
+        ref_ids = set(islice(finished.keys(), self.batch_size))
+        if not ref_ids:
+            return 0
+
+        for channel in list(self.vasp.channel_store.values()):
+            self.archive_requests(channel, ref_ids)
+
+        # Collect all versions of each payment.
+        object_store = processor.object_store
+        versions = {}
+        with self.cold_factory.atomic_writes():
+            for ref_id in ref_ids:
+                payment = processor.reference_id_index[ref_id]
+                processor.reference_id_index.archive[ref_id] = payment
+                versions[ref_id] = []
+                version = payment.get_version()
+                while version is not None:
+                    obj = object_store[version]
+                    object_store.archive[version] = obj
+                    versions[ref_id] += [version]
+                    version = obj.previous_version
+        self.cold_factory.flush()
+
+        with processor.storage_factory.atomic_writes():
+            for ref_id in ref_ids:
+                for version in versions[ref_id]:
+                    try:
+                        del object_store[version]
+                    except KeyError:
+                        pass  # Removed before a crash.
+                try:
+                    del processor.reference_id_index[ref_id]
+                except KeyError:
+                    pass  # Removed before a crash.
+                del finished[ref_id]
+
+        logger.debug(f'Archived {len(ref_ids)} payments.')
+        return len(ref_ids)
+
+    async def scan_finished_payments(self):
+        ''' Records the payments of the storage already in a final state
+            to be archived, in batches of ``batch_size`` payments, and
+            returns their number. '''
+        processor = self.processor
+        index = processor.reference_id_index
+        finished = processor.finished_payments
+        ref_ids = list(index.keys())
+        found = 0
+        for start in range(0, len(ref_ids), self.batch_size):
+            async with processor.storage_factory.atomic_writes_async():
+                for ref_id in ref_ids[start:start + self.batch_size]:
+                    if ref_id in finished:
+                        continue
+                    payment = index[ref_id]
+                    if payment_is_final(payment):
+                        finished[ref_id] = payment.get_version()
+                        found += 1
+            # Let other tasks run between batches.
+            await asyncio.sleep(0)
+        return found
+
+    async def run(self, period=60.0):
+        ''' Archives finished payments every ``period`` seconds. '''
+        logger.info('Start Payment Archiver.')
+        try:
+            found = await self.scan_finished_payments()
+            logger.debug(f'Found {found} finished payments to archive.')
+        except Exception:
+            logger.error('Payment archival error.', exc_info=True)
+
+        while True:
+            await asyncio.sleep(period)
+            try:
+                while self.archive_payments() == self.batch_size:
+                    # Let other tasks run between batches.
+                    await asyncio.sleep(0)
+            except Exception:
+                logger.error('Payment archival error.', exc_info=True)
@@ -3,6 +3,11 @@
 
 from .business import BusinessNotAuthorized
 from .libra_address import LibraAddress
+from .protocol_messages import CommandRequestObject, OffChainException, \
+    OffChainProtocolError
+from .errors import OffChainErrorCode
+from .flow_control import SendWindow
+from .retransmit import RetransmitScheduler
 from .utils import get_unique_string
 
 import aiohttp
@@ -10,6 +15,7 @@ from aiohttp import web
 from aiohttp.client_exceptions import ClientError
 import asyncio
 import logging
+from collections import namedtuple
 from urllib.parse import urljoin
 
 
@@ -20,16 +26,52 @@ class NetworkException(Exception):
     pass
 
 
+""" A signed request, as returned by `Aionet.sequence_command`, with the
+cid of the request so that it is not retransmitted while it is sent. """
+SignedRequest = namedtuple('SignedRequest',
+    ['content',  # The JWS signed text of the request
+     'cid',  # The cid of the request
+     ])
+
+
 class Aionet:
     """A network client and server using aiohttp. Initialize
     the network system with a OffChainVASP instance.
 
     Args:
         vasp (OffChainVASP): The  OffChainVASP instance.
+        batch_size (int, optional): The max number of requests sent to
+            another VASP in a single signed batch (see `send_batch`). When
+            set, `sequence_command` returns requests that are queued by
+            `send_request`, and sent along with the other requests queued
+            for the same VASP, as are retransmitted requests. Defaults to 0
+            (each request is signed and sent on its own).
+        send_window (int, optional): The max number of requests in flight
+            to another VASP. When set, requests are queued as with a
+            `batch_size`, and sent as the SendWindow of the channel lets
+            them, with a window size that adapts to the load of the other
+            VASP (see flow_control.SendWindow). Defaults to 0 (no limit).
+        retransmit_timeout (float, optional): The time (seconds) after which
+            a request without a response is first retransmitted, doubling
+            for each retransmit (see retransmit.RetransmitScheduler).
+            Defaults to 1.0.
     """
 
-    def __init__(self, vasp):
+    def __init__(self, vasp, batch_size=0, send_window=0,
+                 retransmit_timeout=1.0):
         self.vasp = vasp
+        self.batch_size = batch_size
+        self.send_window = send_window
+
+        # Retransmits the requests not answered in time, once started.
+        self.retransmitter = RetransmitScheduler(
+            self, timeout=retransmit_timeout)
+        self.retransmit_task_obj = None
+
+        # The tasks sending the requests queued in the outbox of each
+        # channel, per other VASP, and those sending a batch.
+        self.outbox_tasks = {}
+        self.send_tasks = set()
 
         # For the moment hold one session per VASP.
         self.session = None
@@ -54,9 +96,39 @@ class Aionet:
         if self.watchdog_task_obj is not None:
             self.watchdog_task_obj.cancel()
 
+        if self.retransmit_task_obj is not None:
+            self.retransmit_task_obj.cancel()
+
+        for task in list(self.outbox_tasks.values()) + list(self.send_tasks):
+            task.cancel()
+        for channel in self.vasp.channel_store.values():
+            for _, future in channel.outbox:
+                future.cancel()
+            channel.outbox.clear()
+
+    def queues_requests(self):
+        ''' Returns True if requests are queued in the outbox of their
+            channel to be sent (see `queue_request`). '''
+        return self.batch_size > 0 or self.send_window > 0
+
+    def get_channel(self, other_addr):
+        ''' Returns the channel with the other VASP, with a SendWindow if
+            the network has a `send_window`. '''
+        channel = self.vasp.get_channel(other_addr)
+        if self.send_window > 0 and channel.send_window is None:
+            channel.send_window = SendWindow(max_size=self.send_window)
+        self.retransmitter.attach(channel)
+        return channel
+
+    def retransmit_counts(self):
+        ''' Returns a dict from the address (str) of other VASPs to the
+            number of requests retransmitted to them. '''
+        return dict(self.retransmitter.retransmits)
+
     def schedule_watchdog(self, loop, period=10.0):
-        """ Creates and schedues the watchdog periodic process.
-        It logs basic statistics for all channels and retransmits.
+        """ Creates and schedues the watchdog periodic process, that
+        logs basic statistics for the channels with pending requests, and
+        starts retransmitting requests not answered in time.
 
         Args:
             loop (asyncio.AbstractEventLoopPolicy): The event loop.
@@ -65,6 +137,7 @@ class Aionet:
         """
         self.watchdog_period = period
         self.watchdog_task_obj = loop.create_task(self.watchdog_task())
+        self.retransmit_task_obj = loop.create_task(self.retransmitter.run())
 
     async def watchdog_task(self):
         ''' Provides a priodic debug view of pending requests and replies. '''
@@ -73,33 +146,28 @@ class Aionet:
             while True:
                 for k in self.vasp.channel_store:
                     channel = self.vasp.channel_store[k]
+                    if not channel.would_retransmit() \
+                            and channel.send_queue_depth() == 0:
+                        continue
 
                     role = ['Client', 'Server'][channel.is_server()]
                     waiting = channel.is_server() \
                         and channel.would_retransmit()
                     me = channel.get_my_address()
                     other = channel.get_other_address()
-
-                    # Retransmit a few of the requests here.
-                    messages = await channel.package_retransmit(number=100)
-                    for message in messages:
-                        logger.info(
-                            f'Attempt to re-transmit messages {message}.'
-                        )
-                        try:
-                            await self.send_request(other, message.content)
-                        except NetworkException as e:
-                            logger.debug(
-                                f'Attempt to re-transmit message {message} '
-                                f'failed with error: {str(e)}'
-                            )
+                    retransmits = self.retransmitter.retransmits.get(
+                        channel.other_address_str, 0)
 
                     len_my = len(channel.my_request_index)
+                    window = channel.send_window
+                    window_size = 'None' if window is None \
+                        else f'{int(window.size)} ({window.in_flight} used)'
                     logger.info(
                         f'''
                         Channel: {me.as_str()} [{role}] <-> {other.as_str()}
                         Queues: my: {len_my} (Wait: {waiting})
-                        Retransmit: {channel.would_retransmit()}'''
+                        Send queue: {channel.send_queue_depth()} Window: {window_size}
+                        Retransmit: {channel.would_retransmit()} (Sent: {retransmits})'''
                     )
                 await asyncio.sleep(self.watchdog_period)
         except asyncio.CancelledError:
@@ -109,6 +177,36 @@ class Aionet:
         finally:
             logger.info('Stop Network Watchdog')
 
+    async def retransmit(self, channel, requests):
+        ''' Sends again requests (CommandRequestObject) of the channel, and
+            waits for their results. With a `batch_size` or `send_window`,
+            the requests are queued, unless they already are. '''
+        other = channel.get_other_address()
+        if self.queues_requests():
+            queued = {request.cid for request, _ in channel.outbox}
+            requests = [request for request in requests
+                        if request.cid not in queued]
+            results = await asyncio.gather(
+                *[self.send_request(other, request) for request in requests],
+                return_exceptions=True
+            )
+        else:
+            results = []
+            for request in requests:
+                try:
+                    message = await channel.package_request(request)
+                    results += [await self.send_signed(
+                        other, message.content, [request.cid])]
+                except Exception as e:
+                    results += [e]
+
+        for request, result in zip(requests, results):
+            if isinstance(result, Exception):
+                logger.debug(
+                    f'Attempt to re-transmit request {request.cid} '
+                    f'failed with error: {str(result)}'
+                )
+
     def get_url(self, base_url, other_addr_str, other_is_server=False):
         """Composes the URL for the Off-chain API VASP end point.
 
@@ -184,12 +282,195 @@ class Aionet:
 
         Args:
             other_addr (LibraAddress): The LibraAddress of the other VASP.
-            request_text (dict): a JWS signed request,
-                ready to be sent across the network.
+            request_text (SignedRequest, str or CommandRequestObject): a
+                JWS signed request, ready to be sent across the network (a
+                SignedRequest is not retransmitted while sent), or a request
+                to send in a batch with the other requests queued for the
+                VASP.
 
         Raises:
             NetworkException: [description]
         """
+        if isinstance(request_text, CommandRequestObject):
+            return await self.queue_request(other_addr, request_text)
+
+        if isinstance(request_text, SignedRequest):
+            return await self.send_signed(
+                other_addr, request_text.content, [request_text.cid])
+        return await self.send_signed(other_addr, request_text, [])
+
+    async def send_signed(self, other_addr, request_text, cids):
+        """ Sends a signed request to another VASP, and returns the
+        result as `send_request`. The requests with the `cids` are not
+        retransmitted while it is sent (see RetransmitScheduler). """
+        channel = self.get_channel(other_addr)
+        self.retransmitter.sending(channel, cids)
+        try:
+            response_text = await self.post(other_addr, request_text)
+
+            # Wait in case the requests are sent out of order.
+            res = await channel.parse_handle_response(response_text)
+            logger.debug(f'Response parsed with status: {res}')
+        finally:
+            self.retransmitter.sent(channel, cids)
+
+        return res
+
+    async def send_batch(self, other_addr, requests):
+        """ Sends a batch of requests to another VASP, with a single
+        signature and in a single Http request.
+
+        Args:
+            other_addr (LibraAddress): The LibraAddress of the other VASP.
+            requests (list): The CommandRequestObject instances to send.
+
+        Raises:
+            NetworkException: If the batch could not be sent.
+
+        Returns:
+            list: For each request, in order, whether its command was a
+            success (bool), or the exception its response raised (see
+            `VASPPairChannel.parse_handle_batch_response`).
+        """
+        channel = self.get_channel(other_addr)
+        message = await channel.package_requests(requests)
+        cids = [request.cid for request in requests]
+        self.retransmitter.sending(channel, cids)
+        try:
+            response_text = await self.post(other_addr, message.content)
+            results = await channel.parse_handle_batch_response(
+                response_text)
+        finally:
+            self.retransmitter.sent(channel, cids)
+
+        # Requests the other VASP did not respond to stay pending.
+        missing = OffChainException('No response in batch.')
+        results += [missing] * (len(requests) - len(results))
+        return results[:len(requests)]
+
+    async def queue_request(self, other_addr, request):
+        """ Queues a request in the outbox of the channel with the other VASP
+        to be sent in a batch with the other requests queued for the same
+        VASP, and returns its result as `send_request`. Without a
+        SendWindow, the requests queued while a batch is sent to the VASP
+        are sent in the next batch. With one, batches are sent while the
+        window lets them, without waiting for the previous ones.
+
+        Args:
+            other_addr (LibraAddress): The LibraAddress of the other VASP.
+            request (CommandRequestObject): The request to send.
+
+        Raises:
+            NetworkException: If the request could not be sent.
+        """
+        channel = self.get_channel(other_addr)
+        future = asyncio.get_event_loop().create_future()
+        channel.outbox.append((request, future))
+
+        key = other_addr.as_str()
+        task = self.outbox_tasks.get(key)
+        if task is None or task.done():
+            self.outbox_tasks[key] = asyncio.ensure_future(
+                self.flush_outbox(channel))
+        return await future
+
+    async def flush_outbox(self, channel):
+        ''' Sends the requests queued in the outbox of a channel, in batches
+            of up to `batch_size`, until none is left. '''
+        outbox = channel.outbox
+        window = channel.send_window
+        batch_size = max(1, self.batch_size)
+
+        # Let the requests sequenced along with the first join its batch.
+        await asyncio.sleep(0)
+        while outbox:
+            if window is None:
+                await self.send_queued(channel, self.take_queued(
+                    channel, batch_size))
+                continue
+
+            number, ticket = await window.acquire(
+                min(batch_size, len(outbox)))
+
+            # Take the requests before acquiring the window again, so that
+            # each request is only counted once in the window.
+            batch = self.take_queued(channel, number)
+            if len(batch) < number:
+                window.release_unused(number - len(batch))
+            if not batch:
+                continue
+            task = asyncio.ensure_future(
+                self.send_queued(channel, batch, ticket))
+            self.send_tasks.add(task)
+            task.add_done_callback(self.send_tasks.discard)
+
+    @staticmethod
+    def take_queued(channel, number):
+        ''' Removes the first `number` requests of the outbox of a channel,
+            and returns them with the futures of their results. '''
+        batch = channel.outbox[:number]
+        del channel.outbox[:number]
+        return batch
+
+    async def send_queued(self, channel, batch, ticket=None):
+        ''' Sends a batch of requests taken from the outbox of a channel
+            (see `take_queued`), and sets their results. With a
+            SendWindow, the window taken for the requests is then released,
+            with the `ticket` from `SendWindow.acquire`. '''
+        other_addr = channel.get_other_address()
+
+        requests = [request for request, _ in batch]
+        results = []
+        try:
+            if self.batch_size > 0:
+                logger.debug(
+                    f'Sending batch of {len(requests)} requests '
+                    f'to {other_addr.as_str()}'
+                )
+                results = await self.send_batch(other_addr, requests)
+            else:
+                for request in requests:
+                    message = await channel.package_request(request)
+                    results += [await self.send_signed(
+                        other_addr, message.content, [request.cid])]
+        except Exception as e:
+            results = [e] * len(batch)
+        finally:
+            if ticket is not None:
+                congested = any(
+                    self.is_congestion(result) for result in results) \
+                    if len(results) == len(batch) else True
+                channel.send_window.release(len(batch), ticket, congested)
+
+        for (_, future), result in zip(batch, results):
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    @staticmethod
+    def is_congestion(result):
+        ''' Returns True if the result of sending a request (a bool, or the
+            exception raised) shows that the other VASP is overloaded: it
+            answered `wait`, or the request could not be sent. '''
+        if isinstance(result, NetworkException):
+            return True
+        return isinstance(result, OffChainProtocolError) \
+            and result.protocol_error.code == OffChainErrorCode.wait
+
+    async def post(self, other_addr, request_text):
+        """ Posts a signed request, or batch of requests, to another VASP
+        and returns the text of its signed response.
+
+        Args:
+            other_addr (LibraAddress): The LibraAddress of the other VASP.
+            request_text (str): The JWS signed request.
+
+        Raises:
+            NetworkException: If the request could not be sent.
+        """
 
         logger.debug(f'Connect to {other_addr.as_str()}')
 
@@ -200,6 +481,9 @@ class Aionet:
         # Try to get a channel with the other VASP.
         channel = self.vasp.get_channel(other_addr)
 
+        # Only send requests once they are durably stored.
+        await channel.storage.wait_durable()
+
         # Get the URLs
         base_url = self.vasp.info_context.get_peer_base_url(other_addr)
         url = self.get_url(base_url, other_addr.as_str(), other_is_server=True)
@@ -229,12 +513,7 @@ class Aionet:
 
                 response_text = await response.text()
                 logger.debug(f'Raw response: {response_text}')
-
-                # Wait in case the requests are sent out of order.
-                res = await channel.parse_handle_response(response_text)
-                logger.debug(f'Response parsed with status: {res}')
-
-                return res
+                return response_text
 
         except ClientError as e:
             logger.debug(f'ClientError {type(e)}: {e}')
@@ -248,15 +527,46 @@ class Aionet:
             command (ProtocolCommand) : A ProtocolCommand instance.
 
             Returns:
-                str: str of the net message
+                SignedRequest: the net message and cid of the request, or the
+                CommandRequestObject to be queued if `batch_size` or
+                `send_window` is set.
         '''
-
-        channel = self.vasp.get_channel(other_addr)
+        request = self.sequence_command_local(other_addr, command)
+        return await self.package_sequenced(other_addr, request)
+
+    def atomic_writes(self, other_addr):
+        ''' Returns the context manager of a transaction of the storage of
+            the channel with the other VASP. Writes to the objects of the
+            processor within it (eg. with `sequence_command_local`) are
+            committed atomically with those of the channel. '''
+        return self.get_channel(other_addr).storage.atomic_writes()
+
+    def atomic_writes_async(self, other_addr):
+        ''' Returns the asynchronous context manager of a transaction of the
+            storage of the channel with the other VASP (see
+            `atomic_writes`), that waits for the transactions of other tasks
+            without blocking the event loop. '''
+        return self.get_channel(other_addr).storage.atomic_writes_async()
+
+    def sequence_command_local(self, other_addr, command):
+        ''' Sequences a new command to the local queue, like
+            `sequence_command`, and returns its CommandRequestObject to
+            pass to `package_sequenced` once the transaction (if any)
+            that it is part of completes. '''
+        channel = self.get_channel(other_addr)
         request = channel.sequence_command_local(command)
-        request = await channel.package_request(request)
-        request = request.content
+        self.retransmitter.schedule(channel, request.cid)
         return request
 
+    async def package_sequenced(self, other_addr, request):
+        ''' Returns the SignedRequest of a sequenced request, or the
+            request itself if requests are queued. '''
+        if self.queues_requests():
+            return request
+        channel = self.get_channel(other_addr)
+        message = await channel.package_request(request)
+        return SignedRequest(message.content, request.cid)
+
     def get_runner(self):
         ''' Gets an object to that needs to be run in an
             event loop to register the server.
@@ -0,0 +1,73 @@
+# Copyright (c) The Libra Core Contributors
+# SPDX-License-Identifier: Apache-2.0
+
+# A Bloom filter of storage keys.
+
+import hashlib
+import math
+
+
+class BloomFilter:
+    ''' A set of strings that answers membership tests with no false
+    negatives, and a small rate of false positives, in little memory.
+    Strings cannot be removed.
+
+    The filter grows as strings are added: once a stage holds
+    ``capacity`` strings a new stage, twice as large, is added with half
+    the error rate, so that the overall rate of false positives stays
+    below about twice ``error_rate``.
+
+    Parameters:
+        * capacity : the number of strings of the first stage.
+        * error_rate : the rate of false positives of the first stage.
+    '''
+
+    def __init__(self, capacity=1024, error_rate=0.01):
+        self.error_rate = error_rate
+        # The stages, as lists [bits, num_bits, num_hashes, capacity, count].
+        self.stages = []
+        self._add_stage(capacity, error_rate)
+
+    def _add_stage(self, capacity, error_rate):
+        num_bits = max(8, int(
+            -capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        num_hashes = max(1, round(num_bits / capacity * math.log(2)))
+        bits = bytearray((num_bits + 7) // 8)
+        self.stages += [[bits, num_bits, num_hashes, capacity, 0]]
+
+    @staticmethod
+    def _hashes(item):
+        digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+        return int.from_bytes(digest[:8], 'little'), \
+            int.from_bytes(digest[8:], 'little') | 1
+
+    def add(self, item):
+        ''' Adds the string ``item`` to the filter. '''
+        stage = self.stages[-1]
+        bits, num_bits, num_hashes, capacity, count = stage
+        if count >= capacity:
+            self._add_stage(
+                capacity * 2, self.error_rate / 2 ** len(self.stages))
+            stage = self.stages[-1]
+            bits, num_bits, num_hashes, capacity, count = stage
+
+        h1, h2 = self._hashes(item)
+        for i in range(num_hashes):
+            bit = (h1 + i * h2) % num_bits
+            bits[bit >> 3] |= 1 << (bit & 7)
+        stage[4] = count + 1
+
+    def __contains__(self, item):
+        h1, h2 = self._hashes(item)
+        for bits, num_bits, num_hashes, _, _ in self.stages:
+            for i in range(num_hashes):
+                bit = (h1 + i * h2) % num_bits
+                if not bits[bit >> 3] & (1 << (bit & 7)):
+                    break
+            else:
+                return True
+        return False
+
+    def __len__(self):
+        ''' The number of strings added (counting repeats). '''
+        return sum(stage[4] for stage in self.stages)
@@ -0,0 +1,153 @@
+# Copyright (c) The Libra Core Contributors
+# SPDX-License-Identifier: Apache-2.0
+
+# Online compaction of the storage of a VASP.
+
+from .storage import StorableLogDict
+
+import asyncio
+import logging
+import time
+
+logger = logging.getLogger(name='libra_off_chain_api.compaction')
+
+
+class StorageCompactor:
+    ''' Reclaims the storage of a VASP that live traffic leaves behind, so
+    that the storage of a long running VASP stays bounded. Each pass:
+
+        * moves the object locks of versions that have been consumed
+          (``'False'``) for longer than ``retention`` seconds out of the
+          hot lock table, to a cold store of collected versions (see
+          ``ObjectLockTable.collect``). Requests depending on such a
+          version still get a conflict.
+        * rewrites the index of append-only containers (see
+          ``StorableLogDict.compact``) in which deleted keys outnumber
+          live ones.
+        * deletes the blobs (see ``StorableFactory.collect_blobs``) that
+          no stored object refers to any more.
+        * asks the backend to give up the space of deleted data, if it
+          supports ``compact()`` (see ``SQLiteStorage`` and ``LogStorage``).
+
+    Locks are removed in small transactions, taking the lock of the
+    channel, and blobs are swept and the backend is compacted on a
+    separate thread, so that
+    passes run alongside the processing of requests. The time since a
+    lock was consumed is tracked in memory, from the first pass that finds
+    it consumed, so locks are kept for longer after a restart.
+
+    Parameters:
+        * vasp : the OffChainVASP whose storage is compacted.
+        * retention : the time (seconds) consumed locks are kept.
+        * batch_size : the max number of locks removed in a transaction.
+    '''
+
+    def __init__(self, vasp, retention=3600.0, batch_size=100):
+        self.vasp = vasp
+        self.processor = vasp.processor
+        self.retention = retention
+        self.batch_size = batch_size
+
+        # The time each consumed lock was first seen, per channel.
+        self.consumed_since = {}
+
+        # The totals of all passes.
+        self.collected_locks = 0
+        self.compacted_index_entries = 0
+        self.collected_blobs = 0
+        self.reclaimed_bytes = 0
+
+    def collect_locks(self, channel, now=None):
+        ''' Collects the locks of the channel consumed for longer than the
+            retention. Returns the number of locks collected. '''
+        now = time.time() if now is None else now
+        seen = self.consumed_since.setdefault(channel.other_address_str, {})
+        locks = channel.object_locks
+
+        expired = []
+        with channel.rlock:
+            consumed = set()
+            for version in locks.keys():
+                if not locks.is_used(version):
+                    continue
+                consumed.add(version)
+                first_seen = seen.setdefault(version, now)
+                if now - first_seen >= self.retention:
+                    expired += [version]
+
+            # Forget the locks removed by others (eg. a previous pass).
+            for version in set(seen) - consumed:
+                del seen[version]
+
+        collected = 0
+        for start in range(0, len(expired), self.batch_size):
+            with channel.rlock:
+                with channel.storage.atomic_writes():
+                    for version in expired[start:start + self.batch_size]:
+                        # Consumed locks never change, but may be gone.
+                        if locks.collect(version):
+                            collected += 1
+                        seen.pop(version, None)
+        channel.collected_locks += collected
+        return collected
+
+    def compact_indexes(self):
+        ''' Rewrites the index of the append-only containers of the
+            processor with more deleted keys than live ones. Returns the
+            number of index entries removed. '''
+        processor = self.processor
+        removed = 0
+        for container in (processor.object_store, processor.command_cache):
+            if not isinstance(container, StorableLogDict):
+                continue
+            with processor.storage_factory.atomic_writes():
+                if container.deleted.get_value() > len(container):
+                    removed += container.compact()
+        return removed
+
+    def collect_blobs(self):
+        ''' Deletes the blobs that no stored object refers to. Returns the
+            number of blobs deleted. '''
+        return self.processor.storage_factory.collect_blobs()
+
+    def compact_backend(self):
+        ''' Asks the backend to give up the space of deleted data. Returns
+            the number of bytes reclaimed. '''
+        db = self.processor.storage_factory.db
+        if not hasattr(db, 'compact'):
+            return 0
+        return db.compact()
+
+    async def compact(self, now=None):
+        ''' Runs a compaction pass, and returns a dict with the number of
+            ``locks``, ``index_entries`` and ``blobs`` removed, and of
+            ``bytes`` reclaimed by the backend. '''
+        locks = 0
+        for channel in list(self.vasp.channel_store.values()):
+            locks += self.collect_locks(channel, now)
+            # Let requests be processed between channels.
+            await asyncio.sleep(0)
+        index_entries = self.compact_indexes()
+
+        loop = asyncio.get_event_loop()
+        blobs = await loop.run_in_executor(None, self.collect_blobs)
+        reclaimed = await loop.run_in_executor(None, self.compact_backend)
+
+        self.collected_locks += locks
+        self.compacted_index_entries += index_entries
+        self.collected_blobs += blobs
+        self.reclaimed_bytes += reclaimed
+        report = {'locks': locks, 'index_entries': index_entries,
+                  'blobs': blobs, 'bytes': reclaimed}
+        logger.info(f'Storage compaction: {report}')
+        return report
+
+    async def run(self, period=300.0):
+        ''' Runs a compaction pass every ``period`` seconds. '''
+        logger.info('Start Storage Compactor.')
+        while True:
+            await asyncio.sleep(period)
+            try:
+                await self.compact()
+            except Exception:
+                logger.error('Storage compaction error.', exc_info=True)
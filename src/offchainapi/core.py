@@ -6,7 +6,11 @@
 
 from .protocol import OffChainVASP
 from .payment_logic import PaymentProcessor
-from .storage import StorableFactory
+from .storage import StorableFactory, AsyncStorableFactory
+from .payment import KYC_BLOB_FIELDS
+from .archive import PaymentArchiver
+from .compaction import StorageCompactor
+from .sqlite_storage import SQLiteStorage
 from .asyncnet import Aionet, NetworkException
 
 import asyncio
@@ -31,13 +35,95 @@ class Vasp:
         info_context (VASPInfo) : The information context for the VASP
             implementing the VASPInfo interface.
         database (*) : A persistent key value store to be used
-            by the storage systems as a backend.
+            by the storage systems as a backend, or a file name (str)
+            for a durable SQLiteStorage backend.
+        cache_size (int, optional) : The number of decoded payments and
+            requests to cache per storage container. Defaults to 0 (no cache).
+        async_storage (bool, optional) : Whether to write to the database on
+            a dedicated I/O thread (see AsyncStorableFactory) rather than on
+            the event loop. Defaults to False.
+        partition_channels (bool, optional) : Whether the channel with each
+            VASP has its own storage partition, so that its transactions do
+            not wait for those of other channels. Defaults to False.
+        checkpoint_interval (int, optional) : The number of commits that
+            change the hot state of the VASP (eg. object locks and pending
+            commands) between snapshots of it, that make restarts fast. See
+            StorableFactory. Defaults to 0 (no snapshots).
+        compact_keys (bool, optional) : Whether new storage containers use
+            short interned key prefixes, rather than their full path (see
+            StorableFactory). Defaults to False.
+        kyc_blobs (bool, optional) : Whether the KYC data of payments is
+            stored once, by the hash of its content, and referenced from the
+            stored payments and requests (see StorableFactory). Defaults to
+            False.
+        bloom_filters (bool, optional) : Whether the containers that are
+            mostly tested for absent keys (eg. request indexes) keep a Bloom
+            filter of their keys, to avoid reading the database for those
+            (see StorableDict). Defaults to False.
+        durability (Durability, optional) : Whether each commit is synced to
+            disk (Durability.SYNC), commits are grouped and synced together
+            (Durability.GROUP), or never synced (Durability.NONE, for
+            benchmarks and test networks). See StorableFactory. Defaults to
+            None (left to the database).
+        group_commit_window (float, optional) : The time (seconds) within
+            which commits are grouped with Durability.GROUP. Defaults to 0.0
+            (the DEFAULT_GROUP_COMMIT_WINDOW of the storage).
+        delta_interval (int, optional) : Whether versions of payments are
+            stored as deltas against their previous version, with a full
+            version at least every delta_interval versions (see
+            PaymentProcessor). Defaults to 0 (all versions in full).
+        archive_database (*, optional) : A key value store, or a file name
+            (str) for an SQLiteStorage, to which finished payments and their
+            requests are moved (see PaymentArchiver). Defaults to None (no
+            archival).
+        archive_period (float, optional) : The time (seconds) between
+            archival passes. Defaults to 60.0.
+        compaction_period (float, optional) : The time (seconds) between
+            passes of a StorageCompactor, that reclaims the storage of
+            consumed object locks and deleted data. Defaults to None (no
+            compaction).
+        lock_retention (float, optional) : The time (seconds) consumed
+            object locks are kept before compaction removes them. Defaults
+            to 3600.0.
+        storage_stats (StorageStatsSink, optional) : A sink for the
+            statistics of the storage operations of each transaction (eg.
+            a StorageStatsAggregator). Defaults to None (no statistics).
+        batch_size (int, optional) : The max number of requests sent to
+            another VASP in a single signed batch. Requests for the same
+            VASP, new or retransmitted, are then queued and sent together
+            (see Aionet). Defaults to 0 (each request sent on its own).
+        send_window (int, optional) : The max number of requests in flight
+            to another VASP. Requests beyond those the window of the channel
+            lets through, whose size adapts to the load of the other VASP,
+            are queued (see flow_control.SendWindow). Defaults to 0 (no
+            limit).
+        retransmit_timeout (float, optional) : The time (seconds) after which
+            a request without a response is retransmitted, doubling for
+            each retransmit (see retransmit.RetransmitScheduler). Defaults
+            to 1.0.
+        park_timeout (float, optional) : The max time (seconds) a request
+            of another VASP whose dependencies are missing or locked is held,
+            and handled again as their locks change, before it is answered
+            with a wait, by the channels where this VASP is the server (see
+            VASPPairChannel). Defaults to 0.0 (answer at once).
 
     Returns a VASP object.
     '''
 
     def __init__(self, my_addr, host, port, business_context,
-                 info_context, database):
+                 info_context, database, cache_size=0, async_storage=False,
+                 partition_channels=False, checkpoint_interval=0,
+                 compact_keys=False, kyc_blobs=False, delta_interval=0,
+                 bloom_filters=False, durability=None,
+                 group_commit_window=0.0,
+                 archive_database=None, archive_period=60.0,
+                 compaction_period=None, lock_retention=3600.0,
+                 storage_stats=None, batch_size=0, send_window=0,
+                 retransmit_timeout=1.0, park_timeout=0.0):
+
+        # A file name selects the durable SQLite backend.
+        if isinstance(database, str):
+            database = SQLiteStorage(database)
 
         # Initiaize all VASP related objects.
         self.my_addr = my_addr              # Our Address.
@@ -48,16 +134,47 @@ class Vasp:
         self.info_context = info_context    # Our info context.
 
         # Make default storage.
-        self.store = StorableFactory(database)
+        options = dict(
+            cache_size=cache_size, checkpoint_interval=checkpoint_interval,
+            compact_keys=compact_keys, stats=storage_stats,
+            blob_fields=KYC_BLOB_FIELDS if kyc_blobs else (),
+            bloom_filters=bloom_filters, durability=durability)
+        if async_storage:
+            self.store = AsyncStorableFactory(database, **options)
+        else:
+            self.store = StorableFactory(
+                database, group_commit_window=group_commit_window, **options)
         # Make default PaymentProcessor.
-        self.pp = PaymentProcessor(self.bc, self.store)
+        self.pp = PaymentProcessor(
+            self.bc, self.store, delta_interval=delta_interval)
 
         # Make root OffChainVasp Object.
         self.vasp = OffChainVASP(
-            self.my_addr, self.pp, self.store, self.info_context
+            self.my_addr, self.pp, self.store, self.info_context,
+            partition_channels=partition_channels,
+            park_timeout=park_timeout
         )
+        # Move finished payments to a cold store.
+        self.archive_store = None
+        self.archiver = None
+        self.archive_period = archive_period
+        if archive_database is not None:
+            if isinstance(archive_database, str):
+                archive_database = SQLiteStorage(archive_database)
+            self.archive_store = StorableFactory(archive_database)
+            self.archiver = PaymentArchiver(self.vasp, self.archive_store)
+
+        # Reclaim the storage left behind by processed requests.
+        self.compactor = None
+        self.compaction_period = compaction_period
+        if compaction_period is not None:
+            self.compactor = StorageCompactor(
+                self.vasp, retention=lock_retention)
+
         # Make default aiohttp based network.
-        self.net_handler = Aionet(self.vasp)
+        self.net_handler = Aionet(
+            self.vasp, batch_size=batch_size, send_window=send_window,
+            retransmit_timeout=retransmit_timeout)
         self.pp.set_network(self.net_handler) # Set handler for processor.
 
         # Initialize later those ...
@@ -87,8 +204,9 @@ class Vasp:
             loop (asyncio.AbstractEventLoopPolicy): an asyncio event loop on
                 which to register services.
             watch_period (float, optional): the time (seconds) beween
-                activating the network watchdog to trigger debug info and
-                retransmits. Defaults to 10.0.
+                activating the network watchdog to trigger debug info.
+                Requests are retransmitted on their own deadlines (see
+                `retransmit_timeout`). Defaults to 10.0.
 
         '''
         if self.loop is None:
@@ -111,6 +229,15 @@ class Vasp:
         # Reschedule commands to be processed, when the loop starts.
         self.loop.create_task(self.pp.retry_process_commands())
 
+        # Periodically archive finished payments.
+        if self.archiver is not None:
+            self.loop.create_task(self.archiver.run(self.archive_period))
+
+        # Periodically compact the storage.
+        if self.compactor is not None:
+            self.loop.create_task(
+                self.compactor.run(self.compaction_period))
+
         # Mechanism to notify the running of loop
         self.loop.create_task(self._set_start_notifier())
 
@@ -172,8 +299,9 @@ class Vasp:
                 In case of no failure it returns
                 a Bool indicating whether the sequenced command was
                 successful or not. OR In case of a network failure
-                returns an instance of a CommandRequestObject represented
-                as a json dict that can be retransmitted.
+                returns the signed request (a SignedRequest, or with a
+                `batch_size` or `send_window` the CommandRequestObject)
+                that can be retransmitted.
 
             Note that the automatic retransmission will eventually re-sent
             the request until progress is made.
@@ -214,7 +342,9 @@ class Vasp:
 
     def get_payment_by_ref(self, reference_id):
         """ Returns the latest version of the PaymentObject
-            with the given reference ID.
+            with the given reference ID. It reads a snapshot of the
+            committed state, so it is safe to call from any thread
+            and does not wait for the processing of commands.
 
             Parameters:
                 reference_id (str): The reference ID of a payment.
@@ -226,12 +356,14 @@ class Vasp:
                 KeyError: In case a payment with the given reference
                     does not exist.
         """
-        payment = self.pp.get_latest_payment_by_ref_id(reference_id)
+        with self.store.snapshot():
+            payment = self.pp.get_latest_payment_by_ref_id(reference_id)
         return payment
 
     def get_payment_history_by_ref(self, reference_id):
         """ Returns a list of versions of the PaymentObjects
-            with the given reference ID.
+            with the given reference ID, read from a snapshot of the
+            committed state (see ``get_payment_by_ref``).
 
             Parameters:
                 reference_id (str): The reference ID of a payment.
@@ -245,7 +377,9 @@ class Vasp:
                 KeyError: In case a payment with the given reference
                     does not exist.
         """
-        payment = list(self.pp.get_payment_history_by_ref_id(reference_id))
+        with self.store.snapshot():
+            payment = list(
+                self.pp.get_payment_history_by_ref_id(reference_id))
         return payment
 
     async def close_async(self):
@@ -270,6 +404,11 @@ class Vasp:
         logger.info('Cancelling all tasks ...')
         await asyncio.gather(*other_tasks, return_exceptions=True)
 
+        # Write any pending group commit to storage.
+        self.store.close()
+        if self.archive_store is not None:
+            self.archive_store.close()
+
         logger.info('Closing loop ...')
         self.loop.stop()
         if self.loop is not None:
@@ -0,0 +1,105 @@
+# Copyright (c) The Libra Core Contributors
+# SPDX-License-Identifier: Apache-2.0
+
+# Flow control of the requests sent to another VASP.
+
+import asyncio
+from collections import deque
+
+
+class SendWindow:
+    ''' Bounds the number of requests in flight to another VASP, namely
+    sent but not yet answered. The size of the window adapts to the load of
+    the other VASP (AIMD): it grows by about one request per window of
+    requests answered, and halves when a request is answered with ``wait``
+    or times out. It halves at most once for the requests that were in
+    flight together, so that a burst of ``wait`` responses counts once.
+
+    Requests that do not fit in the window wait locally, in order, in
+    ``acquire``.
+
+    Parameters:
+        * max_size : the max number of requests in flight.
+        * initial : the initial size of the window.
+        * min_size : the min size of the window.
+    '''
+
+    def __init__(self, max_size=64, initial=8, min_size=1):
+        self.max_size = max_size
+        self.min_size = min(min_size, max_size)
+        self.size = float(max(self.min_size, min(initial, max_size)))
+
+        self.in_flight = 0
+        self.waiters = deque()
+
+        # The number of requests let through, and its value at the last
+        # decrease: later requests may decrease the window again.
+        self.sent = 0
+        self.recovery_point = 0
+
+        # Statistics.
+        self.decreases = 0
+        self.congestion_events = 0
+
+    def available(self):
+        ''' The number of requests that may be sent now. '''
+        return max(0, int(self.size) - self.in_flight)
+
+    async def acquire(self, number=1):
+        ''' Waits until at least one request may be sent, and takes the
+            window for up to ``number`` requests. Returns the number of
+            requests taken, and a ticket to pass to ``release``. '''
+        woken = False
+        while self.available() == 0 or self.waiters and not woken:
+            future = asyncio.get_event_loop().create_future()
+            if woken:
+                # Woken while the window is full again: keep the place of
+                # the request at the head of the queue.
+                self.waiters.appendleft(future)
+            else:
+                self.waiters.append(future)
+            try:
+                await future
+            except asyncio.CancelledError:
+                if future in self.waiters:
+                    self.waiters.remove(future)
+                else:
+                    # Pass on the wake up to the next request.
+                    self._wake()
+                raise
+            woken = True
+
+        taken = min(number, self.available())
+        self.in_flight += taken
+        self.sent += taken
+        return taken, self.sent
+
+    def release(self, number, ticket, congested=False):
+        ''' Gives back the window taken for ``number`` requests, once they
+            are answered, and adapts its size. '''
+        self.in_flight -= number
+        if congested:
+            self.congestion_events += 1
+            if ticket > self.recovery_point:
+                self.size = max(self.min_size, self.size / 2)
+                self.recovery_point = self.sent
+                self.decreases += 1
+        else:
+            self.size = min(self.max_size, self.size + number / self.size)
+
+        self._wake()
+
+    def release_unused(self, number):
+        ''' Gives back the window taken for ``number`` requests that were
+            not sent, without adapting its size. '''
+        self.in_flight -= number
+        self._wake()
+
+    def _wake(self):
+        ''' Lets the waiting requests take the window. '''
+        for _ in range(self.available()):
+            if not self.waiters:
+                break
+            future = self.waiters.popleft()
+            if not future.done():
+                future.set_result(None)
@@ -0,0 +1,323 @@
+# Copyright (c) The Libra Core Contributors
+# SPDX-License-Identifier: Apache-2.0
+
+# A log-structured, memory-mapped backend for the storage subsystem.
+
+import mmap
+import os
+import struct
+import zlib
+from threading import Lock, RLock, Thread
+
+# The file starts with a magic string, followed by a sequence of records.
+# Each record has a header (type, key length, value length), followed by
+# the key and the value. Writes and deletes of a batch are followed by a
+# commit record, holding the length and CRC32 of the batch records.
+_MAGIC = b'OCLOG001'
+_HEADER = struct.Struct('<BII')
+_PUT = 1
+_DEL = 2
+_COMMIT = 3
+
+# The size of the batches written by the compactor.
+_COMPACT_BATCH = 1 << 20
+
+
+def _committed_batches(mm, offset, end):
+    ''' Yields the list of operations, and the end offset, of each valid
+        committed batch of records in ``mm[offset:end]``. Operations are
+        (type, key, value offset, value length, record size) tuples.
+        Stops at the first record that is incomplete, corrupt, or not
+        followed by a commit record. '''
+    ops = []
+    batch_start = offset
+    while offset + _HEADER.size <= end:
+        kind, key_len, value_len = _HEADER.unpack_from(mm, offset)
+        if kind == _COMMIT:
+            if key_len != offset - batch_start or \
+                    zlib.crc32(mm[batch_start:offset]) != value_len:
+                return
+            offset += _HEADER.size
+            yield ops, offset
+            ops = []
+            batch_start = offset
+        elif kind in (_PUT, _DEL):
+            key_start = offset + _HEADER.size
+            record_end = key_start + key_len + value_len
+            if record_end > end:
+                return
+            try:
+                key = str(mm[key_start:key_start + key_len], 'utf-8')
+            except UnicodeDecodeError:
+                return
+            ops += [(kind, key, key_start + key_len, value_len,
+                     record_end - offset)]
+            offset = record_end
+        else:
+            return
+
+
+class LogStorage:
+    ''' A durable key-value store that appends all writes to a
+    memory-mapped log file, that can be passed to a ``StorableFactory``
+    (or to ``core.Vasp``) as its ``db``.
+
+    Each call to ``write_batch`` (that the ``StorableFactory`` uses to
+    commit a full transaction) appends the records of all writes and
+    deletes, followed by a commit record with a checksum of the batch.
+    An in-memory hash index maps each key to the offset of its latest
+    value, and values are decoded straight from the memory map. On
+    opening, the log is read up to the last valid commit record, and
+    any partially written batch after it is truncated, so the factory
+    does not need to keep a recovery backup of old values.
+
+    Once more than ``compact_ratio`` of the log is taken by overwritten
+    or deleted values, a background thread rewrites the live keys to a
+    new log, that replaces the old one. The hash index does not support
+    ordered prefix scans, so containers traverse their own links.
+
+    Parameters:
+        * path : the file name of the log.
+        * sync : whether each commit is flushed to disk before it
+          returns. Defaults to True.
+        * compact_ratio : the fraction of dead data in the log that
+          triggers a compaction. Defaults to 0.5.
+        * compact_min_size : the size (bytes) of the log below which it
+          is never compacted. Defaults to 1MB.
+        * grow_size : the minimum size (bytes) by which the file grows
+          when the log reaches its end. Defaults to 1MB.
+    '''
+
+    def __init__(self, path, sync=True, compact_ratio=0.5,
+                 compact_min_size=1 << 20, grow_size=1 << 20):
+        self.path = str(path)
+        self.sync = sync
+        self.compact_ratio = compact_ratio
+        self.compact_min_size = compact_min_size
+        self.grow_size = grow_size
+
+        self.lock = RLock()
+        self.compact_lock = Lock()
+        self.compactor = None
+        self.compactions = 0
+
+        # A compaction interrupted by a crash leaves the old log intact.
+        if os.path.exists(self.compact_path()):
+            os.remove(self.compact_path())
+
+        with self.lock:
+            self._open()
+
+    def compact_path(self):
+        return self.path + '.compact'
+
+    def _open(self):
+        ''' Maps the log file, rebuilds the index and truncates any
+            uncommitted records. '''
+        if not os.path.exists(self.path) or os.path.getsize(self.path) == 0:
+            with open(self.path, 'wb') as new_file:
+                new_file.write(_MAGIC)
+                new_file.flush()
+                os.fsync(new_file.fileno())
+
+        self.file = open(self.path, 'r+b')
+        self.mm = mmap.mmap(self.file.fileno(), 0)
+        if self.mm[:len(_MAGIC)] != _MAGIC:
+            self.mm.close()
+            self.file.close()
+            raise RuntimeError(f'{self.path} is not a log storage file.')
+
+        self.index = {}
+        self.live_bytes = 0
+        self.end = len(_MAGIC)
+        self._replay(len(_MAGIC), len(self.mm))
+
+        # Drop anything after the last commit record.
+        if self.end < len(self.mm):
+            self.mm.resize(self.end)
+            os.fsync(self.file.fileno())
+
+    def _replay(self, offset, end):
+        for ops, batch_end in _committed_batches(self.mm, offset, end):
+            self._apply(ops)
+            self.end = batch_end
+
+    def _apply(self, ops):
+        for kind, key, value_offset, value_len, size in ops:
+            old = self.index.pop(key, None)
+            if old is not None:
+                self.live_bytes -= old[2]
+            if kind == _PUT:
+                self.index[key] = (value_offset, value_len, size)
+                self.live_bytes += size
+
+    def __getitem__(self, key):
+        with self.lock:
+            value_offset, value_len, _ = self.index[key]
+            with memoryview(self.mm) as view, \
+                    view[value_offset:value_offset + value_len] as value:
+                return str(value, 'utf-8')
+
+    def __setitem__(self, key, value):
+        self.write_batch({key: value}, ())
+
+    def __delitem__(self, key):
+        with self.lock:
+            if key not in self.index:
+                raise KeyError(key)
+            self.write_batch({}, (key,))
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def keys(self):
+        ''' Returns a list of all keys in the store. '''
+        with self.lock:
+            return list(self.index)
+
+    def set_sync(self, sync):
+        ''' Sets whether each commit is flushed to disk before it
+            returns. '''
+        self.sync = sync
+
+    def write_batch(self, writes, deletes):
+        ''' Atomically writes all key-values in the dict ``writes`` and
+            removes all keys in ``deletes``, by appending them to the log
+            followed by a commit record. Either all changes are persisted
+            or none. '''
+        # Encode everything first, so that a bad value writes nothing.
+        records = bytearray()
+        ops = []
+        for key, value in writes.items():
+            key_data = key.encode()
+            value_data = value if isinstance(value, bytes) \
+                else value.encode()
+            record_start = len(records)
+            records += _HEADER.pack(_PUT, len(key_data), len(value_data))
+            records += key_data
+            value_offset = len(records)
+            records += value_data
+            ops += [(_PUT, key, value_offset, len(value_data),
+                     len(records) - record_start)]
+        for key in deletes:
+            key_data = key.encode()
+            records += _HEADER.pack(_DEL, len(key_data), 0)
+            records += key_data
+            ops += [(_DEL, key, 0, 0, 0)]
+        if not ops:
+            return
+        records += _HEADER.pack(_COMMIT, len(records), zlib.crc32(records))
+
+        with self.lock:
+            start = self.end
+            if start + len(records) > len(self.mm):
+                self.mm.resize(max(
+                    start + len(records), len(self.mm) + self.grow_size))
+            self.mm[start:start + len(records)] = records
+            if self.sync:
+                page_start = start - start % mmap.ALLOCATIONGRANULARITY
+                self.mm.flush(page_start, start + len(records) - page_start)
+            self.end = start + len(records)
+            self._apply([(kind, key, start + value_offset, value_len, size)
+                         for kind, key, value_offset, value_len, size in ops])
+
+            if self.needs_compaction() and (
+                    self.compactor is None or not self.compactor.is_alive()):
+                self.compactor = Thread(target=self.compact, daemon=True)
+                self.compactor.start()
+
+    def needs_compaction(self):
+        ''' Returns True if enough of the log is dead to compact it. '''
+        log_size = self.end - len(_MAGIC)
+        return log_size >= self.compact_min_size and \
+            log_size - self.live_bytes > self.compact_ratio * log_size
+
+    def compact(self):
+        ''' Rewrites the live keys to a new log, that replaces the current
+            one. Only appending the records committed while it runs, and
+            replacing the log, block other writes and reads. Returns the
+            number of bytes reclaimed. '''
+        with self.compact_lock:
+            with self.lock:
+                if self.mm is None:
+                    return 0
+                mm, snapshot_end = self.mm, self.end
+                old_size = len(mm)
+                snapshot = list(self.index.items())
+
+            index = {}
+            live_bytes = 0
+            with open(self.compact_path(), 'wb') as new_file:
+                new_file.write(_MAGIC)
+                offset = len(_MAGIC)
+                records = bytearray()
+                for key, (value_offset, value_len, size) in snapshot:
+                    key_data = key.encode()
+                    records += _HEADER.pack(_PUT, len(key_data), value_len)
+                    records += key_data
+                    index[key] = (offset + len(records), value_len, size)
+                    records += mm[value_offset:value_offset + value_len]
+                    live_bytes += size
+                    if len(records) >= _COMPACT_BATCH:
+                        offset += self._write_batch_records(new_file, records)
+                        records = bytearray()
+                if records:
+                    offset += self._write_batch_records(new_file, records)
+
+                with self.lock:
+                    if self.mm is not mm:
+                        # Closed while compacting.
+                        os.remove(self.compact_path())
+                        return 0
+
+                    # Copy the batches committed since the snapshot as is.
+                    new_file.write(self.mm[snapshot_end:self.end])
+                    new_file.flush()
+                    os.fsync(new_file.fileno())
+                    os.replace(self.compact_path(), self.path)
+                    self._sync_dir()
+
+                    self.mm.close()
+                    self.file.close()
+                    self.file = open(self.path, 'r+b')
+                    self.mm = mmap.mmap(self.file.fileno(), 0)
+                    self.index = index
+                    self.live_bytes = live_bytes
+                    self.end = offset
+                    self._replay(offset, len(self.mm))
+                    self.compactions += 1
+                    return old_size - len(self.mm)
+
+    @staticmethod
+    def _write_batch_records(new_file, records):
+        records += _HEADER.pack(_COMMIT, len(records), zlib.crc32(records))
+        new_file.write(records)
+        return len(records)
+
+    def _sync_dir(self):
+        dir_fd = os.open(os.path.dirname(os.path.abspath(self.path)),
+                         os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+    def close(self):
+        ''' Waits for any compaction, and closes the log. '''
+        compactor = self.compactor
+        if compactor is not None:
+            compactor.join()
+        with self.lock:
+            if self.mm is None:
+                return
+            self.mm.flush()
+            self.mm.close()
+            self.mm = None
+            self.file.truncate(self.end)
+            self.file.close()
@@ -0,0 +1,152 @@
+# Copyright (c) The Libra Core Contributors
+# SPDX-License-Identifier: Apache-2.0
+
+# The table of object locks of a channel.
+
+from enum import Enum
+
+
+class LockState(Enum):
+    ''' The state of an object version that is not locked by a request. The
+    values are those stored. '''
+
+    # The object exists and is ready to be used by a command.
+    FREE = 'True'
+    # The object exists, but has already been used by a committed command.
+    USED = 'False'
+
+
+class ObjectLockTable:
+    ''' The object locks of a channel, held in memory and written through to
+    a storable dict (``store``), in the transaction of the write.
+
+    Each object version maps to a LockState, or to the cid (as bytes) of
+    the request that locks it. The table is read from storage once, on
+    first use, so that checking locks is a dict lookup, without reads from
+    storage or parsing. It must only be changed through this table, under
+    the lock of the channel. Since storage transactions do not roll back
+    their writes, the table follows the committed state.
+
+    The table also behaves as the dict it stores into, with values
+    ``'True'``, ``'False'`` or a cid.
+
+    To reclaim storage, the locks of consumed versions can be moved out of
+    the table (see ``collect``) to a store of ``collected`` versions, that
+    is only read for versions not in the table. Collected versions remain
+    ``LockState.USED``, so that requests depending on them, or creating
+    them again, are still rejected. ``keys`` and ``len`` only cover the
+    table.
+
+    Parameters:
+        * store : the StorableDict (of str) in which locks are stored.
+        * collected : the StorableDict (of str) of collected versions, or
+          None.
+    '''
+
+    def __init__(self, store, collected=None):
+        self.store = store
+        self.collected = collected
+        self.table = None
+
+    def _load(self):
+        table = {}
+        for version in self.store.keys():
+            table[version] = self.decode(self.store[version])
+        self.table = table
+        return table
+
+    def _get_table(self):
+        table = self.table
+        if table is None:
+            table = self._load()
+        return table
+
+    @staticmethod
+    def decode(value):
+        ''' Returns the state of a lock from its stored value. '''
+        if value == LockState.FREE.value:
+            return LockState.FREE
+        if value == LockState.USED.value:
+            return LockState.USED
+        return value.encode()
+
+    @staticmethod
+    def encode(state):
+        ''' Returns the stored value of the state of a lock. '''
+        if isinstance(state, LockState):
+            return state.value
+        return state.decode()
+
+    def get(self, version):
+        ''' Returns the state of the lock of an object version: a LockState,
+            the cid (bytes) of the request locking it, or None if there is
+            no such version. '''
+        state = self._get_table().get(version)
+        if state is None and self.is_collected(version):
+            return LockState.USED
+        return state
+
+    def is_free(self, version):
+        return self._get_table().get(version) is LockState.FREE
+
+    def is_used(self, version):
+        return self.get(version) is LockState.USED
+
+    def is_collected(self, version):
+        ''' Returns True if the lock of a consumed version was collected. '''
+        return self.collected is not None and version in self.collected
+
+    def collect(self, version):
+        ''' Moves the lock of a consumed version from the table to the
+            collected versions. Returns False if the table does not hold
+            a consumed lock for the version. '''
+        table = self._get_table()
+        if table.get(version) is not LockState.USED:
+            return False
+        self.collected[version] = LockState.USED.value
+        del self.store[version]
+        del table[version]
+        return True
+
+    def is_locked_by(self, version, cid):
+        return self._get_table().get(version) == cid.encode()
+
+    def set_state(self, version, state):
+        ''' Sets the state of the lock of an object version to a LockState,
+            or the cid (str) of the request locking it. '''
+        table = self._get_table()
+        if isinstance(state, str):
+            state = state.encode()
+        self.store[version] = self.encode(state)
+        table[version] = state
+
+    def free(self, version):
+        self.set_state(version, LockState.FREE)
+
+    def use(self, version):
+        self.set_state(version, LockState.USED)
+
+    def lock(self, version, cid):
+        self.set_state(version, cid)
+
+    def __contains__(self, version):
+        return version in self._get_table() or self.is_collected(version)
+
+    def __getitem__(self, version):
+        return self.encode(self._get_table()[version])
+
+    def __setitem__(self, version, value):
+        self.set_state(version, self.decode(value))
+
+    def __delitem__(self, version):
+        table = self._get_table()
+        if version not in table:
+            raise KeyError(version)
+        del self.store[version]
+        del table[version]
+
+    def __len__(self):
+        return len(self._get_table())
+
+    def keys(self):
+        return list(self._get_table())
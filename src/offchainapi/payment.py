@@ -185,6 +185,11 @@ class PaymentActor(StructureChecker):
         })
 
 
+# The fields of payment actors that hold KYC data, which can be stored
+# once and shared by all versions of a payment (see StorableFactory).
+KYC_BLOB_FIELDS = ('kyc_data', 'additional_kyc_data')
+
+
 class PaymentAction(StructureChecker):
     fields = [
         ('amount', int, REQUIRED, WRITE_ONCE),
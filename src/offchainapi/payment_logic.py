@@ -29,6 +29,16 @@ class PaymentProcessorRemoteError(Exception):
 logger = logging.getLogger(name='libra_off_chain_api.payment_logic')
 
 
+def payment_is_final(payment):
+    ''' Returns True if the payment is in a final state: both sides are
+        ready_for_settlement, or either side has aborted. '''
+    sender_status = payment.sender.status.as_status()
+    receiver_status = payment.receiver.status.as_status()
+    return (sender_status == Status.ready_for_settlement and
+            receiver_status == Status.ready_for_settlement) or \
+        sender_status == Status.abort or receiver_status == Status.abort
+
+
 class PaymentProcessor(CommandProcessor):
     ''' The logic to process a payment from either side.
 
@@ -46,9 +56,19 @@ class PaymentProcessor(CommandProcessor):
 
     The Processor must store those commands, and ensure they have
     all been suitably processed upon a potential crash and recovery.
+
+    With ``log_stores`` set, the write-once ``object_store`` and
+    ``command_cache`` are kept in append-only storable maps (see
+    ``StorableFactory.make_log_dict``), migrating any existing data.
+
+    With a ``delta_interval`` larger than zero, new versions of objects are
+    stored in the ``object_store`` as deltas against their previous
+    version, with a full version at least every ``delta_interval``
+    versions (see ``StorableDict``).
     '''
 
-    def __init__(self, business, storage_factory, loop=None):
+    def __init__(self, business, storage_factory, loop=None, log_stores=False,
+                 delta_interval=0):
         self.business = business
 
         # Asyncio support
@@ -61,18 +81,22 @@ class PaymentProcessor(CommandProcessor):
         with self.storage_factory.atomic_writes():
             root = storage_factory.make_value('processor', None)
             self.reference_id_index = storage_factory.make_dict(
-                'reference_id_index', PaymentObject, root)
+                'reference_id_index', PaymentObject, root, cached=True)
+
+            make_write_once_dict = storage_factory.make_log_dict \
+                if log_stores else storage_factory.make_dict
 
             # This is the primary store of shared objects.
             # It maps version numbers -> objects.
-            self.object_store = storage_factory.make_dict(
-                'object_store', SharedObject, root=root)
+            self.object_store = make_write_once_dict(
+                'object_store', SharedObject, root=root, cached=True,
+                delta_interval=delta_interval)
 
             # Persist those to enable crash-recovery
             self.pending_commands = storage_factory.make_dict(
-                'pending_commands', str, root)
-            self.command_cache = storage_factory.make_dict(
-                'command_cache', ProtocolCommand, root)
+                'pending_commands', str, root, hot=True, bloom=True)
+            self.command_cache = make_write_once_dict(
+                'command_cache', ProtocolCommand, root, hot=True)
 
         # Allow mapping a set of future to payment reference_id outcomes
         # Once a payment has an outcome (ready_for_settlement, abort, or command exception)
@@ -85,6 +109,11 @@ class PaymentProcessor(CommandProcessor):
         # Storage for debug futures list
         self.futs = []
 
+        # When payments are archived (see archive.PaymentArchiver) this
+        # maps the reference_id of payments in a final state to their
+        # latest version, until they are moved to the cold store.
+        self.finished_payments = None
+
     def set_network(self, net):
         ''' Assigns a concrete network for this command processor to use. '''
         assert self.net is None
@@ -231,9 +260,12 @@ class PaymentProcessor(CommandProcessor):
 
                     # This context ensure that either we both
                     # write the next request & free th obligation
-                    # Or none of the two.
-                    with self.storage_factory.atomic_writes():
-                        request = await self.net.sequence_command(
+                    # Or none of the two. The transaction of the
+                    # channel is opened first, and ends before the
+                    # request is signed.
+                    async with self.net.atomic_writes_async(other_address), \
+                            self.storage_factory.atomic_writes_async():
+                        request = self.net.sequence_command_local(
                             other_address, new_cmd
                         )
 
@@ -243,8 +275,11 @@ class PaymentProcessor(CommandProcessor):
                         if self.obligation_exists(other_address_str, seq):
                             self.release_command_obligation(
                                 other_address_str, seq)
+                    await self.storage_factory.wait_durable()
 
                     # Attempt to send it to the other VASP.
+                    request = await self.net.package_sequenced(
+                        other_address, request)
                     await self.net.send_request(other_address, request)
                 else:
                     # Signal to anyone waiting that progress was not made
@@ -267,7 +302,7 @@ class PaymentProcessor(CommandProcessor):
                     )
 
             # If we are here we are done with this obligation.
-            with self.storage_factory.atomic_writes():
+            async with self.storage_factory.atomic_writes_async():
                 if self.obligation_exists(other_address_str, seq):
                     self.release_command_obligation(other_address_str, seq)
 
@@ -312,10 +347,7 @@ class PaymentProcessor(CommandProcessor):
         '''
 
         # Check if payment is in a final state
-        if not ((payment.sender.status.as_status() == Status.ready_for_settlement and \
-                payment.receiver.status.as_status() == Status.ready_for_settlement) or \
-                payment.sender.status.as_status() == Status.abort or \
-                payment.receiver.status.as_status() == Status.abort):
+        if not payment_is_final(payment):
             return
 
         # Check if anyone is waiting for this payment.
@@ -497,9 +529,15 @@ class PaymentProcessor(CommandProcessor):
             dependencies_versions = command.get_dependencies()
             if old_version in dependencies_versions:
                 self.reference_id_index[ref_id] = payment
+            else:
+                return
         else:
             self.reference_id_index[ref_id] = payment
 
+        # Record finished payments for the archiver.
+        if self.finished_payments is not None and payment_is_final(payment):
+            self.finished_payments[ref_id] = payment.get_version()
+
     # ----------- END of CommandProcessor interface ---------
 
     def check_signatures(self, payment):
@@ -3,13 +3,14 @@
 
 from .command_processor import CommandProcessor, CommandValidationError
 from .protocol_messages import CommandRequestObject, CommandResponseObject, \
-    OffChainProtocolError, OffChainException, \
+    CommandBatchObject, OffChainProtocolError, OffChainException, \
     make_success_response, make_protocol_error, \
     make_parsing_error, make_command_error
 from .errors import OffChainErrorCode
 from .utils import JSONParsingError, JSONFlag
 from .libra_address import LibraAddress
 from .crypto import OffChainInvalidSignature
+from .object_locks import LockState, ObjectLockTable
 
 import json
 from collections import namedtuple
@@ -44,9 +45,17 @@ class OffChainVASP:
         storage_factory (StorableFactory): The storage factory.
         info_context (VASPInfo): The information context for the VASP
                                  implementing the VASPInfo interface.
+        partition_channels (bool, optional): Whether each channel uses its
+            own storage partition, with independent transactions (see
+            StoragePartition). Defaults to False.
+        park_timeout (float, optional): The max time (seconds) the server
+            channels hold a request whose dependencies are missing or
+            locked, before answering it with a wait (see VASPPairChannel).
+            Defaults to 0.0 (answer at once).
     """
 
-    def __init__(self, vasp_addr, processor, storage_factory, info_context):
+    def __init__(self, vasp_addr, processor, storage_factory, info_context,
+                 partition_channels=False, park_timeout=0.0):
         logger.debug(f'Creating VASP {vasp_addr.as_str()}')
 
         assert isinstance(processor, CommandProcessor)
@@ -71,6 +80,13 @@ class OffChainVASP:
 
         # Manage storage.
         self.storage_factory = storage_factory
+        self.partition_channels = partition_channels
+
+        # The time requests blocked on their dependencies are held.
+        self.park_timeout = park_timeout
+
+        # The PaymentArchiver moving finished payments to a cold store.
+        self.archiver = None
 
     def get_vasp_address(self):
         """Return our own VASP Libra Blockchain Address.
@@ -95,13 +111,20 @@ class OffChainVASP:
         store_key = (my_address, other_vasp_addr)
 
         if store_key not in self.channel_store:
+            storage = self.storage_factory
+            if self.partition_channels:
+                storage = storage.partition(other_vasp_addr.as_str())
+
             channel = VASPPairChannel(
                 my_address,
                 other_vasp_addr,
                 self,
-                self.storage_factory,
-                self.processor
+                storage,
+                self.processor,
+                park_timeout=self.park_timeout
             )
+            if self.archiver is not None:
+                self.archiver.attach_channel(channel)
             self.channel_store[store_key] = channel
 
         return self.channel_store[store_key]
@@ -126,12 +149,21 @@ class VASPPairChannel:
                              is attached.
         storage (StorageFactory): The storage factory.
         processor (CommandProcessor): A command processor.
+        park_timeout (float, optional): The max time (seconds) a request of
+            the other VASP whose dependencies are missing, or locked by our
+            requests, is held before it is answered with a wait. It is
+            handled again each time the lock of one of its dependencies
+            changes (see register_dependencies), and answered as soon as
+            it does not have to wait. Only the server, that sequences the
+            requests, holds requests, and only those not sent in a batch.
+            Defaults to 0.0 (answer at once).
 
     Raises:
         OffChainException: If the channel is not talking to another VASP.
     """
 
-    def __init__(self, myself, other, vasp, storage, processor):
+    def __init__(self, myself, other, vasp, storage, processor,
+                 park_timeout=0.0):
 
         assert isinstance(myself, LibraAddress)
         assert isinstance(other, LibraAddress)
@@ -157,44 +189,65 @@ class VASPPairChannel:
         # A reentrant lock to manage access.
         self.rlock = RLock()
 
-        # State that is persisted.
+        # The number of consumed object locks removed to reclaim storage
+        # (see compaction.StorageCompactor).
+        self.collected_locks = 0
+
+        # The requests queued to be sent to the other VASP, with the futures
+        # of their results, and the SendWindow bounding those in flight
+        # (see flow_control.SendWindow). Both are managed by the network.
+        self.outbox = []
+        self.send_window = None
+
+        # The futures of the requests held until the lock of an object
+        # version changes, by version, and the number of requests held.
+        self.park_timeout = park_timeout
+        self.parked = {}
+        self.parked_requests = 0
+
+        # State that is persisted. Making the containers reads and writes
+        # nothing (see StorableValue), so channels are cheap to open.
 
         root = self.storage.make_value(self.myself.as_str(), None)
         other_vasp = self.storage.make_value(
             self.other_address_str, None, root=root
         )
 
-        with self.storage.atomic_writes():
-
-            # The common sequence of commands and their
-            # status for those committed.
-            self.command_sequence = self.storage.make_list(
-                'command_sequence', CommandRequestObject, root=other_vasp
-            )
+        # The common sequence of commands and their
+        # status for those committed.
+        self.command_sequence = self.storage.make_list(
+            'command_sequence', CommandRequestObject, root=other_vasp
+        )
 
-            # Keep track of object locks
-
-            # Object_locks takes values 'True', 'False' or a request cid.
-            #  * True means that the object exists and is ready to be used
-            #    by a command.
-            #  * False means that an object exists, but has already been used
-            #    by a command that is committed.
-            #  * Another value indicates a lock for a request with the cid
-            #    stored.
-            self.object_locks = self.storage.make_dict(
-                        'object_locks', str, root=other_vasp)
-
-            # Maps between request cid and requests for self and other.
-            self.my_request_index = self.storage.make_dict(
-                        'my_request_index', CommandRequestObject,
-                        root=other_vasp)
-            self.other_request_index = self.storage.make_dict(
-                        'other_request_index', CommandRequestObject,
-                        root=other_vasp)
-
-            # Indicates for a request cid if a response has been received.
-            self.pending_response = self.storage.make_dict(
-                        'pending_response', bool, root=other_vasp)
+        # Keep track of object locks
+
+        # Object_locks takes values 'True', 'False' or a request cid.
+        #  * True means that the object exists and is ready to be used
+        #    by a command.
+        #  * False means that an object exists, but has already been used
+        #    by a command that is committed.
+        #  * Another value indicates a lock for a request with the cid
+        #    stored.
+        # They are checked in memory (see ObjectLockTable), as LockState
+        # values or cids. Consumed locks collected to reclaim storage are
+        # kept, cold, in 'collected_locks' (see compaction.StorageCompactor).
+        self.object_locks = ObjectLockTable(
+            self.storage.make_dict(
+                'object_locks', str, root=other_vasp, hot=True),
+            collected=self.storage.make_log_dict(
+                'collected_locks', str, root=other_vasp, bloom=True))
+
+        # Maps between request cid and requests for self and other.
+        self.my_request_index = self.storage.make_dict(
+            'my_request_index', CommandRequestObject,
+            root=other_vasp, cached=True)
+        self.other_request_index = self.storage.make_dict(
+            'other_request_index', CommandRequestObject,
+            root=other_vasp, cached=True, bloom=True)
+
+        # Indicates for a request cid if a response has been received.
+        self.pending_response = self.storage.make_dict(
+            'pending_response', bool, root=other_vasp, hot=True)
 
         logger.debug(f'(other:{self.other_address_str}) Created VASP channel')
 
@@ -265,11 +318,42 @@ class VASPPairChannel:
 
         return net_message
 
+    async def package_requests(self, requests):
+        """ A hook to send a batch of requests to the other VASP, with a
+        single signature (see CommandBatchObject).
+
+        Args:
+            requests (list): The CommandRequestObject instances.
+
+        Returns:
+            NetMessage: The message to be sent on a network.
+        """
+        batch = CommandBatchObject(requests)
+        json_dict = batch.get_json_data_dict(JSONFlag.NET)
+
+        # Make signature.
+        vasp = self.get_vasp()
+        my_key = vasp.info_context.get_my_compliance_signature_key(
+            self.get_my_address().as_str()
+        )
+        json_string = await my_key.sign_message(json.dumps(json_dict))
+
+        net_message = NetMessage(
+            self.myself,
+            self.other,
+            CommandBatchObject,
+            json_string,
+            batch
+        )
+
+        return net_message
+
     async def package_response(self, response):
         """ A hook to send a response to other VASP.
 
         Args:
-            response (CommandResponseObject): The request object.
+            response (CommandResponseObject or CommandBatchObject): The
+                response object, or a batch of them.
 
         Returns:
             NetMessage: The message to be sent on a network.
@@ -284,8 +368,11 @@ class VASPPairChannel:
 
         signed_response = await my_key.sign_message(json.dumps(struct))
 
+        net_type = CommandBatchObject \
+            if isinstance(response, CommandBatchObject) \
+            else CommandResponseObject
         net_message = NetMessage(
-            self.myself, self.other, CommandResponseObject, signed_response, response
+            self.myself, self.other, net_type, signed_response, response
         )
 
         return net_message
@@ -359,17 +446,17 @@ class VASPPairChannel:
         create_versions = request.command.get_new_object_versions()
         depends_on_version = request.command.get_dependencies()
 
-        if any(dv not in self.object_locks for dv in depends_on_version):
+        locks = [self.object_locks.get(dv) for dv in depends_on_version]
+        if any(lock is None for lock in locks):
             raise DependencyException('Dependencies not present.')
 
-        if any(self.object_locks[dv] == 'False' for dv in depends_on_version):
+        if any(lock is LockState.USED for lock in locks):
             raise DependencyException('Dependencies used.')
 
         if any(cv in self.object_locks for cv in create_versions):
             raise DependencyException('Object version already exists.')
 
-        is_locked = any(self.object_locks[dv] != 'True'
-                        for dv in depends_on_version)
+        is_locked = any(lock is not LockState.FREE for lock in locks)
         if is_locked:
             raise DependencyException('Dependencies locked.')
 
@@ -387,7 +474,7 @@ class VASPPairChannel:
                 self.pending_response[request.cid] = True
 
                 for dv in depends_on_version:
-                    self.object_locks[dv] = request.cid
+                    self.object_locks.lock(dv, request.cid)
                     # By definition nothing was waiting here, since
                     # we checked it was all True.
 
@@ -396,7 +483,14 @@ class VASPPairChannel:
         return request
 
     async def parse_handle_request(self, json_command):
-        """ Handles a request provided as a json string or dict.
+        """ Handles a request, or a batch of requests (see
+        package_requests), provided as a json string or dict. The requests
+        of a batch are handled in order, in one transaction, and the
+        response is the batch of their responses. A single request that
+        must wait for its dependencies may be parked (see
+        handle_request_parked), while a request of a batch is answered with
+        a wait at once, and retransmitted, so that it does not hold back
+        the response to the other requests of the batch.
 
         Args:
             json_command (str or dict): The json request.
@@ -414,18 +508,23 @@ class VASPPairChannel:
             message = await other_key.verify_message(json_command)
             request = json.loads(message)
 
-            # Parse the request whoever necessary.
-            request = CommandRequestObject.from_json_data_dict(
-                request, JSONFlag.NET
-            )
-
-            with self.rlock:
-                # Going ahead to process the request.
-                logger.debug(
-                    f'(other:{self.other_address_str}) '
-                    f'Processing request seq #{request.cid}',
+            if CommandBatchObject.is_batch(request):
+                batch = CommandBatchObject.from_json_data_dict(
+                    request, JSONFlag.NET
+                )
+                async with self.storage.atomic_writes_async():
+                    response = CommandBatchObject(
+                        [self.parse_handle_batch_item(item) for item in batch]
+                    )
+            else:
+                # Parse the request whoever necessary.
+                request = CommandRequestObject.from_json_data_dict(
+                    request, JSONFlag.NET
                 )
-                response = self.handle_request(request)
+                response = await self.handle_request_parked(request)
+
+            # Only respond once the effects of the request are durable.
+            await self.storage.wait_durable()
 
         except OffChainInvalidSignature as e:
             logger.warning(
@@ -451,6 +550,115 @@ class VASPPairChannel:
         full_response = await self.package_response(response)
         return full_response
 
+    def parse_handle_batch_item(self, json_dict):
+        """ Handles a request of a batch provided as a JSON data dictionary.
+        A request that cannot be parsed gets a parsing error, and does not
+        affect the other requests of the batch.
+
+        Args:
+            json_dict (dict): The request.
+
+        Returns:
+            CommandResponseObject: The response to the VASP's request.
+        """
+        try:
+            request = CommandRequestObject.from_json_data_dict(
+                json_dict, JSONFlag.NET
+            )
+        except JSONParsingError as e:
+            logger.error(
+                f'(other:{self.other_address_str}) '
+                f'JSONParsingError in batch: {e}'
+            )
+            return make_parsing_error()
+        return self.handle_request_locked(request)
+
+    async def handle_request_parked(self, request):
+        """ Handles a request (see `handle_request_locked`). If it must wait
+        for its dependencies, the channel is the server and has a
+        park_timeout, the request is held and handled again each time the
+        lock of a dependency changes, until it gets another response or the
+        timeout expires.
+
+        Args:
+            request (CommandRequestObject): The request.
+
+        Returns:
+            CommandResponseObject: The response to the VASP's request.
+        """
+        if self.park_timeout <= 0 or not self.is_server():
+            async with self.storage.atomic_writes_async():
+                return self.handle_request_locked(request)
+
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + self.park_timeout
+        versions = request.command.get_dependencies()
+        parked = False
+        while True:
+            future = loop.create_future()
+            async with self.storage.atomic_writes_async():
+                with self.rlock:
+                    response = self.handle_request(request)
+                    timeout = deadline - loop.time()
+                    if not self.must_wait(response) or timeout <= 0:
+                        return response
+
+                    # Park under the lock, so that no change of the locks
+                    # of the dependencies is missed.
+                    for version in versions:
+                        self.parked.setdefault(version, []).append(future)
+
+            if not parked:
+                parked = True
+                self.parked_requests += 1
+                logger.debug(
+                    f'(other:{self.other_address_str}) '
+                    f'Park request seq #{request.cid} on {versions}')
+
+            try:
+                await asyncio.wait_for(future, timeout)
+            except asyncio.TimeoutError:
+                pass
+            finally:
+                with self.rlock:
+                    for version in versions:
+                        futures = self.parked.get(version, [])
+                        if future in futures:
+                            futures.remove(future)
+                        if not futures:
+                            self.parked.pop(version, None)
+
+    @staticmethod
+    def must_wait(response):
+        ''' Whether a response tells the other VASP to wait. '''
+        return response.is_protocol_failure() and \
+            response.error.code == OffChainErrorCode.wait
+
+    def wake_parked(self, versions):
+        ''' Wakes the requests held until the lock of any of the object
+            versions changes (see `handle_request_parked`). '''
+        for version in versions:
+            for future in self.parked.pop(version, []):
+                if not future.done():
+                    future.get_loop().call_soon_threadsafe(
+                        self._set_woken, future)
+
+    @staticmethod
+    def _set_woken(future):
+        if not future.done():
+            future.set_result(None)
+
+    def handle_request_locked(self, request):
+        """ Handles a request, holding the lock of the channel. (see
+        `_handle_request`) """
+        with self.rlock:
+            # Going ahead to process the request.
+            logger.debug(
+                f'(other:{self.other_address_str}) '
+                f'Processing request seq #{request.cid}',
+            )
+            return self.handle_request(request)
+
     def handle_request(self, request):
         """ Handles a request provided as a dictionary. (see `_handle_request`)
         """
@@ -479,8 +687,8 @@ class VASPPairChannel:
                 if previous_request.is_same_command(request):
 
                     # Invariant
-                    assert all(cv in self.object_locks
-                               for cv in create_versions)
+                    assert all(
+                        cv in self.object_locks for cv in create_versions)
 
                     # Re-send the response.
                     logger.debug(
@@ -503,24 +711,23 @@ class VASPPairChannel:
                     )
                     return response
 
-        # Read & cache object locks for this command
-        obj_locks = {dv:  self.object_locks[dv]
-                     for dv in depends_on_version
-                     if dv in self.object_locks}
+        # Read object locks for this command
+        obj_locks = {dv: self.object_locks.get(dv)
+                     for dv in depends_on_version}
 
-        if any(dv not in obj_locks for dv in depends_on_version):
+        if any(obj_locks[dv] is None for dv in depends_on_version):
             # Some dependencies are missing but may becomes available later?
             response = make_protocol_error(
                 request, code=OffChainErrorCode.wait)
             return response
 
         # Check all dependencies are here and not used.
-        has_all_deps = all(obj_locks[dv] != 'False'
+        has_all_deps = all(obj_locks[dv] is not LockState.USED
                            for dv in depends_on_version)
 
         # If one of the dependency is locked then wait.
         if has_all_deps:
-            is_locked = any(obj_locks[dv] != 'True'
+            is_locked = any(obj_locks[dv] is not LockState.FREE
                             for dv in depends_on_version)
             if is_locked:
                 if self.is_server():
@@ -540,7 +747,7 @@ class VASPPairChannel:
             # Record the error in the log
             logger.error(f'Reject request {request.cid} -- missing dependencies')
             for dv in depends_on_version:
-                if dv not in obj_locks:
+                if obj_locks[dv] is None:
                     logger.error(f' Key {dv} not found')
                 else:
                     logger.error(f' Key {dv} = {obj_locks[dv]}')
@@ -589,10 +796,10 @@ class VASPPairChannel:
             assert all(v in self.object_locks for v in depends_on_version)
 
             for dv in depends_on_version:
-                self.object_locks[dv] = 'False'
+                self.object_locks.use(dv)
 
             for cv in create_versions:
-                self.object_locks[cv] = 'True'
+                self.object_locks.free(cv)
 
             logger.debug(f'[{self.role()}] Dependency update: {depends_on_version} -> {create_versions}')
 
@@ -600,8 +807,11 @@ class VASPPairChannel:
             for dv in depends_on_version:
                 # The depedency may not be in the locks, since the failure
                 # may have been due to a missing dependency.
-                if dv in self.object_locks and self.object_locks[dv] == request.cid:
-                    self.object_locks[dv] = 'True'
+                if self.object_locks.is_locked_by(dv, request.cid):
+                    self.object_locks.free(dv)
+
+        if self.parked:
+            self.wake_parked(list(depends_on_version) + list(create_versions))
 
 
     async def parse_handle_response(self, json_response):
@@ -624,8 +834,9 @@ class VASPPairChannel:
                 response, JSONFlag.NET
             )
 
-            with self.rlock:
-                result = self.handle_response(response)
+            async with self.storage.atomic_writes_async():
+                with self.rlock:
+                    result = self.handle_response(response)
             return result
 
         except OffChainInvalidSignature as e:
@@ -646,6 +857,59 @@ class VASPPairChannel:
             )
             raise e
 
+    async def parse_handle_batch_response(self, json_response):
+        """ Handles the response to a batch of requests (see
+        `package_requests`), as a json string.
+
+        Args:
+            json_response (str): The response signed using JWS.
+
+        Raises:
+            As `parse_handle_response`, if the batch was rejected as a
+            whole (eg. its signature was invalid).
+
+        Returns:
+            list: For each response of the batch, in order, whether its
+            command was a success (bool), or the exception (eg.
+            OffChainProtocolError) that handling the response raised.
+        """
+        vasp = self.get_vasp()
+        other_key = vasp.info_context.get_peer_compliance_verification_key(
+            self.other_address_str
+        )
+        message = await other_key.verify_message(json_response)
+        data = json.loads(message)
+
+        if not CommandBatchObject.is_batch(data):
+            # The batch was rejected as a whole.
+            response = CommandResponseObject.from_json_data_dict(
+                data, JSONFlag.NET
+            )
+            async with self.storage.atomic_writes_async():
+                with self.rlock:
+                    self.handle_response(response)
+            raise OffChainException(
+                'Received a single response to a batch of requests.'
+            )
+
+        batch = CommandBatchObject.from_json_data_dict(data, JSONFlag.NET)
+        results = []
+        async with self.storage.atomic_writes_async():
+            for item in batch:
+                try:
+                    response = CommandResponseObject.from_json_data_dict(
+                        item, JSONFlag.NET
+                    )
+                    with self.rlock:
+                        results += [self.handle_response(response)]
+                except (OffChainException, JSONParsingError) as e:
+                    logger.warning(
+                        f'(other:{self.other_address_str}) '
+                        f'Response in batch failed: {e}'
+                    )
+                    results += [e]
+        return results
+
     def handle_response(self, response):
         """ Handles a response provided as a dictionary. See `_handle_response`
         """
@@ -731,6 +995,14 @@ class VASPPairChannel:
         """
         return len(self.pending_response) > 0
 
+    def send_queue_depth(self):
+        '''
+        Returns:
+            the number of requests queued locally, waiting to be sent
+            to the other VASP.
+        '''
+        return len(self.outbox)
+
     def pending_retransmit_number(self):
         '''
         Returns:
@@ -249,6 +249,66 @@ class CommandResponseObject(JSONSerializable):
             raise JSONParsingError(*e.args)
 
 
+class CommandBatchObject(JSONSerializable):
+    """ Represents a batch of requests of the Off chain protocol, or the
+    batch of their responses in the same order. A batch travels with a
+    single signature in a single exchange, but each request in it is
+    handled, and succeeds or fails, as if it was sent on its own.
+
+    Args:
+        items (list): The CommandRequestObject or CommandResponseObject
+            instances of the batch.
+    """
+
+    def __init__(self, items):
+        self.items = list(items)
+
+    def __eq__(self, other):
+        return isinstance(other, CommandBatchObject) \
+            and self.items == other.items
+
+    def __len__(self):
+        return len(self.items)
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def is_failure(self):
+        """ Returns False, since each item of a batch carries its own
+        outcome. """
+        return False
+
+    @classmethod
+    def is_batch(cls, data):
+        """ Returns True if the JSON data dictionary is a batch. """
+        return isinstance(data, dict) \
+            and data.get('_ObjectType') == cls.json_type()
+
+    # define serialization interface
+
+    def get_json_data_dict(self, flag):
+        ''' Override JSONSerializable. '''
+        data_dict = {
+            "batch": [item.get_json_data_dict(flag) for item in self.items]
+        }
+        self.add_object_type(data_dict)
+        return data_dict
+
+    @classmethod
+    def from_json_data_dict(cls, data, flag):
+        ''' Override JSONSerializable. The items are left as JSON data
+        dictionaries, to be parsed one by one. '''
+        try:
+            items = data['batch']
+            if not isinstance(items, list):
+                raise JSONParsingError('A batch must be a list of items.')
+            return CommandBatchObject(items)
+        except JSONParsingError:
+            raise
+        except Exception as e:
+            raise JSONParsingError(*e.args)
+
+
 def make_success_response(request):
     """Constructs a CommandResponse signaling success.
 
@@ -0,0 +1,201 @@
+# Copyright (c) The Libra Core Contributors
+# SPDX-License-Identifier: Apache-2.0
+
+# Retransmission of the requests that other VASPs did not answer in time.
+
+import asyncio
+import heapq
+import logging
+import random
+import time
+from itertools import count
+
+logger = logging.getLogger(name='libra_off_chain_api.retransmit')
+
+
+class RetransmitScheduler:
+    ''' Retransmits the requests sent to other VASPs that are not answered
+    by their deadline. The deadline of a request is ``timeout`` seconds
+    after it is sequenced, or after the last exchange that sent it ended
+    without a response to it (eg. with ``wait`` or a network error). The
+    timeout doubles after each retransmit, up to ``max_timeout``, plus a
+    random jitter of up to ``jitter`` times the timeout, so that the
+    requests to a VASP that recovers are not all retransmitted at once.
+    Requests being sent (see ``sending``) are not retransmitted, so that
+    slow responses under load do not cause more load.
+
+    Deadlines are kept in a heap, and the scheduler sleeps until the
+    earliest one, so it only wakes up for requests that are due, and only
+    touches the channels that have any. A request answered before its
+    deadline is dropped when the deadline expires.
+
+    Once started, requests without a response (eg. from before a restart)
+    are retransmitted at once, for the open channels and the channels
+    opened later (see ``attach``).
+
+    Parameters:
+        * net : the Aionet network that retransmits the requests (see
+          ``Aionet.retransmit``).
+        * timeout : the time (seconds) before the first retransmit.
+        * max_timeout : the max time (seconds) between retransmits.
+        * jitter : the max jitter, as a fraction of the timeout.
+    '''
+
+    def __init__(self, net, timeout=1.0, max_timeout=60.0, jitter=0.1):
+        self.net = net
+        self.timeout = timeout
+        self.max_timeout = max_timeout
+        self.jitter = jitter
+
+        # A heap of (deadline, sequence, other address, cid), and the
+        # current deadline of each (other address, cid). Heap entries with
+        # another deadline are stale.
+        self.deadlines = []
+        self.deadline_of = {}
+        self.sequence = count()
+
+        # The number of retransmits of each request, and of all requests
+        # to each VASP.
+        self.attempts = {}
+        self.retransmits = {}
+
+        # The channels attached, by the address of the other VASP, and the
+        # number of exchanges sending each (other address, cid).
+        self.channels = {}
+        self.in_flight = {}
+
+        # Set when running, to wake up the scheduler for earlier deadlines.
+        self.wakeup = None
+        self.tasks = set()
+
+    def is_running(self):
+        return self.wakeup is not None
+
+    def delay(self, attempts):
+        ''' Returns the time (seconds) until the deadline of a request
+            retransmitted ``attempts`` times. '''
+        timeout = min(self.max_timeout, self.timeout * 2 ** attempts)
+        return timeout + random.uniform(0, self.jitter * timeout)
+
+    def attach(self, channel, now=None):
+        ''' Schedules the requests without a response of a channel to be
+            retransmitted at once, the first time it is seen. '''
+        if not self.is_running():
+            return
+        key = channel.other_address_str
+        if key in self.channels:
+            return
+        self.channels[key] = channel
+        for cid in channel.pending_response.keys():
+            self.schedule(channel, cid, now, delay=0.0)
+
+    def schedule(self, channel, cid, now=None, delay=None):
+        ''' Sets the deadline of the request with the cid on the channel,
+            by default after the timeout for the retransmits it had. '''
+        if not self.is_running():
+            return
+        now = time.monotonic() if now is None else now
+        key = channel.other_address_str
+        self.channels[key] = channel
+        attempts = self.attempts.setdefault((key, cid), 0)
+        if delay is None:
+            delay = self.delay(attempts)
+
+        deadline = now + delay
+        self.deadline_of[(key, cid)] = deadline
+        heapq.heappush(
+            self.deadlines, (deadline, next(self.sequence), key, cid))
+        if self.deadlines[0][0] == deadline:
+            self.wakeup.set()
+
+    def sending(self, channel, cids):
+        ''' Records that the requests with the cids are being sent. '''
+        if not self.is_running():
+            return
+        key = channel.other_address_str
+        for cid in cids:
+            self.in_flight[(key, cid)] = self.in_flight.get((key, cid), 0) + 1
+
+    def sent(self, channel, cids, now=None):
+        ''' Records that an exchange sending the requests with the cids
+            ended, and sets their deadline from now. '''
+        if not self.is_running():
+            return
+        key = channel.other_address_str
+        for cid in cids:
+            number = self.in_flight.pop((key, cid), 0) - 1
+            if number > 0:
+                self.in_flight[(key, cid)] = number
+            self.schedule(channel, cid, now)
+
+    def pop_due(self, now=None):
+        ''' Returns the requests that are due and still without a
+            response, as a dict from channels to lists of requests, and
+            sets their next deadline. '''
+        now = time.monotonic() if now is None else now
+        due = {}
+        while self.deadlines and self.deadlines[0][0] <= now:
+            deadline, _, key, cid = heapq.heappop(self.deadlines)
+            if self.deadline_of.get((key, cid)) != deadline:
+                continue
+
+            channel = self.channels[key]
+            if cid not in channel.pending_response:
+                del self.deadline_of[(key, cid)]
+                del self.attempts[(key, cid)]
+                continue
+
+            # Wait for the exchange sending the request to end.
+            if (key, cid) in self.in_flight:
+                self.schedule(channel, cid, now)
+                continue
+
+            self.attempts[(key, cid)] += 1
+            self.retransmits[key] = self.retransmits.get(key, 0) + 1
+            due.setdefault(channel, []).append(channel.my_request_index[cid])
+            self.schedule(channel, cid, now)
+        return due
+
+    def next_deadline(self):
+        ''' The time of the earliest deadline, or None. '''
+        return self.deadlines[0][0] if self.deadlines else None
+
+    async def run(self):
+        ''' Retransmits the requests that are due, until cancelled. '''
+        logger.info('Start Retransmit Scheduler.')
+        self.wakeup = asyncio.Event()
+        for channel in list(self.net.vasp.channel_store.values()):
+            self.attach(channel)
+
+        try:
+            while True:
+                for channel, requests in self.pop_due().items():
+                    logger.info(
+                        f'Retransmit {len(requests)} requests to '
+                        f'{channel.other_address_str}.'
+                    )
+                    task = asyncio.ensure_future(
+                        self.net.retransmit(channel, requests))
+                    self.tasks.add(task)
+                    task.add_done_callback(self.tasks.discard)
+
+                self.wakeup.clear()
+                deadline = self.next_deadline()
+                timeout = None if deadline is None \
+                    else max(0.0, deadline - time.monotonic())
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+        except asyncio.CancelledError:
+            pass
+        finally:
+            self.wakeup = None
+            self.channels = {}
+            self.deadlines = []
+            self.deadline_of = {}
+            self.attempts = {}
+            self.in_flight = {}
+            for task in list(self.tasks):
+                task.cancel()
+            logger.info('Stop Retransmit Scheduler.')
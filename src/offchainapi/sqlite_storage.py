@@ -0,0 +1,156 @@
+# Copyright (c) The Libra Core Contributors
+# SPDX-License-Identifier: Apache-2.0
+
+# A durable SQLite backend for the storage subsystem.
+
+import os
+import sqlite3
+from threading import RLock
+
+from .storage import prefix_upper_bound
+
+
+# The value of the auto_vacuum pragma for incremental auto vacuum.
+AUTO_VACUUM_INCREMENTAL = 2
+
+
+class SQLiteStorage:
+    ''' A durable key-value store backed by an SQLite database in WAL mode,
+    that can be passed to a ``StorableFactory`` (or to ``core.Vasp``) as
+    its ``db``.
+
+    It supports the dictionary interface, where every individual write is
+    committed on its own, as well as ``write_batch`` that the
+    ``StorableFactory`` uses to commit a full transaction as a single
+    database transaction. Since SQLite transactions are atomic and durable
+    the factory does not need to keep a recovery backup of old values.
+
+    Parameters:
+        * path : the file name of the database (or ``':memory:'``).
+        * synchronous : the SQLite ``synchronous`` pragma. With the default
+          ``'FULL'`` every commit is flushed to disk before it returns.
+    '''
+
+    def __init__(self, path, synchronous='FULL'):
+        self.path = str(path)
+        self.lock = RLock()
+        self.conn = sqlite3.connect(
+            self.path, isolation_level=None, check_same_thread=False)
+
+        with self.lock:
+            # Only applies to new databases (see compact), and must be set
+            # before the journal mode writes the database header.
+            self.conn.execute('PRAGMA auto_vacuum=INCREMENTAL')
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute(f'PRAGMA synchronous={synchronous}')
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS kv ('
+                'k PRIMARY KEY, v NOT NULL) WITHOUT ROWID')
+
+    def __getitem__(self, key):
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT v FROM kv WHERE k = ?', (key,)).fetchone()
+        if row is None:
+            raise KeyError(key)
+        return row[0]
+
+    def __setitem__(self, key, value):
+        with self.lock:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO kv (k, v) VALUES (?, ?)',
+                (key, value))
+
+    def __delitem__(self, key):
+        with self.lock:
+            cursor = self.conn.execute('DELETE FROM kv WHERE k = ?', (key,))
+        if cursor.rowcount == 0:
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT 1 FROM kv WHERE k = ?', (key,)).fetchone()
+        return row is not None
+
+    def __len__(self):
+        with self.lock:
+            return self.conn.execute('SELECT COUNT(*) FROM kv').fetchone()[0]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def keys(self):
+        ''' Returns a list of all keys in the store. '''
+        with self.lock:
+            return [row[0] for row in self.conn.execute('SELECT k FROM kv')]
+
+    def scan_prefix(self, prefix):
+        ''' Returns a list of all (key, value) pairs with keys starting
+            with ``prefix``, in key order, using a single range query. '''
+        upper = prefix_upper_bound(prefix)
+        with self.lock:
+            if upper is None:
+                cursor = self.conn.execute(
+                    'SELECT k, v FROM kv WHERE k >= ? ORDER BY k',
+                    (prefix,))
+            else:
+                cursor = self.conn.execute(
+                    'SELECT k, v FROM kv WHERE k >= ? AND k < ? ORDER BY k',
+                    (prefix, upper))
+            return cursor.fetchall()
+
+    def set_sync(self, sync):
+        ''' Sets whether commits are flushed to disk before they return
+            (``synchronous`` FULL), or left to the OS (OFF). '''
+        with self.lock:
+            self.conn.execute(
+                f'PRAGMA synchronous={"FULL" if sync else "OFF"}')
+
+    def write_batch(self, writes, deletes):
+        ''' Atomically writes all key-values in the dict ``writes`` and
+            removes all keys in ``deletes`` within a single database
+            transaction. Either all changes are persisted or none. '''
+        with self.lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                self.conn.executemany(
+                    'INSERT OR REPLACE INTO kv (k, v) VALUES (?, ?)',
+                    writes.items())
+                self.conn.executemany(
+                    'DELETE FROM kv WHERE k = ?',
+                    ((key,) for key in deletes))
+                self.conn.execute('COMMIT')
+            except BaseException:
+                self.conn.execute('ROLLBACK')
+                raise
+
+    def file_size(self):
+        ''' Returns the size (bytes) of the database and WAL files. '''
+        if self.path == ':memory:':
+            return 0
+        return sum(os.path.getsize(path)
+                   for path in (self.path, self.path + '-wal')
+                   if os.path.exists(path))
+
+    def compact(self):
+        ''' Returns the free pages of the database to the file system, and
+            truncates the WAL. Returns the number of bytes reclaimed.
+            Databases without incremental auto vacuum (eg. created before
+            this class used it) are converted once, by a full VACUUM. '''
+        with self.lock:
+            before = self.file_size()
+            mode = self.conn.execute('PRAGMA auto_vacuum').fetchone()[0]
+            if mode != AUTO_VACUUM_INCREMENTAL:
+                self.conn.execute('PRAGMA auto_vacuum=INCREMENTAL')
+                self.conn.execute('VACUUM')
+            else:
+                # Each step frees one page, and a script runs all of them.
+                self.conn.executescript('PRAGMA incremental_vacuum;')
+            self.conn.execute('PRAGMA wal_checkpoint(TRUNCATE)').fetchall()
+            return before - self.file_size()
+
+    def close(self):
+        ''' Closes the underlying database connection. '''
+        with self.lock:
+            self.conn.close()
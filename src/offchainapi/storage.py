@@ -4,9 +4,27 @@
 # The main storage interface.
 
 import json
-from threading import RLock
+import re
+import pickle
+import hashlib
+import copy
+from itertools import chain
+from collections import OrderedDict
+from threading import Condition, Lock, Timer, get_ident
+from concurrent.futures import Future, ThreadPoolExecutor
+import asyncio
+from contextvars import ContextVar
+from enum import Enum
+import time
+import logging
 
 from .utils import JSONFlag, JSONSerializable, get_unique_string
+from .storage_stats import TransactionStats, OTHER, READS, DB_READS, \
+    WRITES, DELETES, BYTES_ENCODED, BYTES_DECODED, BLOOM_NEGATIVES, \
+    BLOOM_FALSE_POSITIVES, false_positive_rate
+from .bloom import BloomFilter
+
+logger = logging.getLogger(name='libra_off_chain_api.storage')
 
 
 def key_join(strs):
@@ -15,6 +33,115 @@ def key_join(strs):
     return '||'.join([f'[{len(s)}:{s}]' for s in strs])
 
 
+def prefix_upper_bound(prefix):
+    ''' Returns the smallest key larger than all keys starting with
+        ``prefix`` (a str or bytes), or None if there is no such key. '''
+    if isinstance(prefix, bytes):
+        prefix = prefix.rstrip(b'\xff')
+        if not prefix:
+            return None
+        return prefix[:-1] + bytes([prefix[-1] + 1])
+    prefix = prefix.rstrip(chr(0x10ffff))
+    if not prefix:
+        return None
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+def json_diff(old, new):
+    ''' Returns the changes from the JSON dict ``old`` to ``new``, as a
+        dict with the fields set ('s'), removed ('r') and, for fields
+        that are dicts in both, the diff of their values ('d'). '''
+    diff = {}
+    for field, value in new.items():
+        if field not in old:
+            diff.setdefault('s', {})[field] = value
+            continue
+        old_value = old[field]
+        if old_value == value:
+            continue
+        if isinstance(old_value, dict) and isinstance(value, dict):
+            diff.setdefault('d', {})[field] = json_diff(old_value, value)
+        else:
+            diff.setdefault('s', {})[field] = value
+    removed = [field for field in old if field not in new]
+    if removed:
+        diff['r'] = removed
+    return diff
+
+
+def json_patch(old, diff):
+    ''' Returns the JSON dict ``old`` with the changes of a ``json_diff``.
+        The result shares the unchanged parts of ``old``. '''
+    new = dict(old)
+    for field, value in diff.get('s', {}).items():
+        new[field] = value
+    for field, field_diff in diff.get('d', {}).items():
+        new[field] = json_patch(old[field], field_diff)
+    for field in diff.get('r', ()):
+        del new[field]
+    return new
+
+
+def can_scan(db):
+    ''' Returns True if the db supports ordered prefix scans
+        through ``scan_prefix``. '''
+    if isinstance(db, StorableFactory):
+        return db.can_scan()
+    return hasattr(db, 'scan_prefix')
+
+
+def track_hot(db, prefix, probe=None):
+    ''' Asks the db, if it is a ``StorableFactory`` with checkpoints, to
+        keep in memory all keys starting with the key ``prefix`` (see
+        ``StorableFactory.track_hot``). '''
+    if isinstance(db, StorableFactory):
+        db.track_hot(prefix, probe)
+
+
+def register_container(db, prefix, name):
+    ''' Tells the db, if it is a ``StorableFactory`` that records
+        statistics, that keys under ``prefix`` belong to the container
+        ``name`` (see ``StorableFactory.container_of``). '''
+    if isinstance(db, StorableFactory) and db.root.stats is not None:
+        db.root.container_labels[prefix] = name
+
+
+def in_snapshot(db):
+    ''' Returns True if reads through the db, if it is a
+        ``StorableFactory``, go to a snapshot in the current context. '''
+    return isinstance(db, StorableFactory) and bool(db.root.snapshots) \
+        and db.active_snapshot() is not None
+
+
+def container_prefix(db, base_key, probes):
+    ''' Returns the prefix of the keys of a container with the path
+        ``base_key``: the key_join of the path, or the short prefix
+        interned for it if the db is a ``StorableFactory`` with compact
+        keys (see ``StorableFactory.intern_prefix``). ``probes`` are the
+        parts of keys that exist under the prefix if the container has
+        been written to. '''
+    path = key_join(base_key)
+    if isinstance(db, StorableFactory):
+        probe_keys = [f'{path}||{key_join(probe)}' for probe in probes]
+        return db.root.intern_prefix(path, probe_keys)
+    return path
+
+
+class Durability(Enum):
+    ''' The durability policy of a ``StorableFactory``:
+
+        * SYNC : each transaction is synced to disk before it exits.
+        * GROUP : transactions are grouped within the group commit window,
+          and each group is synced to disk as it is written.
+        * NONE : transactions are written as they exit but never synced,
+          so that a crash of the machine may lose the latest ones. For
+          benchmarks and test networks.
+    '''
+    SYNC = 'sync'
+    GROUP = 'group'
+    NONE = 'none'
+
+
 class Storable:
     """Base class for objects that can be stored.
 
@@ -26,14 +153,25 @@ class Storable:
         self.xtype = xtype
         self.factory = None
 
+    def key(self, *parts):
+        ''' Returns the storage key of the given parts under this object,
+            or of the object itself without parts. '''
+        if not parts:
+            return self.prefix
+        return f'{self.prefix}||{key_join(parts)}'
+
     def pre_proc(self, val):
         """ Pre-processing of objects before storage. By default
             it calls get_json_data_dict for JSONSerializable objects or
             their base type. eg int('10'). The result must be a structure
-            that can be passed to json.dumps.
+            that can be passed to json.dumps. Blob fields are replaced
+            by references (see ``StorableFactory.intern_blobs``).
         """
         if issubclass(self.xtype, JSONSerializable):
-            return val.get_json_data_dict(JSONFlag.STORE)
+            data = val.get_json_data_dict(JSONFlag.STORE)
+            if isinstance(self.db, StorableFactory) and self.db.root.blob_fields:
+                data = self.db.root.intern_blobs(data)
+            return data
         else:
             return self.xtype(val)
 
@@ -43,11 +181,102 @@ class Storable:
             the type constructor.
         """
         if issubclass(self.xtype, JSONSerializable):
+            if isinstance(self.db, StorableFactory) and self.db.root.blob_fields:
+                val = self.db.root.resolve_blobs(val)
             return self.xtype.parse(val, JSONFlag.STORE)
         else:
             return self.xtype(val)
 
 
+class TransactionLock:
+    ''' The reentrant lock of the transactions of a ``StorableFactory``. It
+    is held by a thread or, within an asyncio task, by the task, so that
+    each task has its own transactions. Threads wait for the lock with
+    ``acquire``, and tasks with ``await acquire_async()``. A thread cannot
+    wait for the lock while another task on the same thread holds it, so
+    ``acquire`` raises RuntimeError instead.
+    '''
+
+    def __init__(self):
+        self.condition = Condition()
+        self.owner = None
+        self.owner_thread = None
+        self.count = 0
+
+        # The futures, and their loops, of the tasks waiting for the lock.
+        self.waiters = []
+
+    @staticmethod
+    def _current_owner():
+        try:
+            task = asyncio.current_task()
+        except RuntimeError:
+            task = None
+        return get_ident() if task is None else task
+
+    def is_owned(self):
+        ''' Returns True if the lock is held by the current task or
+            thread. '''
+        owner = self.owner
+        if owner is None or self.owner_thread != get_ident():
+            return False
+        if isinstance(owner, int):
+            return True
+        try:
+            return asyncio.current_task() is owner
+        except RuntimeError:
+            return False
+
+    def acquire(self):
+        with self.condition:
+            while self.owner is not None and not self.is_owned():
+                if self.owner_thread == get_ident():
+                    raise RuntimeError(
+                        'The transaction is held by another task on this '
+                        'thread (see StorableFactory.atomic_writes_async).')
+                self.condition.wait()
+            self._take()
+
+    async def acquire_async(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            with self.condition:
+                if self.owner is None or self.is_owned():
+                    self._take()
+                    return
+                waiter = loop.create_future()
+                self.waiters += [(loop, waiter)]
+            await waiter
+
+    def _take(self):
+        # Called with the condition held.
+        if self.owner is None:
+            self.owner = self._current_owner()
+            self.owner_thread = get_ident()
+        self.count += 1
+
+    def release(self):
+        with self.condition:
+            if not self.is_owned():
+                raise RuntimeError('The transaction lock is not held.')
+            self.count -= 1
+            if self.count > 0:
+                return
+            self.owner = None
+            self.owner_thread = None
+            waiters, self.waiters = self.waiters, []
+            self.condition.notify_all()
+
+        # Waiting tasks try to take the lock again once woken.
+        for loop, waiter in waiters:
+            loop.call_soon_threadsafe(_wake_waiter, waiter)
+
+
+def _wake_waiter(waiter):
+    if not waiter.done():
+        waiter.set_result(True)
+
+
 class StorableFactory:
     ''' This class maintains an overview of the full storage subsystem,
     and creates specific classes for values, lists and dictionary like
@@ -58,22 +287,193 @@ class StorableFactory:
     Initialize the ``StorableFactory`` with a persistent key-value
     store ``db``. In case the db already contains data the initializer
     runs the crash recovery procedure to cleanly re-open it.
+
+    Each thread, or asyncio task, has its own transactions, and waits for
+    those of others to complete (see ``TransactionLock``). Reads outside
+    a transaction see the committed state. Coroutines should not await
+    other work (eg. the network) within a transaction, since other tasks
+    wait for it, and synchronous transactions on the same thread fail.
+
+    If the ``db`` supports native transactions through a
+    ``write_batch(writes, deletes)`` method (see ``SQLiteStorage``) the
+    outermost transaction is committed as a single backend transaction,
+    otherwise a backup of the old values is used to recover from crashes.
+
+    By default each outermost transaction is written to the ``db`` as it
+    completes. Setting ``group_commit_window`` (seconds) enables group
+    commit: completed transactions are kept in memory (and are visible to
+    reads) and are written to the ``db`` together, once the window since
+    the first of them expires or ``group_commit_size`` transactions are
+    waiting. Callers that need durability can wait on ``durable()`` or
+    ``await wait_durable()`` once their transaction exits.
+
+    A ``durability`` policy (see ``Durability``) sets how commits reach the
+    disk: it enables group commit for ``Durability.GROUP`` (with a window of
+    ``DEFAULT_GROUP_COMMIT_WINDOW`` unless one is given) and disables it
+    otherwise, and turns the syncing of the db on or off. Backends are
+    synced through their ``set_sync(flag)`` method if they have one (see
+    ``SQLiteStorage`` and ``LogStorage``), and otherwise by calling their
+    ``sync()`` method (eg. dbm), if any, around the crash recovery backup.
+    Without a policy, durability is left to the db.
+
+    Dictionaries made with ``make_dict(..., cached=True)`` keep an LRU cache
+    of up to ``cache_size`` decoded values (see ``StorableDict``). With
+    ``bloom_filters`` set, those made with ``make_dict(..., bloom=True)``
+    keep a Bloom filter of their keys, that answers most membership tests
+    of absent keys without reading the db.
+
+    Independent parts of the system (eg. each channel) can get their own
+    partition of the factory through ``partition(name)``, with its own
+    transactions (see ``StoragePartition``).
+
+    With a ``checkpoint_interval`` larger than zero the factory keeps the
+    hot state of the system in memory: the metadata (eg. lengths) of all
+    storable objects, and all entries of those made with ``hot=True``.
+    Commits that change the hot state also record the changes in a
+    journal, and every ``checkpoint_interval`` journal entries (or when
+    ``checkpoint()`` is called) a compact snapshot of the hot state
+    replaces the journal. On startup the factory loads the snapshot and
+    replays the journal entries written after it, instead of reading the
+    hot state key by key.
+
+    Keys are formed from the path of each object (the names of its roots
+    and its own, see ``key_join``), that for containers include the
+    addresses of VASPs. With ``compact_keys`` the factory instead interns
+    the path of each new container to a short prefix (eg. ``#12``), and
+    records it in the db, so that keys are much shorter. Containers that
+    already hold data under their full path keep using it, so existing
+    databases remain readable. Once used, compact keys are enabled
+    whenever the db is opened.
+
+    Given a ``stats`` sink (see ``storage_stats.StorageStatsSink``, eg. a
+    ``StorageStatsAggregator``) the factory counts the reads, backend
+    reads, writes, deletes and bytes of values of each transaction, per
+    container (eg. ``object_locks``), and times its commit. The stats of
+    each transaction are passed to the sink as it commits. Without a sink
+    nothing is counted.
+
+    Readers that must not see transactions in progress, nor wait for them
+    (eg. API or reporting threads) can read from a ``snapshot()`` of the
+    committed state (see ``StorageSnapshot``).
+
+    Large, write-once parts of stored objects, that many versions of an
+    object share (eg. the KYC data of payments), can be stored once. The
+    ``blob_fields`` are the names of fields that, wherever they appear in
+    the JSON of a stored object, hold such a part. Their values are then
+    stored as blobs keyed by the hash of their content, and the objects
+    only hold references to them (see ``intern_blobs``). The blob fields
+    are recorded in the db, and stay in use whenever it is opened. Blobs
+    that no stored value refers to are deleted by ``collect_blobs``.
     '''
 
-    def __init__(self, db):
-        self.rlock = RLock()
+    def __init__(self, db, group_commit_window=0.0, group_commit_size=100,
+                 cache_size=0, checkpoint_interval=0, compact_keys=False,
+                 stats=None, blob_fields=(), bloom_filters=False,
+                 durability=None):
+        self.transaction_lock = TransactionLock()
         self.db = db
+        self.root = self
+        self.cache_size = cache_size
+        self.bloom_filters = bloom_filters
         self.current_transaction = None
         self.levels = 0
 
+        # The other factories whose locks the transaction holds.
+        self.held = []
+
         # Transaction cache: keep data in memory
         # until the transaction completes.
         self.cache = {}
         self.del_cache = set()
 
+        # Partitions by name, that share this factory's commits.
+        self.partitions = {}
+
+        # Statistics: the sink, the names of containers by key prefix, and
+        # the stats of the transaction in progress, and of operations made
+        # outside transactions.
+        self.stats = stats
+        self.container_labels = {}
+        self.transaction_stats = None
+        self.outside_stats = TransactionStats()
+
+        # The open snapshots, replaced (not changed) under the commit lock.
+        self.snapshots = []
+
+        # Serializes the commits of the factory and its partitions, and
+        # guards the group commit state below.
+        self.commit_lock = Lock()
+
+        # Durability: whether writes to a db without native transactions
+        # are synced around the crash recovery backup.
+        self.durability = durability
+        self.sync_writes = False
+        if durability is not None:
+            if durability == Durability.GROUP:
+                group_commit_window = \
+                    group_commit_window or DEFAULT_GROUP_COMMIT_WINDOW
+            else:
+                group_commit_window = 0.0
+            sync = durability != Durability.NONE
+            if hasattr(db, 'set_sync'):
+                db.set_sync(sync)
+            else:
+                self.sync_writes = sync and hasattr(db, 'sync')
+
+        # Group commit: completed transactions that are not yet written
+        # to the db. Maps keys to values, or _DELETED for deleted keys.
+        self.group_commit_window = group_commit_window
+        self.group_commit_size = group_commit_size
+        self.pending = {}
+        self.pending_transactions = 0
+        self.pending_future = Future()
+        self.flush_timer = None
+
+        # The group being written to the db by a flush, which remains
+        # visible to reads until the write completes. The io_lock
+        # ensures that flushes happen one at a time, and in order.
+        self.flushing = {}
+        self.io_lock = Lock()
+
+        # A future resolved when the last transaction is durable.
+        self.last_commit_future = Future()
+        self.last_commit_future.set_result(True)
+
         # Check and fix the database, if this is needed
         self.crash_recovery()
 
+        # The hot state: committed values of hot keys, that are keys
+        # equal to, or under, the key prefixes tracked.
+        self.checkpoint_interval = checkpoint_interval
+        self.hot_items = {}
+        self.hot_prefixes = set()
+        self.new_hot_prefixes = []
+        self.snapshot_seq = 0
+        self.journal_seq = 0
+        self.checkpoint_requested = False
+        if checkpoint_interval > 0:
+            self.load_checkpoint()
+
+        # Compact keys: the short prefixes interned for container paths.
+        self.prefix_ids = {}
+        self.prefix_lock = Lock()
+        self.compact_keys = compact_keys \
+            or self.contains_committed(PREFIX_NEXT_KEY)
+        if self.compact_keys:
+            self.track_hot(key_join(['__PREFIX']), PREFIX_NEXT_KEY)
+
+        # Blobs: the blob fields, an LRU cache of the JSON of blobs known
+        # to be committed, by hash, an LRU cache of the hashes of blob
+        # values, by their JSON with unsorted keys, and the hashes of the
+        # blobs used since the last sweep started (see ``collect_blobs``).
+        self.blob_fields = frozenset()
+        self.blob_cache = OrderedDict()
+        self.blob_digests = OrderedDict()
+        self.blob_uses = set()
+        self.blob_lock = Lock()
+        self.set_blob_fields(blob_fields)
+        register_container(self, key_join([BLOB_PREFIX]), 'blobs')
+
     def make_value(self, name, xtype, root=None, default=None):
         ''' Makes a new value-like storable.
 
@@ -91,6 +491,35 @@ class StorableFactory:
         v.factory = self
         return v
 
+    def make_log_dict(self, name, xtype, root, cached=False, hot=False,
+                      delta_interval=0, bloom=False):
+        ''' A new append-only map-like storable object, for maps where keys
+            are written once (see ``StorableLogDict``). Any data stored in a
+            dictionary made by ``make_dict`` with the same name and root is
+            migrated to the new format.
+
+            Parameters:
+                * name : a string representing the name of the object.
+                * xtype : the type of the object stored in the map.
+                * root : another storable object that acts as a logical
+                  folder to this one.
+                * cached : whether to keep a cache of decoded values of
+                  the factory ``cache_size``.
+                * hot : whether to keep all entries in memory, and in
+                  checkpoints.
+                * delta_interval : the max length of the chains of values
+                  stored as deltas (see ``StorableDict``), or 0.
+                * bloom : whether to keep a Bloom filter of the keys, if
+                  the factory has ``bloom_filters``.
+        '''
+        cache_size = self.cache_size if cached else 0
+        v = StorableLogDict(
+            self, name, xtype, root, cache_size=cache_size, hot=hot,
+            delta_interval=delta_interval, bloom=bloom and self.bloom_filters)
+        v.factory = self
+        v.migrate()
+        return v
+
     def make_list(self, name, xtype, root):
         ''' Makes a new list-like storable. The type of the objects
             stored is xtype, or any subclass of JSONSerializable.
@@ -107,7 +536,8 @@ class StorableFactory:
         v.factory = self
         return v
 
-    def make_dict(self, name, xtype, root):
+    def make_dict(self, name, xtype, root, cached=False, hot=False,
+                  delta_interval=0, bloom=False):
         ''' A new map-like storable object.
 
             Parameters:
@@ -117,60 +547,290 @@ class StorableFactory:
                   JSONSerializable. The keys are always strings.
                 * root : another storable object that acts as a logical
                   folder to this one.
+                * cached : whether to keep a cache of decoded values of
+                  the factory ``cache_size``.
+                * hot : whether to keep all entries in memory, and in
+                  checkpoints.
+                * delta_interval : the max length of the chains of values
+                  stored as deltas (see ``StorableDict``), or 0.
+                * bloom : whether to keep a Bloom filter of the keys, if
+                  the factory has ``bloom_filters``.
 
         '''
-        v = StorableDict(self, name, xtype, root)
+        cache_size = self.cache_size if cached else 0
+        v = StorableDict(
+            self, name, xtype, root, cache_size=cache_size, hot=hot,
+            delta_interval=delta_interval, bloom=bloom and self.bloom_filters)
         v.factory = self
         return v
 
+    def partition(self, name):
+        ''' Returns the partition of this factory with the given name,
+            creating it if needed (see ``StoragePartition``). '''
+        with self.commit_lock:
+            if name not in self.partitions:
+                self.partitions[name] = StoragePartition(self, name)
+            return self.partitions[name]
+
+    def transaction_owner(self):
+        ''' Returns the factory (this one, or a partition of the same
+            root factory) whose transaction the operations of the current
+            thread or task join. This is the factory of the outermost
+            transaction that the current thread or task holds, or this
+            factory if there is none. '''
+        if not self.root.partitions:
+            return self
+        context = _transaction_context.get()
+        if context is not None:
+            owner, transaction = context
+            if owner is not self and owner.root is self.root \
+                    and owner.current_transaction == transaction \
+                    and owner.transaction_lock.is_owned():
+                return owner
+        return self
+
+    def open_transaction(self, write=False):
+        ''' Returns the factory whose transaction the operations made
+            through this factory in the current thread or task join, or
+            None if there is none, in which case reads see the committed
+            state and writes raise RuntimeError. A transaction of another
+            factory that uses the objects of this one holds the lock of
+            this one until it completes (see ``hold``). '''
+        owner = self.transaction_owner()
+        if owner is self:
+            if self.levels > 0 and self.transaction_lock.is_owned():
+                return self
+        elif write or owner.can_hold(self):
+            owner.hold(self)
+            return owner
+        if write:
+            raise RuntimeError(
+                'Writes must happen within a transaction context')
+        return None
+
+    def can_hold(self, factory):
+        ''' Returns True if the transactions of this factory may use the
+            objects of ``factory``. Only the partitions may use those of
+            the root factory, so that locks are always taken in the same
+            order. '''
+        return factory is self.root and self is not factory
+
+    def hold(self, factory):
+        ''' Takes the transaction lock of ``factory``, if needed, until
+            the transaction of this factory completes. '''
+        if factory not in self.held:
+            self._check_hold(factory)
+            factory.transaction_lock.acquire()
+            self.held += [factory]
+
+    async def hold_async(self, factory):
+        ''' Like ``hold``, but waits for the lock without blocking the
+            event loop. '''
+        if factory not in self.held:
+            self._check_hold(factory)
+            await factory.transaction_lock.acquire_async()
+            self.held += [factory]
+
+    def _check_hold(self, factory):
+        if not self.can_hold(factory):
+            raise RuntimeError(
+                'The transaction cannot use the objects of another '
+                'partition: open the transaction of their partition first.')
+
     # Define central interfaces as a dictionary structure
     # (with no keys or value enumeration)
 
     def __getitem__(self, key):
+        if self.root.snapshots:
+            snapshot = self.active_snapshot()
+            if snapshot is not None:
+                return snapshot[key]
+
+        owner = self.open_transaction()
+        read = self.get_committed if owner is None else owner.get_item
+        if self.root.stats is None:
+            return read(key)
+
+        stats = (owner or self).operation_stats()
+        container = self.root.container_of(key)
+        stats.add(container, READS)
+        value = read(key)
+        stats.add(container, BYTES_DECODED, len(value))
+        return value
+
+    def get_item(self, key):
         # First look into the cache
         if key in self.del_cache:
             raise KeyError('The key is to be deleted.')
         if key in self.cache:
             return self.cache[key]
+        return self.get_committed(key)
+
+    def get_committed(self, key):
+        if self.checkpoint_interval > 0 and self.is_hot(key):
+            if key in self.hot_items:
+                return self.hot_items[key]
+            raise KeyError(key)
+        if key in self.pending:
+            value = self.pending[key]
+            if value is _DELETED:
+                raise KeyError('The key is deleted.')
+            return value
+        if key in self.flushing:
+            value = self.flushing[key]
+            if value is _DELETED:
+                raise KeyError('The key is deleted.')
+            return value
+        if self.stats is not None:
+            self.count_db_read(key)
         return self.db[key]
 
     def __setitem__(self, key, value):
         # Ensure all writes are within a transaction.
-        if self.current_transaction is None:
-            raise RuntimeError(
-                'Writes must happen within a transaction context')
-        self.cache[key] = value
-        if key in self.del_cache:
-            self.del_cache.remove(key)
+        owner = self.open_transaction(write=True)
+        if self.root.snapshots and self.active_snapshot() is not None:
+            raise RuntimeError('Snapshots are read-only.')
+        owner.cache[key] = value
+        if key in owner.del_cache:
+            owner.del_cache.remove(key)
 
     def __contains__(self, item):
+        if self.root.snapshots:
+            snapshot = self.active_snapshot()
+            if snapshot is not None:
+                return item in snapshot
+
+        owner = self.open_transaction()
+        if self.root.stats is not None:
+            (owner or self).operation_stats().add(
+                self.root.container_of(item), READS)
+        if owner is None:
+            return self.contains_committed(item)
+        return owner.contains(item)
+
+    def contains(self, item):
         if item in self.del_cache:
             return False
         if item in self.cache:
             return True
+        return self.contains_committed(item)
+
+    def contains_committed(self, item):
+        if self.checkpoint_interval > 0 and self.is_hot(item):
+            return item in self.hot_items
+        if item in self.pending:
+            return self.pending[item] is not _DELETED
+        if item in self.flushing:
+            return self.flushing[item] is not _DELETED
+        if self.stats is not None:
+            self.count_db_read(item)
         return item in self.db
 
     def __delitem__(self, key):
-        if self.current_transaction is None:
-            raise RuntimeError(
-                'Writes must happen within a transaction context')
-        if key in self.cache:
-            del self.cache[key]
-        self.del_cache.add(key)
+        owner = self.open_transaction(write=True)
+        if self.root.snapshots and self.active_snapshot() is not None:
+            raise RuntimeError('Snapshots are read-only.')
+        if key in owner.cache:
+            del owner.cache[key]
+        owner.del_cache.add(key)
+
+    def can_scan(self):
+        ''' Returns True if the db supports ordered prefix scans. '''
+        return hasattr(self.db, 'scan_prefix')
+
+    def scan_prefix(self, prefix):
+        ''' Returns a list of all (key, value) pairs with keys starting
+            with ``prefix``, in key order, as seen by the current
+            transaction. The db must support ``scan_prefix``. '''
+        if self.root.snapshots:
+            snapshot = self.active_snapshot()
+            if snapshot is not None:
+                return snapshot.scan_prefix(prefix)
+
+        owner = self.open_transaction()
+        if self.root.stats is None:
+            return self._scan(owner, prefix)
+
+        stats = (owner or self).operation_stats()
+        container = self.root.container_of(prefix)
+        stats.add(container, READS)
+        items = self._scan(owner, prefix)
+        stats.add(container, BYTES_DECODED,
+                  sum(len(value) for _, value in items))
+        return items
+
+    def _scan(self, owner, prefix):
+        if owner is None:
+            return sorted(self.scan_committed(prefix).items())
+        return owner.scan_items(prefix)
+
+    def scan_items(self, prefix):
+        items = self.scan_committed(prefix)
+
+        # Apply the changes of the transaction cache.
+        for key, value in self.cache.items():
+            if key.startswith(prefix):
+                items[key] = value
+        for key in self.del_cache:
+            items.pop(key, None)
+
+        return sorted(items.items())
+
+    def scan_committed(self, prefix):
+        if self.stats is not None:
+            self.count_db_read(prefix)
+        items = dict(self.db.scan_prefix(prefix))
+
+        # Apply the changes of the group commit.
+        for key, value in chain(self.flushing.items(), self.pending.items()):
+            if key.startswith(prefix):
+                if value is _DELETED:
+                    items.pop(key, None)
+                else:
+                    items[key] = value
+        return items
+
+    def is_uncommitted(self, key):
+        ''' Returns True if the key is written or deleted by the
+            current transaction. '''
+        owner = self.open_transaction()
+        return owner is not None and owner.is_uncommitted_in(key)
+
+    def is_uncommitted_in(self, key):
+        ''' Returns True if the key is written or deleted by the
+            transaction of this factory. '''
+        return key in self.cache or key in self.del_cache
 
     def persist_cache(self):
         ''' Safely persist the cache once the transaction is over.
             This is called internally when the context manager exists.
         '''
+        self.write_to_db(self.cache, self.del_cache)
+        self.cache = {}
+        self.del_cache = set()
 
-        from itertools import chain
+    def write_to_db(self, writes, deletes):
+        ''' Safely writes the dict ``writes`` and removes the keys
+            ``deletes`` from the db, as an atomic operation. '''
+
+        # Backends with native transactions (eg. SQLiteStorage) commit
+        # all writes and deletes at once, and need no backup.
+        if hasattr(self.db, 'write_batch'):
+            if len(writes) == 0 and len(deletes) == 0:
+                return
+            self.db.write_batch(writes, deletes)
+            return
 
         # Create a backup of all affected values.
         old_entries = {}
         non_existent_entries = []
-        for key in chain(self.cache.keys(), self.del_cache):
+        for key in chain(writes.keys(), deletes):
             if key in self.db:
-                old_entries[key] = self.db[key]
+                old_value = self.db[key]
+                # Some backends (eg. dbm) return stored strings as bytes.
+                if isinstance(old_value, bytes):
+                    old_value = old_value.decode()
+                old_entries[key] = old_value
             else:
                 non_existent_entries += [key]
 
@@ -179,19 +839,552 @@ class StorableFactory:
 
         backup_data = json.dumps([old_entries, non_existent_entries])
         self.db['__backup_recovery'] = backup_data
-        # TODO: call to flush to disk
+        if self.sync_writes:
+            self.db.sync()
 
         # Write new values to the database
-        for item in self.cache:
-            self.db[item] = self.cache[item]
-        for item in self.del_cache:
+        for item in writes:
+            self.db[item] = writes[item]
+        for item in deletes:
             if item in self.db:
                 del self.db[item]
+        if self.sync_writes:
+            self.db.sync()
 
         # Upon completion of write, clean up
         del self.db['__backup_recovery']
-        self.cache = {}
-        self.del_cache = set()
+        if self.sync_writes:
+            self.db.sync()
+
+    def commit_changes(self, writes, deletes):
+        ''' Commits the writes and deletes of a completed transaction
+            of this factory or one of its partitions, and returns True
+            if the group commit should be flushed. '''
+        with self.commit_lock:
+            if self.snapshots:
+                self.preserve_snapshots(writes, deletes)
+            if self.checkpoint_interval > 0:
+                writes, deletes = self.journal_changes(writes, deletes)
+
+            if self.group_commit_window == 0:
+                self.write_to_db(writes, deletes)
+                return False
+
+            self.stage_changes(writes, deletes)
+            if self.pending_transactions >= self.group_commit_size:
+                return True
+            if self.flush_timer is None:
+                self._schedule_flush()
+            return False
+
+    # Statistics
+
+    def container_of(self, key):
+        ''' Returns the name of the container that the key belongs to: the
+            container registered for the shortest prefix of the key that
+            ends at a ``||`` boundary (or for the whole key), or ``OTHER``. '''
+        labels = self.container_labels
+        i = key.find('||')
+        while i != -1:
+            name = labels.get(key[:i])
+            if name is not None:
+                return name
+            i = key.find('||', i + 2)
+        return labels.get(key, OTHER)
+
+    def operation_stats(self):
+        ''' Returns the stats that operations made through this factory
+            count towards: those of its transaction in progress in the
+            current thread or task, if any, or otherwise those of
+            operations outside transactions. '''
+        stats = self.transaction_stats
+        if stats is not None and self.transaction_lock.is_owned():
+            return stats
+        return self.root.outside_stats
+
+    def count_db_read(self, key):
+        self.transaction_owner().operation_stats().add(
+            self.container_of(key), DB_READS)
+
+    def record_stats(self, stats):
+        ''' Counts the writes and deletes of the transaction of this
+            factory that is about to commit in its ``stats``. '''
+        root = self.root
+        for key, value in self.cache.items():
+            container = root.container_of(key)
+            stats.add(container, WRITES)
+            stats.add(container, BYTES_ENCODED, len(value))
+        for key in self.del_cache:
+            stats.add(root.container_of(key), DELETES)
+
+    def flush_stats(self):
+        ''' Passes the stats of operations made outside transactions since
+            the last call to the sink. '''
+        root = self.root
+        if root.stats is None or not root.outside_stats.containers:
+            return
+        stats, root.outside_stats = root.outside_stats, TransactionStats()
+        root.stats.record_operations(stats)
+
+    # Snapshots
+
+    def snapshot(self):
+        ''' Returns a read-only ``StorageSnapshot`` of the state committed
+            so far, that must be closed (eg. by a ``with`` block) once
+            done with. '''
+        root = self.root
+        with root.commit_lock:
+            snapshot = StorageSnapshot(root)
+            root.snapshots = root.snapshots + [snapshot]
+        return snapshot
+
+    def release_snapshot(self, snapshot):
+        ''' Stops preserving the state of a closed snapshot. '''
+        root = self.root
+        with root.commit_lock:
+            root.snapshots = [s for s in root.snapshots if s is not snapshot]
+
+    def active_snapshot(self):
+        ''' Returns the snapshot of this factory that reads in the current
+            thread or task go to, or None. '''
+        snapshot = _snapshot_context.get()
+        if snapshot is not None and snapshot.root is self.root \
+                and not snapshot.closed:
+            return snapshot
+        return None
+
+    def preserve_snapshots(self, writes, deletes):
+        ''' Copies the committed values of the keys a commit is about to
+            change into the open snapshots that do not have them yet.
+            Called with the commit lock held. '''
+        for key in chain(writes, deletes):
+            snapshots = [snapshot for snapshot in self.snapshots
+                         if key not in snapshot.overlay]
+            if not snapshots:
+                continue
+            try:
+                old_value = self.get_committed(key)
+            except KeyError:
+                old_value = _DELETED
+            for snapshot in snapshots:
+                snapshot.overlay[key] = old_value
+
+    # Blobs
+
+    def set_blob_fields(self, blob_fields):
+        ''' Adds the ``blob_fields`` to those recorded in the db, and
+            uses them all. '''
+        fields = set(blob_fields)
+        if self.contains_committed(BLOB_FIELDS_KEY):
+            stored = self.get_committed(BLOB_FIELDS_KEY)
+            fields |= set(json.loads(stored))
+            if fields == set(json.loads(stored)):
+                self.blob_fields = frozenset(fields)
+                return
+        elif not fields:
+            return
+
+        self.blob_fields = frozenset(fields)
+        writes = {BLOB_FIELDS_KEY: json.dumps(sorted(fields))}
+        if self.commit_changes(writes, set()):
+            self.flush()
+
+    def intern_blobs(self, data):
+        ''' Returns a copy of the JSON structure ``data`` where the (dict)
+            values of blob fields are replaced by references to blobs,
+            that are written in the current transaction unless they are
+            known to be committed. '''
+        if isinstance(data, dict):
+            interned = {}
+            for field, value in data.items():
+                if field in self.blob_fields and isinstance(value, dict):
+                    interned[field] = {BLOB_REF: self.store_blob(value)}
+                else:
+                    interned[field] = self.intern_blobs(value)
+            return interned
+        if isinstance(data, list):
+            return [self.intern_blobs(value) for value in data]
+        return data
+
+    def resolve_blobs(self, data):
+        ''' Returns the JSON structure ``data`` with the references of
+            blob fields replaced by the values of their blobs. '''
+        if isinstance(data, dict):
+            for field, value in data.items():
+                if field in self.blob_fields and isinstance(value, dict) \
+                        and BLOB_REF in value:
+                    data[field] = json.loads(self.load_blob(value[BLOB_REF]))
+                else:
+                    self.resolve_blobs(value)
+        elif isinstance(data, list):
+            for value in data:
+                self.resolve_blobs(value)
+        return data
+
+    def store_blob(self, value):
+        ''' Stores the JSON structure ``value`` as a blob, if needed, and
+            returns the hash of its content. '''
+        # The hash of a value stored again is looked up by its plain JSON,
+        # which is cheaper than the sorted JSON and its hash.
+        text = json.dumps(value)
+        blob = None
+        with self.blob_lock:
+            digest = self.blob_digests.get(text)
+            if digest is not None:
+                self.blob_digests.move_to_end(text)
+        if digest is None:
+            blob = json.dumps(value, sort_keys=True)
+            digest = hashlib.sha256(blob.encode()).hexdigest()
+            with self.blob_lock:
+                self.blob_digests[text] = digest
+                if len(self.blob_digests) > BLOB_CACHE_SIZE:
+                    self.blob_digests.popitem(last=False)
+
+        # Blobs are looked up and marked as used under the blob lock, so
+        # that a sweep either keeps them, or deletes them before.
+        key = key_join([BLOB_PREFIX, digest])
+        with self.blob_lock:
+            self.blob_uses.add(digest)
+            if digest in self.blob_cache:
+                self.blob_cache.move_to_end(digest)
+                return digest
+            committed = self.contains_committed(key)
+            if committed and blob is not None:
+                self._cache_blob(digest, blob)
+
+        # Only blobs already committed are cached, so that a blob is
+        # (re)written by each transaction until one commits it.
+        if not committed:
+            if blob is None:
+                blob = json.dumps(value, sort_keys=True)
+            self[key] = blob
+        return digest
+
+    def load_blob(self, digest):
+        ''' Returns the JSON of the blob with the hash ``digest``. '''
+        with self.blob_lock:
+            if digest in self.blob_cache:
+                self.blob_cache.move_to_end(digest)
+                return self.blob_cache[digest]
+
+        key = key_join([BLOB_PREFIX, digest])
+        blob = self[key]
+        if isinstance(blob, bytes):
+            blob = blob.decode()
+        if not self.is_uncommitted(key):
+            with self.blob_lock:
+                self._cache_blob(digest, blob)
+        return blob
+
+    def _cache_blob(self, digest, blob):
+        # Called with the blob lock held.
+        self.blob_cache[digest] = blob
+        if len(self.blob_cache) > BLOB_CACHE_SIZE:
+            self.blob_cache.popitem(last=False)
+
+    def committed_keys(self):
+        ''' Returns the set of all keys in the db, the group commit and
+            the hot state. Some may be deleted in the committed state. '''
+        keys = {key.decode() if isinstance(key, bytes) else key
+                for key in list(self.db.keys())}
+        with self.commit_lock:
+            keys.update(self.flushing)
+            keys.update(self.pending)
+            keys.update(self.hot_items)
+        return keys
+
+    def collect_blobs(self):
+        ''' Deletes the committed blobs that no committed value refers to,
+            and returns the number of blobs deleted.
+
+            The blobs used by ``store_blob`` since the previous sweep
+            started are kept, since the values that refer to them may not
+            be committed yet. Transactions should thus take much less time
+            than the interval between sweeps. '''
+        if not self.blob_fields:
+            return 0
+        with self.blob_lock:
+            recent, self.blob_uses = self.blob_uses, set()
+
+        # Find the references in all committed values, including deltas.
+        blob_prefix = key_join([BLOB_PREFIX]) + '||'
+        blob_keys = []
+        referenced = set()
+        for key in self.committed_keys():
+            if key.startswith(blob_prefix):
+                blob_keys += [key]
+                continue
+            try:
+                value = self.get_committed(key)
+            except KeyError:
+                continue
+            if isinstance(value, bytes):
+                value = value.decode()
+            referenced.update(BLOB_REF_PATTERN.findall(value))
+
+        deletes = set()
+        with self.blob_lock:
+            used = recent | self.blob_uses
+            for key in blob_keys:
+                digest = key[len(blob_prefix):].split(':', 1)[1][:-1]
+                if digest in referenced or digest in used:
+                    continue
+                if self.contains_committed(key):
+                    deletes.add(key)
+                    self.blob_cache.pop(digest, None)
+            flush = bool(deletes) and self.commit_changes({}, deletes)
+        if flush:
+            self.flush()
+        return len(deletes)
+
+    # Compact keys
+
+    def intern_prefix(self, path, probe_keys=()):
+        ''' Returns the key prefix of the container with the (key_join)
+            ``path``. With compact keys the first call for a path assigns
+            it a short prefix, committed right away on its own, unless
+            one of ``probe_keys`` exists, which indicates that the
+            container already has data under its full path. '''
+        if not self.compact_keys:
+            return path
+
+        with self.prefix_lock:
+            if path in self.prefix_ids:
+                return self.prefix_ids[path]
+
+            prefix_key = key_join(['__PREFIX', path])
+            if self.contains_committed(prefix_key):
+                prefix = self.get_committed(prefix_key)
+                if isinstance(prefix, bytes):
+                    prefix = prefix.decode()
+            else:
+                if any(self.contains_committed(key) for key in probe_keys):
+                    prefix = path
+                    writes = {prefix_key: prefix}
+                else:
+                    next_id = int(self.get_committed(PREFIX_NEXT_KEY)) \
+                        if self.contains_committed(PREFIX_NEXT_KEY) else 0
+                    prefix = f'#{next_id}'
+                    writes = {prefix_key: prefix,
+                              PREFIX_NEXT_KEY: str(next_id + 1)}
+                if self.commit_changes(writes, set()):
+                    self.flush()
+
+            self.prefix_ids[path] = prefix
+            return prefix
+
+    # Hot state and checkpoints
+
+    def track_hot(self, prefix, probe=None):
+        ''' Keeps in memory the committed values of the key ``prefix`` and
+            of all keys under it (that start with ``prefix + '||'``). The
+            values are loaded from the checkpoint, or otherwise from the db,
+            unless the key ``probe`` does not exist, which indicates there
+            are no such keys yet. Does nothing without checkpoints. '''
+        if self.checkpoint_interval == 0:
+            return
+
+        with self.commit_lock:
+            if prefix in self.hot_prefixes:
+                return
+
+            if probe is None or self.contains_committed(probe):
+                self.hot_items.update(self._load_prefix(prefix))
+            self.hot_prefixes.add(prefix)
+            self.new_hot_prefixes += [prefix]
+
+    def _load_prefix(self, prefix):
+        items = {}
+        if self.contains_committed(prefix):
+            items[prefix] = self.get_committed(prefix)
+
+        sub_prefix = prefix + '||'
+        if self.can_scan():
+            items.update(self.scan_committed(sub_prefix))
+        else:
+            # Without ordered scans, look through all keys (once).
+            for key in chain(self.db.keys(), self.flushing, self.pending):
+                if isinstance(key, bytes):
+                    key = key.decode()
+                if key.startswith(sub_prefix) and key not in items \
+                        and self.contains_committed(key):
+                    items[key] = self.get_committed(key)
+
+        # Some backends (eg. dbm) return stored strings as bytes.
+        return {key: value.decode() if isinstance(value, bytes) else value
+                for key, value in items.items()}
+
+    def is_hot(self, key):
+        ''' Returns True if the key is part of the hot state. '''
+        if key in self.hot_prefixes:
+            return True
+        i = key.find('||')
+        while i != -1:
+            if key[:i] in self.hot_prefixes:
+                return True
+            i = key.find('||', i + 2)
+        return False
+
+    def journal_changes(self, writes, deletes):
+        ''' Applies the hot state changes of a commit, and returns the
+            writes and deletes of the commit extended with a journal
+            entry, or a new snapshot, that records them. '''
+        hot_writes = {key: value for key, value in writes.items()
+                      if self.is_hot(key)}
+        hot_deletes = [key for key in deletes if self.is_hot(key)]
+        if not (hot_writes or hot_deletes or self.new_hot_prefixes
+                or self.checkpoint_requested):
+            return writes, deletes
+
+        self.hot_items.update(hot_writes)
+        for key in hot_deletes:
+            self.hot_items.pop(key, None)
+
+        writes = dict(writes)
+        deletes = set(deletes)
+        self.journal_seq += 1
+        if self.checkpoint_requested or \
+                self.journal_seq - self.snapshot_seq > self.checkpoint_interval:
+            # Replace the journal with a snapshot of the hot state.
+            writes['__checkpoint'] = json.dumps({
+                'seq': self.journal_seq,
+                'prefixes': sorted(self.hot_prefixes),
+                'items': self.hot_items})
+            for seq in range(self.snapshot_seq + 1, self.journal_seq):
+                deletes.add(journal_key(seq))
+            self.snapshot_seq = self.journal_seq
+            self.checkpoint_requested = False
+        else:
+            writes[journal_key(self.journal_seq)] = json.dumps({
+                'prefixes': self.new_hot_prefixes,
+                'writes': hot_writes,
+                'deletes': hot_deletes})
+        self.new_hot_prefixes = []
+        return writes, deletes
+
+    def load_checkpoint(self):
+        ''' Loads the hot state from the last snapshot and the journal
+            entries written after it. '''
+        if '__checkpoint' in self.db:
+            snapshot = json.loads(self.db['__checkpoint'])
+            self.hot_prefixes = set(snapshot['prefixes'])
+            self.hot_items = snapshot['items']
+            self.snapshot_seq = self.journal_seq = snapshot['seq']
+
+        while journal_key(self.journal_seq + 1) in self.db:
+            entry = json.loads(self.db[journal_key(self.journal_seq + 1)])
+            self.hot_prefixes.update(entry['prefixes'])
+            self.hot_items.update(entry['writes'])
+            for key in entry['deletes']:
+                self.hot_items.pop(key, None)
+            self.journal_seq += 1
+
+    def checkpoint(self):
+        ''' Writes a snapshot of the hot state, which replaces the journal
+            of its changes. '''
+        if self.checkpoint_interval == 0:
+            return
+        with self.commit_lock:
+            self.checkpoint_requested = True
+        if self.commit_changes({}, set()):
+            self.flush()
+
+    # Group commit
+
+    def stage_changes(self, writes, deletes):
+        ''' Adds the changes of a completed transaction to the group of
+            transactions waiting to be written to the db. '''
+        for item in deletes:
+            self.pending[item] = _DELETED
+        self.pending.update(writes)
+
+        self.pending_transactions += 1
+        self.last_commit_future = self.pending_future
+
+    def _schedule_flush(self):
+        self.flush_timer = Timer(
+            self.group_commit_window, self._flush_on_timer)
+        self.flush_timer.daemon = True
+        self.flush_timer.start()
+
+    def flush(self):
+        ''' Writes all completed transactions waiting in the group commit
+            to the db, as a single atomic write, and notifies those
+            waiting for them to be durable.
+
+            The commit lock is only held to take the group, and not
+            while writing it, so new transactions can commit (and read
+            the group) while the db write is in progress. '''
+        with self.io_lock:
+            with self.commit_lock:
+                if self.flush_timer is not None:
+                    self.flush_timer.cancel()
+                    self.flush_timer = None
+
+                if self.pending_transactions == 0:
+                    return
+
+                # Make the group visible as flushing before it is
+                # removed from pending, so that reads always find it.
+                self.flushing = group = self.pending
+                transactions = self.pending_transactions
+                self.pending = {}
+                self.pending_transactions = 0
+                future = self.pending_future
+                self.pending_future = Future()
+
+            try:
+                writes = {}
+                deletes = set()
+                for key, value in group.items():
+                    if value is _DELETED:
+                        deletes.add(key)
+                    else:
+                        writes[key] = value
+                self.write_to_db(writes, deletes)
+            except Exception as e:
+                # Keep the group to retry it with the next one.
+                with self.commit_lock:
+                    group.update(self.pending)
+                    self.pending = group
+                    self.pending_transactions += transactions
+                    self.flushing = {}
+                    self.last_commit_future = self.pending_future
+                future.set_exception(e)
+                raise
+
+            with self.commit_lock:
+                self.flushing = {}
+            future.set_result(True)
+
+    def close(self):
+        ''' Writes all completed transactions (and a checkpoint) to
+            the db. '''
+        self.checkpoint()
+        self.flush()
+        self.flush_stats()
+
+    def _flush_on_timer(self):
+        try:
+            self.flush()
+        except Exception:
+            # The error is passed to those waiting on the group, and
+            # the write is retried after another window.
+            with self.commit_lock:
+                if self.flush_timer is None:
+                    self._schedule_flush()
+
+    def durable(self):
+        ''' Returns a ``concurrent.futures.Future`` that resolves once the
+            last completed transaction is written to the db. '''
+        return self.last_commit_future
+
+    async def wait_durable(self):
+        ''' Awaits until the last completed transaction is written
+            to the db. '''
+        future = self.durable()
+        if not future.done():
+            await asyncio.wrap_future(future)
 
     def crash_recovery(self):
         ''' Detects whether a database contains potentially inconsistent state
@@ -213,7 +1406,9 @@ class StorableFactory:
             if item in self.db:
                 del self.db[item]
 
-        # TODO: Ensure the writes are complete?
+        # Ensure the writes are complete, if the db syncs.
+        if hasattr(self.db, 'sync'):
+            self.db.sync()
         del self.db['__backup_recovery']
 
     # Define the interfaces as a context manager
@@ -227,24 +1422,396 @@ class StorableFactory:
             StorableFactory outside the context manager will
             throw an exception. The context manager is re-entrant
             and commits to disk occur when the outmost context
-            manager (with) exits.'''
+            manager (with) exits. It waits for the transactions of
+            other threads and tasks to complete.'''
         return self
 
+    def atomic_writes_async(self):
+        ''' Returns an asynchronous context manager (``async with``) that,
+            like ``atomic_writes``, makes all writes in its body atomic,
+            and on exit awaits until they are durable. It waits for the
+            transactions of other tasks without blocking the event loop. '''
+        return _AsyncAtomicWrites(self)
+
     def __enter__(self):
-        self.rlock.acquire()
+        # Joins the transaction of another factory in progress in the
+        # current thread or task, if any.
+        owner = self.transaction_owner()
+        if owner is not self:
+            owner.hold(self)
+            return
+        self.transaction_lock.acquire()
+        self.begin_transaction()
+
+    def begin_transaction(self):
+        ''' Begins a transaction, or a nested one, once the current thread
+            or task holds the transaction lock. '''
         if self.levels == 0:
             self.current_transaction = get_unique_string()
+            if self.root.stats is not None:
+                self.transaction_stats = TransactionStats()
+
+            # The transaction takes the writes made in the current thread
+            # or task, to objects of this factory or the root factory.
+            _transaction_context.set((self, self.current_transaction))
 
         self.levels += 1
 
     def __exit__(self, type, value, traceback):
+        # Joined transactions complete with the transaction they join.
+        if self.transaction_owner() is not self:
+            return
+
+        flush = False
+        stats = None
         try:
             self.levels -= 1
             if self.levels == 0:
                 self.current_transaction = None
-                self.persist_cache()
+                stats, self.transaction_stats = self.transaction_stats, None
+                if stats is not None:
+                    self.record_stats(stats)
+                    start = time.perf_counter()
+                flush = self.commit_transaction()
         finally:
-            self.rlock.release()
+            # The locks of the factories whose objects the transaction
+            # used are released once its writes are committed.
+            if self.levels == 0:
+                held, self.held = self.held, []
+                for factory in reversed(held):
+                    factory.transaction_lock.release()
+            self.transaction_lock.release()
+
+        # Flushes do not run under the transaction lock.
+        if flush:
+            self.flush()
+
+        if stats is not None:
+            stats.commit_time = time.perf_counter() - start
+            self.root.stats.record_transaction(stats)
+            self.flush_stats()
+
+    def commit_transaction(self):
+        ''' Commits the outermost transaction as it exits, and returns
+            True if the group commit should be flushed. '''
+        if len(self.cache) == 0 and len(self.del_cache) == 0:
+            return False
+        flush = self.root.commit_changes(self.cache, self.del_cache)
+        self.cache = {}
+        self.del_cache = set()
+        return flush
+
+
+class StoragePartition(StorableFactory):
+    ''' A partition of a ``StorableFactory``, returned by its
+    ``partition(name)`` method, that makes storable objects in the same
+    key space but has its own transactions. A transaction of a partition
+    takes the lock of the partition and only commits the writes made
+    within it, so transactions of different partitions (eg. of the
+    channels with different VASPs) that only use their own objects do
+    not wait for each other. The commits of all partitions go through the
+    (root) factory, in order, and share its backend, group commit and
+    durability.
+
+    Operations join the outermost transaction that the current thread or
+    asyncio task holds, whether they are made on objects of the partition
+    or of the root factory. For example, the objects of the
+    ``PaymentProcessor`` (on the root factory) written while a channel
+    handles a request in the transaction of its partition are committed
+    atomically with the writes of the channel. From its first use of the
+    objects of the root factory until it commits, a transaction of a
+    partition also holds the lock of the root factory, so that no other
+    transaction changes them meanwhile. Locks are thus taken in the order
+    partition, then root: transactions of the root factory, or of another
+    partition, cannot write the objects of a partition, and read their
+    committed state. Reads see the writes of the current transaction,
+    followed by the committed state.
+    '''
+
+    def __init__(self, root, name):
+        self.transaction_lock = TransactionLock()
+        self.root = root
+        self.name = name
+        self.db = root.db
+        self.cache_size = root.cache_size
+        self.bloom_filters = root.bloom_filters
+        self.current_transaction = None
+        self.levels = 0
+        self.held = []
+
+        self.cache = {}
+        self.del_cache = set()
+        self.partitions = {}
+        self.transaction_stats = None
+
+    def partition(self, name):
+        return self.root.partition(name)
+
+    def track_hot(self, prefix, probe=None):
+        self.root.track_hot(prefix, probe)
+
+    def checkpoint(self):
+        self.root.checkpoint()
+
+    def get_committed(self, key):
+        return self.root.get_committed(key)
+
+    def contains_committed(self, item):
+        return self.root.contains_committed(item)
+
+    def can_scan(self):
+        return self.root.can_scan()
+
+    def scan_committed(self, prefix):
+        return self.root.scan_committed(prefix)
+
+    def persist_cache(self):
+        self.root.commit_changes(self.cache, self.del_cache)
+        self.cache = {}
+        self.del_cache = set()
+
+    def flush(self):
+        self.root.flush()
+
+    def close(self):
+        self.root.close()
+
+    def durable(self):
+        return self.root.durable()
+
+
+class AsyncStorableFactory(StorableFactory):
+    ''' A ``StorableFactory`` that never writes to the db on the thread
+    that runs transactions (eg. the event loop). Completed transactions
+    are kept in memory, where they are visible to reads, and are written
+    to the db by a dedicated I/O thread. Transactions completing while
+    the I/O thread is busy are written together, as a group commit.
+
+    The synchronous interface of the ``StorableFactory`` remains
+    available. Coroutines should use ``async with atomic_writes_async()``,
+    or await ``wait_durable()``, before acting on the commit (eg. sending
+    a response to another VASP). Reads that may go to the db can be run
+    on the I/O thread with ``await read_async(key)``.
+
+    Parameters:
+        * db : the persistent key-value store.
+        * cache_size : see ``StorableFactory``.
+        * checkpoint_interval : see ``StorableFactory``.
+        * compact_keys : see ``StorableFactory``.
+        * stats : see ``StorableFactory``.
+        * blob_fields : see ``StorableFactory``.
+        * bloom_filters : see ``StorableFactory``.
+        * durability : see ``StorableFactory``. The group commit window
+          does not apply, since groups are formed by the I/O thread.
+    '''
+
+    def __init__(self, db, cache_size=0, checkpoint_interval=0,
+                 compact_keys=False, stats=None, blob_fields=(),
+                 bloom_filters=False, durability=None):
+        StorableFactory.__init__(
+            self, db, cache_size=cache_size,
+            checkpoint_interval=checkpoint_interval,
+            compact_keys=compact_keys, stats=stats,
+            blob_fields=blob_fields, bloom_filters=bloom_filters,
+            durability=durability)
+        self.io_executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix='storage-io')
+
+    def commit_changes(self, writes, deletes):
+        with self.commit_lock:
+            if self.snapshots:
+                self.preserve_snapshots(writes, deletes)
+            if self.checkpoint_interval > 0:
+                writes, deletes = self.journal_changes(writes, deletes)
+            self.stage_changes(writes, deletes)
+        self.io_executor.submit(self._flush_on_io_thread)
+        return False
+
+    def _flush_on_io_thread(self):
+        try:
+            self.flush()
+        except Exception:
+            # The error is also passed to those waiting on the group, and
+            # the write is retried with the next transaction (or flush).
+            logger.exception('Storage flush error.')
+
+    async def read_async(self, key):
+        ''' Returns the value of the key, reading it from the db on the
+            I/O thread if it is not in memory. Raises KeyError if the key
+            does not exist. '''
+        owner = self.open_transaction()
+        if owner is not None and owner.is_uncommitted_in(key) \
+                or key in self.pending or key in self.flushing:
+            return self[key]
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(
+            self.io_executor, self.__getitem__, key)
+
+    def close(self):
+        ''' Writes all completed transactions (and a checkpoint) to the
+            db and stops the I/O thread. '''
+        self.checkpoint()
+        self.io_executor.shutdown()
+        self.flush()
+
+
+class StorageSnapshot:
+    ''' A read-only view of the state of a ``StorableFactory`` (and its
+    partitions) as committed when the snapshot was taken, returned by
+    ``StorableFactory.snapshot()``. It never sees the writes of
+    transactions in progress, nor those committed after it was taken,
+    and reading from it takes no lock.
+
+    Before a commit changes keys, the factory copies their committed
+    values into each open snapshot (once per key), and reads from the
+    snapshot check these first. Snapshots should therefore be short
+    lived, and be closed once done with.
+
+    Within a ``with`` block on the snapshot, reads through the factory in
+    the same thread or task (eg. of its ``StorableDict`` objects) go to
+    the snapshot, and writes raise RuntimeError. The snapshot is closed
+    as the block exits. It can also be read directly, as a key-value
+    store.
+    '''
+
+    def __init__(self, root):
+        self.root = root
+        self.overlay = {}
+        self.closed = False
+        self.token = None
+
+    def _check_open(self):
+        if self.closed:
+            raise RuntimeError('The snapshot is closed.')
+
+    def __getitem__(self, key):
+        self._check_open()
+        try:
+            value = self.root.get_committed(key)
+        except KeyError:
+            value = _DELETED
+        # Commits copy old values before changing them, so a change
+        # committed while reading is found here.
+        value = self.overlay.get(key, value)
+        if value is _DELETED:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        self._check_open()
+        found = self.root.contains_committed(key)
+        if key in self.overlay:
+            return self.overlay[key] is not _DELETED
+        return found
+
+    def __setitem__(self, key, value):
+        raise RuntimeError('Snapshots are read-only.')
+
+    def __delitem__(self, key):
+        raise RuntimeError('Snapshots are read-only.')
+
+    def can_scan(self):
+        return self.root.can_scan()
+
+    def scan_prefix(self, prefix):
+        ''' Returns a list of all (key, value) pairs with keys starting
+            with ``prefix``, in key order. '''
+        self._check_open()
+        items = self.root.scan_committed(prefix)
+        for key, value in self.overlay.copy().items():
+            if key.startswith(prefix):
+                if value is _DELETED:
+                    items.pop(key, None)
+                else:
+                    items[key] = value
+        return sorted(items.items())
+
+    def close(self):
+        ''' Releases the snapshot, that can no longer be read. '''
+        if not self.closed:
+            self.closed = True
+            self.root.release_snapshot(self)
+
+    def __enter__(self):
+        self.token = _snapshot_context.set(self)
+        return self
+
+    def __exit__(self, type, value, traceback):
+        _snapshot_context.reset(self.token)
+        self.close()
+
+
+class _AsyncAtomicWrites:
+    ''' The asynchronous context manager returned by
+        ``StorableFactory.atomic_writes_async``. '''
+
+    def __init__(self, factory):
+        self.factory = factory
+        self.outermost = False
+
+    async def __aenter__(self):
+        factory = self.factory
+        owner = factory.transaction_owner()
+        if owner is not factory:
+            await owner.hold_async(factory)
+            return
+        await factory.transaction_lock.acquire_async()
+        factory.begin_transaction()
+        self.outermost = factory.levels == 1
+
+    async def __aexit__(self, type, value, traceback):
+        self.factory.__exit__(type, value, traceback)
+        # Only wait once the transaction is complete, since the writes
+        # of an outer transaction are not committed yet.
+        if type is None and self.outermost:
+            await self.factory.wait_durable()
+
+
+# Marks keys deleted by transactions waiting in a group commit.
+_DELETED = object()
+
+
+def journal_key(seq):
+    ''' The key of the entry ``seq`` of the hot state journal. '''
+    return f'__journal_{seq}'
+
+# The key of the next id of an interned key prefix.
+PREFIX_NEXT_KEY = '__PREFIX_NEXT'
+
+# Blobs are stored under key_join([BLOB_PREFIX, hash]), and referenced by
+# a dict {BLOB_REF: hash} in place of the value of a blob field. The blob
+# fields in use are recorded under BLOB_FIELDS_KEY.
+BLOB_PREFIX = '__BLOB'
+BLOB_REF = '_Blob'
+BLOB_REF_PATTERN = re.compile(r'"_Blob": "([0-9a-f]{64})"')
+BLOB_FIELDS_KEY = '__BLOB_FIELDS'
+
+# The group commit window (seconds) of ``Durability.GROUP`` by default.
+DEFAULT_GROUP_COMMIT_WINDOW = 0.005
+
+# The max number of blobs, and of hashes of blob values, cached by a factory.
+BLOB_CACHE_SIZE = 1000
+
+# A value stored as a delta is the dict {DELTA_REF: base key, DELTA_DEPTH:
+# the number of deltas from a full value, DELTA_DIFF: the json_diff}. The
+# base of a value is the entry named by its DELTA_BASE field (the previous
+# version of a ``SharedObject``).
+DELTA_REF = '_Delta'
+DELTA_DEPTH = '_Depth'
+DELTA_DIFF = '_Diff'
+DELTA_BASE = '_previous_version'
+
+# The max number of full values of entries cached by a dictionary that
+# stores deltas.
+DELTA_CACHE_SIZE = 100
+
+# The factory and id of the outermost transaction in progress in the
+# current thread or task (see ``StorableFactory.transaction_owner``).
+_transaction_context = ContextVar('storage_transaction', default=None)
+
+# The snapshot that reads in the current thread or task go to (see
+# ``StorableFactory.active_snapshot``).
+_snapshot_context = ContextVar('storage_snapshot', default=None)
 
 
 class StorableDict(Storable):
@@ -262,9 +1829,50 @@ class StorableDict(Storable):
             * __delitem__(self, key)
 
         Keys should be strings or any object with a unique str representation.
+
+        With a ``cache_size`` larger than zero the dictionary keeps an LRU
+        cache of decoded values, to avoid decoding values on repeated reads.
+        Only committed values are cached, and entries are invalidated when
+        written or deleted through this instance. Immutable values are
+        returned as is, while other values (eg. JSONSerializable objects)
+        are returned as fresh copies so that they can be mutated. The
+        ``cache_hits`` and ``cache_misses`` counters record how effective
+        the cache is. Membership tests always read the db (or the Bloom
+        filter), as entries may be deleted through other instances.
+
+        A dictionary may be given an ``archive`` (see ``set_archive``), a
+        dictionary usually in a separate (cold) store, that holds entries
+        moved out of this one. Reads and membership tests fall through to
+        the archive for keys not found, while ``keys`` and ``len`` only
+        cover the entries kept in this dictionary.
+
+        With a ``delta_interval`` larger than zero, a value whose JSON names
+        an entry of the dictionary in its ``DELTA_BASE`` field (eg. a new
+        version of a ``SharedObject``) is stored as a ``json_diff`` against
+        that entry, unless this makes a chain of more than
+        ``delta_interval - 1`` deltas, in which case it is stored in full.
+        The full JSON of recently written or used bases is cached. Values
+        are then decoded by patching their base, and entries must not be
+        overwritten with other values nor deleted before the values based
+        on them. This suits maps of versions that are written once. Deltas
+        are decoded whatever the ``delta_interval``.
+
+        With ``bloom`` set, the dictionary keeps a Bloom filter of the keys
+        of its entries, loaded from the db on first use and updated as
+        entries are written, so that most membership tests of absent keys
+        (including those of ``__setitem__``) do not read the db. Deleted
+        keys stay in the filter. The filter only sees writes made through
+        this instance, so other instances must not add entries. The
+        ``bloom_negatives`` and ``bloom_false_positives`` counters record
+        how effective the filter is.
         """
 
-    def __init__(self, db, name, xtype, root=None):
+    # The keys (under the full path) that show a container already holds
+    # data under its full path (see ``container_prefix``).
+    PREFIX_PROBES = [['__META', '__LEN']]
+
+    def __init__(self, db, name, xtype, root=None, cache_size=0, hot=False,
+                 delta_interval=0, bloom=False):
 
         if root is None:
             self.root = ['']
@@ -273,6 +1881,43 @@ class StorableDict(Storable):
         self.name = name
         self.db = db
         self.xtype = xtype
+        self.prefix = container_prefix(
+            db, self.base_key(), self.PREFIX_PROBES)
+        self.ll_prefix = self.key('LL') + '||'
+        register_container(db, self.prefix, name)
+        self._init_metadata(hot)
+
+        # The cache of decoded values.
+        self.cache_size = cache_size
+        self.value_cache = OrderedDict()
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.copy_values = not issubclass(xtype, (str, int, float))
+
+        # The cache of full JSON values of bases of deltas.
+        self.delta_interval = delta_interval
+        self.delta_cache = OrderedDict()
+
+        # The Bloom filter of the db keys of entries, loaded on first use.
+        self.bloom = BloomFilter() if bloom else None
+        self.bloom_loaded = False
+        self.bloom_lock = Lock()
+        self.bloom_negatives = 0
+        self.bloom_false_positives = 0
+
+        # The dictionary holding entries moved out of this one.
+        self.archive = None
+
+    def _init_metadata(self, hot):
+        ''' Makes the stored values that hold the metadata of the
+            dictionary, and keeps them, or all entries if ``hot``, in the
+            hot state. '''
+        db = self.db
+        probe = self.key('__META', '__FIRST_KEY')
+        if hot:
+            track_hot(db, self.prefix, probe)
+        else:
+            track_hot(db, self.key('__META'), probe)
 
         # We create a doubly linked list to support traveral with O(1) lookup
         # addition and creation.
@@ -294,9 +1939,158 @@ class StorableDict(Storable):
     def base_key(self):
         return self.root + [self.name]
 
+    def set_archive(self, archive):
+        ''' Sets the dictionary (eg. a StorableDict in a cold store) to
+            read entries from when they are not in this dictionary. '''
+        self.archive = archive
+
     def __getitem__(self, key):
-        db_key, db_key_LL = self.derive_keys(key)
-        return self.post_proc(json.loads(self.db[db_key]))
+        try:
+            if self.cache_size > 0 and not in_snapshot(self.db):
+                return self._cached_getitem(key)
+            db_key, db_key_LL = self.derive_keys(key)
+            return self._decode(self.db[db_key])
+        except KeyError:
+            if self.archive is None:
+                raise
+            return self.archive[key]
+
+    def _decode(self, data):
+        ''' Decodes a value as stored in the db. '''
+        return self._decode_json(json.loads(data))
+
+    def _decode_json(self, data):
+        if isinstance(data, dict) and DELTA_REF in data:
+            data, _ = self._resolve_delta(data)
+            # Patched values share parts with the cached bases.
+            data = pickle.loads(pickle.dumps(data))
+        return self.post_proc(data)
+
+    def _stored_json(self, stored):
+        ''' Returns the JSON part of a value as stored in the db. '''
+        return stored
+
+    def _encode(self, key, value):
+        ''' Encodes a value to store in the db, as a delta if possible. '''
+        data = self.pre_proc(value)
+        if self.delta_interval == 0 or not isinstance(data, dict):
+            return json.dumps(data)
+
+        full, depth = data, 0
+        base = data.get(DELTA_BASE)
+        if base is not None and self._stored(self.key(str(base))):
+            base_data, base_depth = self._full_data(base)
+            if base_depth + 1 < self.delta_interval:
+                depth = base_depth + 1
+                data = {DELTA_REF: str(base), DELTA_DEPTH: depth,
+                        DELTA_DIFF: json_diff(base_data, full)}
+        encoded = json.dumps(data)
+        self._cache_full(str(key), pickle.loads(pickle.dumps(full)), depth)
+        return encoded
+
+    def _resolve_delta(self, data):
+        ''' Returns the full JSON value, and delta depth, of a JSON value
+            as stored. '''
+        if isinstance(data, dict) and DELTA_REF in data:
+            base_data, _ = self._full_data(data[DELTA_REF])
+            return json_patch(base_data, data[DELTA_DIFF]), data[DELTA_DEPTH]
+        return data, 0
+
+    def _full_data(self, key):
+        ''' Returns the full JSON value, and delta depth, of an entry.
+            The value must not be mutated. '''
+        key = str(key)
+        use_cache = not in_snapshot(self.db)
+        if use_cache and key in self.delta_cache:
+            self.delta_cache.move_to_end(key)
+            return self.delta_cache[key]
+
+        db_key, _ = self.derive_keys(key)
+        data = json.loads(self._stored_json(self.db[db_key]))
+        data, depth = self._resolve_delta(data)
+        if use_cache:
+            self._cache_full(key, data, depth)
+        return data, depth
+
+    def _cache_full(self, key, data, depth):
+        # Values are written once, so full values of uncommitted writes
+        # are cached too: a delta on them is rolled back with them.
+        self.delta_cache[key] = (data, depth)
+        self.delta_cache.move_to_end(key)
+        if len(self.delta_cache) > DELTA_CACHE_SIZE:
+            self.delta_cache.popitem(last=False)
+
+    def _cached_getitem(self, key):
+        key = str(key)
+        if key in self.value_cache:
+            self.cache_hits += 1
+            self.value_cache.move_to_end(key)
+            value = self.value_cache[key]
+            return copy.deepcopy(value) if self.copy_values else value
+
+        self.cache_misses += 1
+        db_key, _ = self.derive_keys(key)
+        value = self._decode(self.db[db_key])
+
+        # Never cache values of a transaction that is not yet committed.
+        if isinstance(self.db, StorableFactory) \
+                and self.db.is_uncommitted(db_key):
+            return value
+
+        self.value_cache[key] = copy.deepcopy(value) \
+            if self.copy_values else value
+        if len(self.value_cache) > self.cache_size:
+            self.value_cache.popitem(last=False)
+        return value
+
+    def _invalidate(self, key):
+        if self.cache_size > 0:
+            self.value_cache.pop(str(key), None)
+        if self.delta_cache:
+            self.delta_cache.pop(str(key), None)
+
+    def _stored(self, db_key):
+        ''' Returns True if the db has the key, without reading it if the
+            Bloom filter rules it out. '''
+        if self.bloom is None or in_snapshot(self.db):
+            return db_key in self.db
+        if not self.bloom_loaded:
+            self._load_bloom()
+        if db_key not in self.bloom:
+            self.bloom_negatives += 1
+            self._count_bloom(db_key, BLOOM_NEGATIVES)
+            return False
+        if db_key in self.db:
+            return True
+        self.bloom_false_positives += 1
+        self._count_bloom(db_key, BLOOM_FALSE_POSITIVES)
+        return False
+
+    def _load_bloom(self):
+        with self.bloom_lock:
+            if self.bloom_loaded:
+                return
+            for key in self.keys():
+                db_key, _ = self.derive_keys(key)
+                self.bloom.add(db_key)
+            self.bloom_loaded = True
+
+    def _bloom_add(self, db_key):
+        if self.bloom is not None:
+            with self.bloom_lock:
+                self.bloom.add(db_key)
+
+    def _count_bloom(self, db_key, counter):
+        db = self.db
+        if isinstance(db, StorableFactory) and db.root.stats is not None:
+            db.transaction_owner().operation_stats().add(
+                db.root.container_of(db_key), counter)
+
+    def bloom_false_positive_rate(self):
+        ''' Returns the rate of false positives of the Bloom filter,
+            among the absent keys tested. '''
+        return false_positive_rate(
+            self.bloom_negatives, self.bloom_false_positives)
 
     def _ll_cons(self, key):
         db_key, db_key_LL = self.derive_keys(key)
@@ -327,10 +2121,11 @@ class StorableDict(Storable):
 
     def __setitem__(self, key, value):
         db_key, _ = self.derive_keys(key)
-        data = json.dumps(self.pre_proc(value))
+        self._invalidate(key)
+        data = self._encode(key, value)
 
         # Ensure nothing fails after that
-        if db_key not in self.db:
+        if not self._stored(db_key):
             xlen = self.length.get_value()
             self.length.set_value(xlen+1)
 
@@ -338,20 +2133,32 @@ class StorableDict(Storable):
             self._ll_cons(key)
 
         self.db[db_key] = data
+        self._bloom_add(db_key)
 
         if __debug__:
             self._check_invariant()
 
     def keys(self):
-        ''' An iterator over the keys of the dictionary. '''
+        ''' An iterator over the keys of the dictionary, in the order of the
+            linked list (the last key added first). If the db supports
+            prefix scans, all linked list entries are read through a single
+            scan, and their links followed in memory, otherwise the linked
+            list is traversed in the db. Both give the same order. '''
         if __debug__:
             self._check_invariant()
 
-        if not self.first_key.get_value() != '_NONE':
-            return
         ll_value_key = self.first_key.get_value()
+        if ll_value_key == '_NONE':
+            return
+
+        if can_scan(self.db):
+            ll_entries = dict(self.db.scan_prefix(self.ll_prefix))
+            read_entry = ll_entries.__getitem__
+        else:
+            read_entry = self.db.__getitem__
+
         while True:
-            ll_entry = json.loads(self.db[ll_value_key])
+            ll_entry = json.loads(read_entry(ll_value_key))
             ll_value_key = ll_entry[1]
             yield ll_entry[3]
             if ll_value_key is None:
@@ -368,6 +2175,7 @@ class StorableDict(Storable):
 
     def __delitem__(self, key):
         db_key, db_key_LL = self.derive_keys(key)
+        self._invalidate(key)
         if db_key in self.db:
             xlen = self.length.get_value()
             self.length.set_value(xlen-1)
@@ -401,13 +2209,15 @@ class StorableDict(Storable):
             raise KeyError(key)
 
     def derive_keys(self, item):
-        key = key_join(self.base_key() + [str(item)])
-        key_LL = key_join(self.base_key() + ['LL', str(item)])
-        return key, key_LL
+        item = str(item)
+        part = f'[{len(item)}:{item}]'
+        return f'{self.prefix}||{part}', self.ll_prefix + part
 
     def __contains__(self, item):
-        db_key = key_join(self.base_key() + [str(item)])
-        return db_key in self.db
+        db_key = self.key(str(item))
+        if self._stored(db_key):
+            return True
+        return self.archive is not None and item in self.archive
 
 
 class StorableList(Storable):
@@ -420,6 +2230,11 @@ class StorableList(Storable):
         * __iadd__(self, other)
 
     Keys are always integers.
+
+    Items may be moved to an ``archive`` (see ``set_archive``), a
+    dictionary keyed by the str of their position, and then removed from
+    the list with ``evict``. The length and positions of items do not
+    change, and reads of evicted items fall through to the archive.
     '''
 
     def __init__(self, db, name, xtype, root=None):
@@ -431,13 +2246,23 @@ class StorableList(Storable):
         self.db = db
         self.xtype = xtype
 
+        self.prefix = container_prefix(db, self.base_key(), [['__LEN']])
+        register_container(db, self.prefix, name)
+        length_key = self.key('__LEN')
+        track_hot(db, length_key, probe=length_key)
         self.length = StorableValue(db, '__LEN', int, root=self, default=0)
-        if not self.length.exists():
-            self.length.set_value(0)
+
+        # The dictionary holding evicted items.
+        self.archive = None
 
     def base_key(self):
         return self.root + [self.name]
 
+    def set_archive(self, archive):
+        ''' Sets the dictionary (keyed by the str of positions) to read
+            evicted items from. '''
+        self.archive = archive
+
     def __getitem__(self, key):
         if type(key) is not int:
             raise KeyError('Key must be an int.')
@@ -445,16 +2270,35 @@ class StorableList(Storable):
         if not 0 <= key < xlen:
             raise KeyError('Key does not exist')
 
-        db_key = key_join(self.base_key() + [str(key)])
+        db_key = self.key(str(key))
+        if self.archive is not None and db_key not in self.db:
+            return self.archive[str(key)]
         return self.post_proc(json.loads(self.db[db_key]))
 
+    def is_evicted(self, key):
+        ''' Returns True if the item at position ``key`` has been evicted
+            from this list. '''
+        db_key = self.key(str(key))
+        return db_key not in self.db
+
+    def evict(self, key):
+        ''' Removes the stored item at position ``key``, that must first
+            be copied to the archive of the list. '''
+        if self.archive is None:
+            raise RuntimeError('Cannot evict items of a list without archive.')
+        if type(key) is not int or not 0 <= key < len(self):
+            raise KeyError('Key does not exist')
+        db_key = self.key(str(key))
+        if db_key in self.db:
+            del self.db[db_key]
+
     def __setitem__(self, key, value):
         if type(key) is not int:
             raise KeyError('Key must be an int.')
         xlen = len(self)
         if not 0 <= key < xlen:
             raise KeyError('Key does not exist')
-        db_key = key_join(self.base_key() + [str(key)])
+        db_key = self.key(str(key))
         self.db[db_key] = json.dumps(self.pre_proc(value))
 
     def __len__(self):
@@ -478,6 +2322,11 @@ class StorableList(Storable):
 class StorableValue(Storable):
     """ Implements a cached persistent value. The value is stored to storage
         but a cached variant is stored for quick reads.
+
+        Making a value does not touch storage: it is read on first use,
+        and a ``default`` is returned while no value is stored, but is
+        only written by ``set_value``. Making the values and containers
+        of a new channel is therefore free of I/O.
     """
 
     def __init__(self, db, name, xtype, root=None, default=None):
@@ -490,16 +2339,13 @@ class StorableValue(Storable):
         self.xtype = xtype
         self.db = db
         self._base_key = self.root + [self.name]
-        self._base_key_str = key_join(self._base_key)
+        self._base_key_str = root.key(name) if root is not None \
+            else key_join(self._base_key)
+        self.prefix = self._base_key_str
+        self.default = default
 
         self.has_value = False
-
-        if self.exists():
-            self.value = self.get_value()
-        else:
-            self.value = None
-            if default is not None:
-                self.set_value(default)
+        self.value = None
 
     def set_value(self, value):
         ''' Sets the vale for this instance.
@@ -512,17 +2358,197 @@ class StorableValue(Storable):
         self.value = value
 
     def get_value(self):
-        ''' Get the value for this object. '''
+        ''' Get the value for this object, or its default if it
+            has none. '''
         key = self._base_key_str
-        encoded_value = self.db[key]
+        try:
+            encoded_value = self.db[key]
+        except KeyError:
+            if self.default is None:
+                raise
+            return self.default
         val = json.loads(encoded_value)
         self.value = self.post_proc(val)
         self.has_value = True
         return self.value
 
     def exists(self):
-        ''' Tests if this value exist in storage. '''
+        ''' Tests if this value exist in storage. A default is not stored,
+            so it does not count until ``set_value`` is called. '''
         return self.has_value or self._base_key_str in self.db
 
     def base_key(self):
         return self._base_key
+
+
+class StorableLogDict(StorableDict):
+    """ Implements a persistent dictionary like type optimized for keys
+        that are written once, such as logs of objects or commands. It
+        supports the same interface as ``StorableDict``.
+
+        Instead of a doubly linked list, keys are recorded in an append-only
+        index in insertion order, so that adding a new key only writes the
+        value, its index entry and the index length. Each stored value is
+        prefixed with the position of its index entry, which is removed
+        when the key is deleted. Keys can also be enumerated in chunks
+        through ``key_chunks``.
+        """
+
+    # Data of a StorableDict to migrate also keeps the full path.
+    PREFIX_PROBES = [['__LOG', '__NEXT'], ['__META', '__LEN']]
+
+    def _init_metadata(self, hot):
+        db = self.db
+        probe = self.key('__LOG', '__NEXT')
+        if hot:
+            track_hot(db, self.prefix, probe)
+        else:
+            track_hot(db, self.key('__LOG'), probe)
+
+        # The number of index entries ever appended, and of deleted keys.
+        meta = StorableValue(db, '__LOG', str, root=self)
+        self.next_index = StorableValue(
+            db, '__NEXT', int, root=meta, default=0)
+        self.deleted = StorableValue(db, '__DELETED', int, root=meta, default=0)
+
+    def index_key(self, position):
+        return self.key('__IDX', str(position))
+
+    @staticmethod
+    def _split(data):
+        # Values are stored as "<index position>:<json value>".
+        sep = b':' if isinstance(data, bytes) else ':'
+        position, _, json_data = data.partition(sep)
+        return int(position), json_data
+
+    def _decode(self, data):
+        _, json_data = self._split(data)
+        return self._decode_json(json.loads(json_data))
+
+    def _stored_json(self, stored):
+        _, json_data = self._split(stored)
+        return json_data
+
+    def __setitem__(self, key, value):
+        db_key, _ = self.derive_keys(key)
+        self._invalidate(key)
+        data = self._encode(key, value)
+
+        if self._stored(db_key):
+            # Overwrite the value, keeping its index entry.
+            position, _ = self._split(self.db[db_key])
+        else:
+            position = self.next_index.get_value()
+            self.next_index.set_value(position + 1)
+            self.db[self.index_key(position)] = str(key)
+
+        self.db[db_key] = f'{position}:{data}'
+        self._bloom_add(db_key)
+
+    def __delitem__(self, key):
+        db_key, _ = self.derive_keys(key)
+        self._invalidate(key)
+        if db_key not in self.db:
+            raise KeyError(key)
+
+        position, _ = self._split(self.db[db_key])
+        del self.db[self.index_key(position)]
+        del self.db[db_key]
+        self.deleted.set_value(self.deleted.get_value() + 1)
+
+    def __len__(self):
+        return self.next_index.get_value() - self.deleted.get_value()
+
+    def key_chunks(self, chunk_size=100):
+        ''' An iterator over lists of up to ``chunk_size`` keys of the
+            dictionary, in insertion order. '''
+        chunk = []
+        if can_scan(self.db):
+            index_prefix = self.key('__IDX') + '||'
+            # Index keys of the same length sort in order of position.
+            for _, key in sorted(
+                    self.db.scan_prefix(index_prefix),
+                    key=lambda item: len(item[0])):
+                chunk += [key.decode() if isinstance(key, bytes) else key]
+                if len(chunk) == chunk_size:
+                    yield chunk
+                    chunk = []
+            if chunk:
+                yield chunk
+            return
+
+        for position in range(self.next_index.get_value()):
+            index_key = self.index_key(position)
+            if index_key not in self.db:
+                # The key was deleted.
+                continue
+            key = self.db[index_key]
+            chunk += [key.decode() if isinstance(key, bytes) else key]
+            if len(chunk) == chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    def keys(self):
+        ''' An iterator over the keys of the dictionary. '''
+        for chunk in self.key_chunks():
+            yield from chunk
+
+    def compact(self):
+        ''' Renumbers the index entries of the keys, in order, to remove
+            the gaps left by deleted keys. Returns the number of gaps
+            removed. Must be called within a transaction. '''
+        deleted = self.deleted.get_value()
+        if deleted == 0:
+            return 0
+
+        # Keys only move to lower positions, which are free once the
+        # keys before them have moved.
+        for position, key in enumerate(list(self.keys())):
+            db_key, _ = self.derive_keys(key)
+            old_position, json_data = self._split(self.db[db_key])
+            if old_position == position:
+                continue
+            if isinstance(json_data, bytes):
+                json_data = json_data.decode()
+            del self.db[self.index_key(old_position)]
+            self.db[self.index_key(position)] = str(key)
+            self.db[db_key] = f'{position}:{json_data}'
+
+        self.next_index.set_value(self.next_index.get_value() - deleted)
+        self.deleted.set_value(0)
+        return deleted
+
+    def migrate(self):
+        ''' Migrates the entries of a ``StorableDict`` with the same name
+            and root to this dictionary, and removes its linked list. Must
+            be called within a transaction. '''
+        old = StorableDict.__new__(StorableDict)
+        old.root, old.name, old.db = self.root, self.name, self.db
+        old.prefix, old.ll_prefix = self.prefix, self.ll_prefix
+        old_len_key = old.key('__META', '__LEN')
+        if old_len_key not in self.db:
+            return
+
+        old.first_key = StorableValue(
+            self.db, '__FIRST_KEY', str, root=StorableValue(
+                self.db, '__META', str, root=old))
+        old_keys = list(StorableDict.keys(old)) \
+            if old.first_key.exists() else []
+
+        # Entries are indexed oldest first.
+        for key in reversed(old_keys):
+            db_key, db_key_LL = old.derive_keys(key)
+            position = self.next_index.get_value()
+            self.next_index.set_value(position + 1)
+            self.db[self.index_key(position)] = str(key)
+            data = self.db[db_key]
+            if isinstance(data, bytes):
+                data = data.decode()
+            self.db[db_key] = f'{position}:{data}'
+            del self.db[db_key_LL]
+
+        del self.db[old_len_key]
+        if old.first_key.exists():
+            del self.db[old.first_key._base_key_str]
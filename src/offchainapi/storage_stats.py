@@ -0,0 +1,201 @@
+# Copyright (c) The Libra Core Contributors
+# SPDX-License-Identifier: Apache-2.0
+
+# Statistics of the storage operations of a StorableFactory.
+
+from threading import Lock
+
+# The counters kept for each container, and their index in the list of
+# counters of the container:
+#   * reads : reads (gets, membership tests and scans) of storage keys.
+#   * db_reads : the reads that went to the backend, rather than being
+#     served from the transaction, the group commit or the hot state.
+#   * writes : keys written to the backend on commit.
+#   * deletes : keys deleted from the backend on commit.
+#   * bytes_encoded : the size of the (encoded) values written.
+#   * bytes_decoded : the size of the (encoded) values read.
+#   * bloom_negatives : membership tests of keys answered by the Bloom
+#     filter of the container, without a read.
+#   * bloom_false_positives : keys found absent by a read, that the Bloom
+#     filter of the container reported as possibly present.
+COUNTERS = ('reads', 'db_reads', 'writes', 'deletes',
+            'bytes_encoded', 'bytes_decoded',
+            'bloom_negatives', 'bloom_false_positives')
+READS, DB_READS, WRITES, DELETES, BYTES_ENCODED, BYTES_DECODED, \
+    BLOOM_NEGATIVES, BLOOM_FALSE_POSITIVES = range(len(COUNTERS))
+
+
+def false_positive_rate(negatives, false_positives):
+    ''' Returns the rate of false positives of a Bloom filter among the
+        keys tested that were absent, or 0.0 if there were none. '''
+    absent = negatives + false_positives
+    return false_positives / absent if absent else 0.0
+
+# The container of keys that are not under a known container.
+OTHER = '(other)'
+
+
+class TransactionStats:
+    ''' The storage operations of a single transaction, or of operations
+    made outside transactions, per container.
+
+    Attributes:
+        containers (dict) : maps container names (eg. 'object_locks') to
+            lists of the ``COUNTERS``.
+        commit_time (float) : the time (seconds) the commit of the
+            transaction took, including any flush to the backend.
+    '''
+
+    def __init__(self):
+        self.containers = {}
+        self.commit_time = 0.0
+
+    def add(self, container, counter, amount=1):
+        ''' Adds ``amount`` to the ``counter`` (eg. ``READS``) of the
+            ``container``. '''
+        counts = self.containers.get(container)
+        if counts is None:
+            counts = self.containers[container] = [0] * len(COUNTERS)
+        counts[counter] += amount
+
+    def totals(self):
+        ''' Returns the list of the ``COUNTERS`` over all containers. '''
+        return [sum(counts[i] for counts in self.containers.values())
+                for i in range(len(COUNTERS))]
+
+
+class StorageStatsSink:
+    ''' The interface of sinks of storage statistics, that may be passed
+    to a ``StorableFactory`` as its ``stats``. Methods are called on the
+    thread that commits, and should be quick. '''
+
+    def record_transaction(self, stats):
+        ''' Records the ``TransactionStats`` of a committed transaction. '''
+        raise NotImplementedError()  # pragma: no cover
+
+    def record_operations(self, stats):
+        ''' Records the ``TransactionStats`` of operations (reads) made
+            outside transactions since the last call. '''
+        raise NotImplementedError()  # pragma: no cover
+
+
+class Histogram:
+    ''' A histogram of non negative values, with buckets for zero and for
+    each power of two: a value ``v >= 1`` falls in the bucket of the
+    smallest power of two larger than ``v``. '''
+
+    def __init__(self):
+        self.buckets = {}
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def add(self, value):
+        bucket = 1 << int(value).bit_length() if value >= 1 else 0
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def percentile(self, fraction):
+        ''' Returns the upper bound of the bucket of the value at
+            ``fraction`` (eg. 0.99) of all values. '''
+        if self.count == 0:
+            return 0
+        rank = fraction * self.count
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                return bucket
+        return max(self.buckets)
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else 0,
+            'max': self.max,
+            'p50': self.percentile(0.5),
+            'p99': self.percentile(0.99),
+            'buckets': dict(sorted(self.buckets.items())),
+        }
+
+
+class StorageStatsAggregator(StorageStatsSink):
+    ''' A ``StorageStatsSink`` that keeps, per container, the totals of
+    each of the ``COUNTERS`` and histograms of their values per transaction,
+    as well as the same for all containers together (under the name
+    ``'*'``), and a histogram of commit times (in microseconds). Operations
+    outside transactions only count towards totals. It is thread safe.
+
+    The summary of containers with a Bloom filter also has the rate of its
+    false positives (see ``false_positive_rate``).
+    '''
+
+    def __init__(self):
+        self.lock = Lock()
+        self.reset()
+
+    def reset(self):
+        ''' Clears all statistics. '''
+        with self.lock:
+            self.transactions = 0
+            self.totals = {}
+            self.histograms = {}
+            self.commit_time_us = Histogram()
+
+    def _add_totals(self, container, counts):
+        totals = self.totals.get(container)
+        if totals is None:
+            totals = self.totals[container] = [0] * len(COUNTERS)
+        for i, count in enumerate(counts):
+            totals[i] += count
+
+    def _add_histograms(self, container, counts):
+        histograms = self.histograms.get(container)
+        if histograms is None:
+            histograms = self.histograms[container] = [
+                Histogram() for _ in COUNTERS]
+        for histogram, count in zip(histograms, counts):
+            histogram.add(count)
+
+    def record_transaction(self, stats):
+        with self.lock:
+            self.transactions += 1
+            for container, counts in stats.containers.items():
+                self._add_totals(container, counts)
+                self._add_histograms(container, counts)
+            totals = stats.totals()
+            self._add_totals('*', totals)
+            self._add_histograms('*', totals)
+            self.commit_time_us.add(stats.commit_time * 1e6)
+
+    def record_operations(self, stats):
+        with self.lock:
+            for container, counts in stats.containers.items():
+                self._add_totals(container, counts)
+            self._add_totals('*', stats.totals())
+
+    def summary(self):
+        ''' Returns a dict (that can be dumped as JSON) with the number of
+            transactions, the histogram of commit times and, per container,
+            the totals of each counter and their histograms per
+            transaction. '''
+        with self.lock:
+            containers = {}
+            for container in sorted(set(self.totals) | set(self.histograms)):
+                totals = self.totals.get(container, [0] * len(COUNTERS))
+                entry = dict(zip(COUNTERS, totals))
+                if totals[BLOOM_NEGATIVES] or totals[BLOOM_FALSE_POSITIVES]:
+                    entry['bloom_false_positive_rate'] = false_positive_rate(
+                        totals[BLOOM_NEGATIVES], totals[BLOOM_FALSE_POSITIVES])
+                if container in self.histograms:
+                    entry['per_transaction'] = {
+                        name: histogram.summary() for name, histogram
+                        in zip(COUNTERS, self.histograms[container])}
+                containers[container] = entry
+            return {
+                'transactions': self.transactions,
+                'commit_time_us': self.commit_time_us.summary(),
+                'containers': containers,
+            }
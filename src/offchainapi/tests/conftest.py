@@ -4,6 +4,8 @@
 from ..payment import PaymentActor, PaymentAction, PaymentObject, KYCData, StatusObject
 from ..business import BusinessContext, VASPInfo
 from ..storage import StorableFactory
+from ..sqlite_storage import SQLiteStorage
+from ..log_storage import LogStorage
 from ..payment_logic import Status, PaymentProcessor, PaymentCommand
 from ..protocol import OffChainVASP, VASPPairChannel
 from ..command_processor import CommandProcessor
@@ -113,11 +115,20 @@ def two_channels(three_addresses, vasp, store):
 
     return (server, client)
 
-@pytest.fixture
-def db(tmp_path):
+@pytest.fixture(params=['dbm', 'sqlite', 'log'])
+def db(tmp_path, request):
     db_path = tmp_path / 'db.dat'
-    with dbm.open(str(db_path), 'c') as xdb:
+    if request.param == 'sqlite':
+        xdb = SQLiteStorage(db_path)
+        yield xdb
+        xdb.close()
+    elif request.param == 'log':
+        xdb = LogStorage(db_path)
         yield xdb
+        xdb.close()
+    else:
+        with dbm.open(str(db_path), 'c') as xdb:
+            yield xdb
 
 
 @pytest.fixture
@@ -12,10 +12,14 @@ from ..payment_logic import PaymentCommand
 from ..status_logic import Status
 from ..payment import PaymentAction, PaymentActor, PaymentObject, StatusObject
 from ..core import Vasp
+from ..storage import Durability
+from ..storage_stats import StorageStatsAggregator
 from .basic_business_context import TestBusinessContext
 from ..crypto import ComplianceKey
 
 from threading import Thread
+from tempfile import TemporaryDirectory
+import os
 import time
 import asyncio
 
@@ -70,14 +74,21 @@ def start_thread_main(vasp, loop):
     print('VASP loop exit...')
 
 
-def make_new_VASP(Peer_addr, port, reliable=True):
+def make_new_VASP(Peer_addr, port, reliable=True, storage_stats=None,
+                  database=None, durability=None, batch_size=0,
+                  send_window=0, park_timeout=0.0):
     VASPx = Vasp(
         Peer_addr,
         host='localhost',
         port=port,
         business_context=TestBusinessContext(Peer_addr, reliable=reliable),
         info_context=SimpleVASPInfo(Peer_addr),
-        database={})
+        database={} if database is None else database,
+        durability=durability,
+        storage_stats=storage_stats,
+        batch_size=batch_size,
+        send_window=send_window,
+        park_timeout=park_timeout)
 
     loop = asyncio.new_event_loop()
     VASPx.set_loop(loop)
@@ -93,9 +104,61 @@ def make_new_VASP(Peer_addr, port, reliable=True):
     return (VASPx, loop, t)
 
 
-async def main_perf(messages_num=10, wait_num=0, verbose=False):
-    VASPa, loopA, tA = make_new_VASP(PeerA_addr, port=8091)
-    VASPb, loopB, tB = make_new_VASP(PeerB_addr, port=8092, reliable=False)
+def print_storage_stats(name, stats):
+    ''' Prints the storage operations per container recorded by a
+        StorageStatsAggregator. '''
+    summary = stats.summary()
+    commit_time = summary['commit_time_us']
+    print(f'Storage {name}: {summary["transactions"]} transactions, '
+          f'commit mean {commit_time["mean"]:.0f} us, '
+          f'p99 < {commit_time["p99"]} us')
+    for container, entry in summary['containers'].items():
+        per_transaction = entry.get('per_transaction', {})
+        ops_mean = sum(per_transaction[counter]['mean']
+                       for counter in ('reads', 'writes', 'deletes')) \
+            if per_transaction else 0
+        print(f'    {container}: reads {entry["reads"]} '
+              f'(db {entry["db_reads"]}), writes {entry["writes"]}, '
+              f'deletes {entry["deletes"]}, '
+              f'bytes in {entry["bytes_decoded"]} '
+              f'out {entry["bytes_encoded"]}, '
+              f'ops per transaction {ops_mean:.1f}')
+
+
+async def main_perf(messages_num=10, wait_num=0, verbose=False,
+                    storage_stats=False, durability=None, batch_size=0,
+                    send_window=0, park_timeout=0.0):
+    ''' Runs the benchmark. With a ``durability`` (a Durability or its
+        value, eg. 'sync') the VASPs store their state in SQLite files with
+        that durability, rather than in memory. With a ``batch_size`` the
+        VASPs send their requests in batches, and with a ``send_window``
+        they bound the requests in flight. With a ``park_timeout`` they hold
+        the requests blocked on their dependencies rather than answer them
+        with a wait. '''
+    with TemporaryDirectory() as tmp:
+        database_a = database_b = None
+        if durability is not None:
+            durability = Durability(durability)
+            database_a = os.path.join(tmp, 'vasp_a.db')
+            database_b = os.path.join(tmp, 'vasp_b.db')
+        await run_perf(messages_num, wait_num, verbose, storage_stats,
+                       durability, database_a, database_b, batch_size,
+                       send_window, park_timeout)
+
+
+async def run_perf(messages_num, wait_num, verbose, storage_stats,
+                   durability, database_a, database_b, batch_size=0,
+                   send_window=0, park_timeout=0.0):
+    statsA = StorageStatsAggregator() if storage_stats else None
+    statsB = StorageStatsAggregator() if storage_stats else None
+    VASPa, loopA, tA = make_new_VASP(
+        PeerA_addr, port=8091, storage_stats=statsA,
+        database=database_a, durability=durability, batch_size=batch_size,
+        send_window=send_window, park_timeout=park_timeout)
+    VASPb, loopB, tB = make_new_VASP(
+        PeerB_addr, port=8092, reliable=False, storage_stats=statsB,
+        database=database_b, durability=durability, batch_size=batch_size,
+        send_window=send_window, park_timeout=park_timeout)
 
     # Get the channel from A -> B
     channelAB = VASPa.vasp.get_channel(PeerB_addr)
@@ -190,6 +253,16 @@ async def main_perf(messages_num=10, wait_num=0, verbose=False):
 
     print(f'Estimate throughput #: {len(commands)/elapsed} Tx/s')
 
+    print(f'Retransmits: VASPa {VASPa.net_handler.retransmit_counts()} '
+          f'VASPb {VASPb.net_handler.retransmit_counts()}')
+    print(f'Parked requests: VASPa {channelAB.parked_requests} '
+          f'VASPb {channelBA.parked_requests}')
+    window = channelAB.send_window
+    if window is not None:
+        print(f'Send window: size {window.size:.1f}, '
+              f'decreases {window.decreases}, '
+              f'congestion events {window.congestion_events}')
+
     # Close the loops
     VASPa.close()
     VASPb.close()
@@ -203,3 +276,7 @@ async def main_perf(messages_num=10, wait_num=0, verbose=False):
     rAB = channelAB.pending_retransmit_number()
     rBA = channelBA.pending_retransmit_number()
     print(f'Pending retransmit: VASPa {rAB} VASPb {rBA}')
+
+    if storage_stats:
+        print_storage_stats('VASPa', statsA)
+        print_storage_stats('VASPb', statsB)
@@ -0,0 +1,328 @@
+# Copyright (c) The Libra Core Contributors
+# SPDX-License-Identifier: Apache-2.0
+
+# Benchmarks for the storage subsystem.
+#
+# Run as:
+# $ python src/scripts/run_storage_perf.py
+#
+# or, to compare the backends and write a JSON report:
+# $ python src/scripts/run_storage_perf.py -m 1000 10000 -o report.json
+#
+from ..storage import StorableFactory, AsyncStorableFactory
+from ..sqlite_storage import SQLiteStorage
+from ..log_storage import LogStorage
+from ..payment_logic import PaymentProcessor
+from ..sample.sample_command import SampleCommand
+
+import asyncio
+import dbm
+import json
+import os
+import platform
+import random
+import tempfile
+import time
+
+
+class SlowDisk(dict):
+    ''' An in-memory key-value store where each atomic write takes
+        ``delay`` seconds, to simulate a disk bound load (eg. fsync). '''
+
+    def __init__(self, delay):
+        dict.__init__(self)
+        self.delay = delay
+
+    def write_batch(self, writes, deletes):
+        time.sleep(self.delay)
+        self.update(writes)
+        for key in deletes:
+            self.pop(key, None)
+
+
+async def measure_loop_lag(stop, period=0.001):
+    ''' Samples the event loop lag (the delay of a ``period`` sleep
+        beyond ``period``) until the event ``stop`` is set. '''
+    lags = []
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(period)
+        lags += [time.perf_counter() - start - period]
+    return lags
+
+
+async def main_loop_lag(factory_class, transactions_num=200, clients_num=10,
+                        write_delay=0.005, verbose=True):
+    ''' Runs ``clients_num`` concurrent coroutines, each committing its
+        share of ``transactions_num`` transactions through
+        ``atomic_writes_async`` to a slow disk, and reports the lag
+        of the event loop while they run. '''
+    db = SlowDisk(write_delay)
+    store = factory_class(db)
+    with store.atomic_writes():
+        D = store.make_dict('bench', int, None)
+
+    async def client(n):
+        for i in range(transactions_num // clients_num):
+            async with store.atomic_writes_async():
+                D[f'{n}/{i}'] = i
+
+    stop = asyncio.Event()
+    monitor = asyncio.create_task(measure_loop_lag(stop))
+
+    start = time.perf_counter()
+    await asyncio.gather(*[client(n) for n in range(clients_num)])
+    elapsed = time.perf_counter() - start
+    stop.set()
+    lags = sorted(await monitor)
+    store.close()
+
+    results = {
+        'factory': factory_class.__name__,
+        'transactions': transactions_num,
+        'elapsed_sec': elapsed,
+        'tx_per_sec': transactions_num / elapsed,
+        'lag_mean_ms': 1000 * sum(lags) / max(len(lags), 1),
+        'lag_p99_ms': 1000 * lags[int(0.99 * (len(lags) - 1))] if lags else 0,
+        'lag_max_ms': 1000 * lags[-1] if lags else 0,
+    }
+
+    if verbose:
+        print(f'{results["factory"]}: {transactions_num} transactions in '
+              f'{elapsed:.2f} sec ({results["tx_per_sec"]:.1f} tx/s)')
+        print(f'    Event loop lag: mean {results["lag_mean_ms"]:.2f} ms, '
+              f'p99 {results["lag_p99_ms"]:.2f} ms, '
+              f'max {results["lag_max_ms"]:.2f} ms')
+
+    return results
+
+
+async def main_loop_lag_compare(**kwargs):
+    ''' Compares the event loop lag of committing on the event loop
+        (``StorableFactory``) to committing on an I/O thread
+        (``AsyncStorableFactory``). '''
+    return [await main_loop_lag(factory_class, **kwargs)
+            for factory_class in (StorableFactory, AsyncStorableFactory)]
+
+
+def populate_vasp_db(db, entries_num):
+    ''' Fills the db with ``entries_num`` cold entries (eg. old payments),
+        an object lock table with a tenth as many entries, and a hundredth
+        as many pending commands. '''
+    store = StorableFactory(db)
+    processor = PaymentProcessor(None, store)
+    with store.atomic_writes():
+        root = store.make_value('bench', None)
+        cold = store.make_dict('cold', str, root)
+        locks = store.make_dict('object_locks', str, root, hot=True)
+        for i in range(entries_num):
+            cold[str(i)] = 'x' * 100
+        for i in range(entries_num // 10):
+            locks[f'version{i}'] = 'True'
+        for i in range(entries_num // 100):
+            processor.persist_command_obligation(
+                'peer', i, SampleCommand(f'command{i}'))
+
+
+def start_vasp_storage(db, checkpoint_interval):
+    ''' Opens the storage as a VASP does on startup, and reads its hot
+        state: the pending commands and the object lock table. Returns
+        the time this takes. '''
+    start = time.perf_counter()
+    store = StorableFactory(db, checkpoint_interval=checkpoint_interval)
+    processor = PaymentProcessor(None, store)
+    processor.list_command_obligations()
+    with store.atomic_writes():
+        root = store.make_value('bench', None)
+        locks = store.make_dict('object_locks', str, root, hot=True)
+        for key in locks.keys():
+            locks[key]
+    elapsed = time.perf_counter() - start
+    store.close()
+    return elapsed
+
+
+# The backends compared by the benchmarks.
+BACKENDS = ('dict', 'dbm', 'sqlite', 'log')
+
+
+def open_backend(backend, path):
+    ''' Opens a new db of the given ``backend`` ('dict', 'dbm', 'sqlite'
+        or 'log'). '''
+    if backend == 'dict':
+        return {}
+    if backend == 'sqlite':
+        return SQLiteStorage(path)
+    if backend == 'log':
+        return LogStorage(path)
+    return dbm.open(path, 'c')
+
+
+def main_startup(sizes=(1000, 10000, 100000), backend='dbm', verbose=True):
+    ''' Measures the startup time of the storage of a VASP as the size
+        of its database grows, with and without checkpoints. '''
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for entries_num in sizes:
+            path = os.path.join(tmp_dir, f'startup_{entries_num}.db')
+            db = open_backend(backend, path)
+            populate_vasp_db(db, entries_num)
+
+            no_checkpoint = start_vasp_storage(db, 0)
+            # The first start with checkpoints loads the hot state from
+            # the db, and writes the first snapshot as it closes.
+            start_vasp_storage(db, 1000)
+            checkpoint = start_vasp_storage(db, 1000)
+            db.close()
+
+            results += [{
+                'backend': backend,
+                'entries': entries_num,
+                'startup_sec': no_checkpoint,
+                'startup_checkpoint_sec': checkpoint,
+            }]
+            if verbose:
+                print(f'{backend} {entries_num} entries: startup '
+                      f'{no_checkpoint:.3f} sec, '
+                      f'with checkpoint {checkpoint:.3f} sec')
+    return results
+
+
+def close_backend(db):
+    if hasattr(db, 'close'):
+        db.close()
+
+
+def available_backends():
+    ''' Returns the backends that can be opened here. '''
+    available = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for backend in BACKENDS:
+            try:
+                db = open_backend(backend, os.path.join(tmp_dir, backend))
+                close_backend(db)
+                available += [backend]
+            except Exception:
+                pass
+    return available
+
+
+def timed(func, ops_num):
+    ''' Returns the mean time (seconds) per operation of ``func``, that
+        performs ``ops_num`` operations. '''
+    start = time.perf_counter()
+    func()
+    return (time.perf_counter() - start) / max(ops_num, 1)
+
+
+def bench_backend(backend, keys_num, path, batch_size=1000,
+                  samples_num=10000, commits_num=1000):
+    ''' Measures the storage operations on a ``backend`` holding
+        ``keys_num`` keys in a ``StorableDict``. Inserts, list appends
+        and deletes commit every ``batch_size`` operations, and lookups,
+        deletes and list appends are measured on up to ``samples_num``
+        keys. Returns a dict of the mean seconds per operation, and the
+        median and 99th percentile of the latency of small commits. '''
+    db = open_backend(backend, path)
+    store = StorableFactory(db)
+    with store.atomic_writes():
+        root = store.make_value('bench', None)
+        xdict = store.make_dict('dict', str, root)
+        xlist = store.make_list('list', str, root)
+        xvalue = store.make_value('value', str, root)
+
+    keys = [f'key{i}' for i in range(keys_num)]
+    sample = random.Random(0).sample(keys, min(keys_num, samples_num))
+    value = 'x' * 100
+
+    def in_batches(items, func):
+        def run():
+            for i in range(0, len(items), batch_size):
+                with store.atomic_writes():
+                    for item in items[i:i + batch_size]:
+                        func(item)
+        return run
+
+    def insert(key):
+        xdict[key] = value
+
+    def lookup():
+        for key in sample:
+            xdict[key]
+
+    def iterate():
+        for _ in xdict.keys():
+            pass
+
+    def append(_):
+        nonlocal xlist
+        xlist += [value]
+
+    def delete(key):
+        del xdict[key]
+
+    def set_get():
+        for _ in sample:
+            with store.atomic_writes():
+                xvalue.set_value(value)
+            xvalue.get_value()
+
+    results = {}
+    results['dict_insert'] = timed(in_batches(keys, insert), keys_num)
+    results['dict_lookup'] = timed(lookup, len(sample))
+    results['dict_iterate'] = timed(iterate, keys_num)
+    results['list_append'] = timed(in_batches(sample, append), len(sample))
+    results['value_set_get'] = timed(set_get, len(sample))
+
+    latencies = []
+    for i in range(commits_num):
+        start = time.perf_counter()
+        with store.atomic_writes():
+            xdict[keys[i % keys_num]] = str(i)
+        latencies += [time.perf_counter() - start]
+    latencies.sort()
+    results['commit_p50'] = latencies[len(latencies) // 2]
+    results['commit_p99'] = latencies[int(0.99 * (len(latencies) - 1))]
+
+    results['dict_delete'] = timed(in_batches(sample, delete), len(sample))
+
+    store.close()
+    close_backend(db)
+    return results
+
+
+def main_matrix(sizes=(1000, 10000, 100000), backends=None,
+                report=None, verbose=True):
+    ''' Runs ``bench_backend`` for each backend (by default all available
+        ones) and number of keys in ``sizes``, and returns a report with
+        all measurements. If ``report`` is a file name the report is
+        also written to it, as JSON. '''
+    if backends is None:
+        backends = available_backends()
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for keys_num in sizes:
+            for backend in backends:
+                path = os.path.join(tmp_dir, f'matrix_{backend}_{keys_num}.db')
+                measurements = bench_backend(backend, keys_num, path)
+                results += [{
+                    'backend': backend,
+                    'keys': keys_num,
+                    'sec_per_op': measurements,
+                }]
+                if verbose:
+                    print(f'{backend} {keys_num} keys: ' + ', '.join(
+                        f'{op} {1e6 * sec:.1f} us'
+                        for op, sec in measurements.items()))
+
+    matrix = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'time': time.time(),
+        'results': results,
+    }
+    if report is not None:
+        with open(report, 'w') as report_file:
+            json.dump(matrix, report_file, indent=2)
+    return matrix
@@ -1,15 +1,18 @@
 # Copyright (c) The Libra Core Contributors
 # SPDX-License-Identifier: Apache-2.0
 
-from ..asyncnet import Aionet
+from ..asyncnet import Aionet, SignedRequest
 from ..protocol_messages import OffChainException
 from ..business import BusinessNotAuthorized
 from ..utils import get_unique_string
+from ..sample.sample_command import SampleCommand
+from ..flow_control import SendWindow
 
 import pytest
 import aiohttp
 import json
 import asyncio
+import time
 
 
 @pytest.fixture
@@ -104,6 +107,8 @@ async def test_send_command(net_handler, tester_addr, server, command):
     net_handler.vasp.info_context.get_peer_base_url.return_value = base_url
     req = await net_handler.sequence_command(tester_addr, command)
     server.side['cid'] = command.get_request_cid()
+    assert req.cid == command.get_request_cid()
+    assert isinstance(req, SignedRequest) and isinstance(req.content, str)
 
     ret = await net_handler.send_request(tester_addr, req)
     await net_handler.close()
@@ -121,7 +126,7 @@ async def test_watchdog_task(net_handler, tester_addr, server, command):
     assert channel.would_retransmit()
     waiting_packages = await channel.package_retransmit(number=100)
     assert len(waiting_packages) == 1
-    assert waiting_packages[0].content == req
+    assert waiting_packages[0].content == req.content
     assert channel.next_final_sequence() == 0
 
 
@@ -138,3 +143,196 @@ async def test_watchdog_task(net_handler, tester_addr, server, command):
     waiting_packages = await channel.package_retransmit(number=100)
     assert not waiting_packages
     await net_handler.close()
+
+
+async def test_retransmit_scheduler(net_handler, tester_addr, command):
+    sent = []
+
+    async def retransmit(channel, requests):
+        sent.append([request.cid for request in requests])
+
+    net_handler.retransmit = retransmit
+    scheduler = net_handler.retransmitter
+    scheduler.timeout = 10.0
+    scheduler.jitter = 0.0
+
+    # A request without a response is retransmitted once started.
+    await net_handler.sequence_command(tester_addr, command)
+    cid = command.get_request_cid()
+    key = tester_addr.as_str()
+    net_handler.schedule_watchdog(asyncio.get_event_loop(), period=10.0)
+    await asyncio.sleep(0.05)
+    assert sent == [[cid]]
+    assert net_handler.retransmit_counts() == {key: 1}
+
+    # Then after a timeout that doubles for each retransmit.
+    now = time.monotonic()
+    assert scheduler.pop_due(now + 19.0) == {}
+    due = scheduler.pop_due(now + 20.5)
+    assert [[request.cid for request in requests]
+            for requests in due.values()] == [[cid]]
+    assert scheduler.attempts[(key, cid)] == 2
+    assert net_handler.retransmit_counts() == {key: 2}
+
+    # A request is not retransmitted while it is being sent.
+    channel = net_handler.vasp.get_channel(tester_addr)
+    scheduler.sending(channel, [cid])
+    assert scheduler.pop_due(now + 100.0) == {}
+    scheduler.sent(channel, [cid], now=now + 100.0)
+    assert scheduler.pop_due(now + 139.0) == {}
+    assert len(scheduler.pop_due(now + 141.0)) == 1
+
+    # A request with a response is dropped at its deadline.
+    with channel.storage.atomic_writes():
+        del channel.pending_response[cid]
+    assert scheduler.pop_due(now + 1000.0) == {}
+    assert (key, cid) not in scheduler.attempts
+    await net_handler.close()
+
+
+async def test_send_batched_commands(vasp, key, tester_addr, aiohttp_server):
+    net_handler = Aionet(vasp, batch_size=3)
+    batches = []
+
+    async def handler(request):
+        headers = {'X-Request-ID': request.headers['X-Request-ID']}
+        data = json.loads(await key.verify_message(await request.text()))
+        batches.append(len(data['batch']))
+        resp = {'batch': [
+            {'cid': item['cid'], 'status': 'success',
+             '_ObjectType': 'CommandResponseObject'}
+            for item in data['batch']], '_ObjectType': 'CommandBatchObject'}
+        signed_json_response = await key.sign_message(json.dumps(resp))
+        return aiohttp.web.Response(text=signed_json_response, headers=headers)
+
+    app = aiohttp.web.Application()
+    url = net_handler.get_url('/', tester_addr.as_str(), other_is_server=True)
+    app.add_routes([aiohttp.web.post(url, handler)])
+    server = await aiohttp_server(app)
+    base_url = f'http://{server.host}:{server.port}'
+    vasp.info_context.get_peer_base_url.return_value = base_url
+
+    requests = [
+        await net_handler.sequence_command(tester_addr, SampleCommand(f'H{i}'))
+        for i in range(5)]
+    results = await asyncio.gather(
+        *[net_handler.send_request(tester_addr, req) for req in requests])
+    await net_handler.close()
+
+    # The requests are coalesced in batches of up to 3.
+    assert results == [True] * 5
+    assert batches == [3, 2]
+    channel = vasp.get_channel(tester_addr)
+    assert not channel.would_retransmit()
+
+
+async def test_send_window():
+    window = SendWindow(max_size=4, initial=2)
+    number, ticket = await window.acquire(5)
+    assert number == 2 and window.available() == 0
+
+    # Requests beyond the window wait.
+    waiting = asyncio.ensure_future(window.acquire(1))
+    await asyncio.sleep(0)
+    assert not waiting.done()
+
+    # Answered requests grow the window, and let waiting ones through.
+    window.release(number, ticket)
+    assert window.size == 3.0
+    number, ticket = await waiting
+    assert number == 1 and window.in_flight == 1
+
+    # Congestion halves the window once for the requests in flight.
+    other, other_ticket = await window.acquire(1)
+    window.release(number, ticket, congested=True)
+    window.release(other, other_ticket, congested=True)
+    assert window.size == 1.5
+    assert window.decreases == 1 and window.congestion_events == 2
+
+
+async def test_send_window_keeps_order():
+    window = SendWindow(max_size=2, initial=2)
+    await window.acquire(2)
+    waiting = [asyncio.ensure_future(window.acquire(1)) for _ in range(4)]
+    await asyncio.sleep(0)
+
+    # Requests woken while the window filled up again keep their place.
+    window.release_unused(1)
+    window.release_unused(1)
+    await asyncio.sleep(0)
+    assert [task.done() for task in waiting] == [True, True, False, False]
+    window.release_unused(1)
+    await asyncio.sleep(0)
+    assert [task.done() for task in waiting] == [True, True, True, False]
+
+
+async def test_send_windowed_commands(vasp, key, tester_addr, aiohttp_server):
+    net_handler = Aionet(vasp, send_window=2)
+    in_flight = []
+
+    async def handler(request):
+        headers = {'X-Request-ID': request.headers['X-Request-ID']}
+        data = json.loads(await key.verify_message(await request.text()))
+        in_flight.append(data['cid'])
+        max_in_flight.append(len(in_flight))
+        await asyncio.sleep(0.01)
+        in_flight.remove(data['cid'])
+        resp = {'cid': data['cid'], 'status': 'success'}
+        signed_json_response = await key.sign_message(json.dumps(resp))
+        return aiohttp.web.Response(text=signed_json_response, headers=headers)
+
+    max_in_flight = []
+    app = aiohttp.web.Application()
+    url = net_handler.get_url('/', tester_addr.as_str(), other_is_server=True)
+    app.add_routes([aiohttp.web.post(url, handler)])
+    server = await aiohttp_server(app)
+    base_url = f'http://{server.host}:{server.port}'
+    vasp.info_context.get_peer_base_url.return_value = base_url
+
+    requests = [
+        await net_handler.sequence_command(tester_addr, SampleCommand(f'H{i}'))
+        for i in range(6)]
+    sends = asyncio.gather(
+        *[net_handler.send_request(tester_addr, req) for req in requests])
+    await asyncio.sleep(0.005)
+    channel = vasp.get_channel(tester_addr)
+    assert channel.send_queue_depth() > 0
+
+    results = await sends
+    await net_handler.close()
+    assert results == [True] * 6
+    assert max(max_in_flight) <= 2
+    assert channel.send_queue_depth() == 0
+    assert channel.send_window.congestion_events == 0
+
+
+async def test_send_window_small_burst(vasp, key, tester_addr, aiohttp_server):
+    net_handler = Aionet(vasp, send_window=64)
+
+    async def handler(request):
+        headers = {'X-Request-ID': request.headers['X-Request-ID']}
+        data = json.loads(await key.verify_message(await request.text()))
+        resp = {'cid': data['cid'], 'status': 'success'}
+        signed_json_response = await key.sign_message(json.dumps(resp))
+        return aiohttp.web.Response(text=signed_json_response, headers=headers)
+
+    app = aiohttp.web.Application()
+    url = net_handler.get_url('/', tester_addr.as_str(), other_is_server=True)
+    app.add_routes([aiohttp.web.post(url, handler)])
+    server = await aiohttp_server(app)
+    base_url = f'http://{server.host}:{server.port}'
+    vasp.info_context.get_peer_base_url.return_value = base_url
+
+    requests = [
+        await net_handler.sequence_command(tester_addr, SampleCommand(f'H{i}'))
+        for i in range(2)]
+    results = await asyncio.gather(
+        *[net_handler.send_request(tester_addr, req) for req in requests])
+    await asyncio.sleep(0.01)
+    await net_handler.close()
+
+    # Each request takes the window once, and grows it once.
+    window = vasp.get_channel(tester_addr).send_window
+    assert results == [True] * 2
+    assert window.in_flight == 0 and window.sent == 2
+    assert 8.0 < window.size <= 8.0 + 2 / 8.0
@@ -1,10 +1,13 @@
 # Copyright (c) The Libra Core Contributors
 # SPDX-License-Identifier: Apache-2.0
 
-from ..protocol import VASPPairChannel
+from ..protocol import VASPPairChannel, OffChainVASP
+from ..protocol_messages import CommandRequestObject
+from ..archive import PaymentArchiver
+from ..compaction import StorageCompactor
 from ..status_logic import Status, STATUS_HEIGHTS
 from ..payment_command import PaymentCommand, PaymentLogicError
-from ..business import BusinessForceAbort, BusinessValidationFailure
+from ..business import BusinessForceAbort, BusinessValidationFailure, VASPInfo
 
 from ..payment import PaymentObject, StatusObject, PaymentActor
 from ..libra_address import LibraAddress
@@ -389,7 +392,8 @@ def test_process_command_success_vanilla(payment, loop):
     _ = loop.run_until_complete(coro)
 
     assert [call[0] for call in net.method_calls] == [
-        'sequence_command', 'send_request']
+        'atomic_writes_async', 'sequence_command_local', 'package_sequenced',
+        'send_request']
 
 
 def reset_payment_status(payment):
@@ -475,3 +479,133 @@ def test_can_change_status(payment, loop):
         for new_status in Status:
             if STATUS_HEIGHTS[new_status] < STATUS_HEIGHTS[old_status]:
                 assert not processor.can_change_status(payment, new_status, actor_is_sender=False)
+
+
+def test_archive_finished_payments(payment, loop):
+    store = StorableFactory({})
+    cold_store = StorableFactory({})
+
+    my_addr = LibraAddress.from_bytes(b'B'*16)
+    other_addr = LibraAddress.from_bytes(b'A'*16)
+    bcm = TestBusinessContext(my_addr)
+    processor = PaymentProcessor(bcm, store, loop)
+    vasp = OffChainVASP(my_addr, processor, store, MagicMock(spec=VASPInfo))
+    archiver = PaymentArchiver(vasp, cold_store)
+    channel = vasp.get_channel(other_addr)
+
+    def sequence(new_payment):
+        cmd = PaymentCommand(new_payment)
+        cmd.set_origin(other_addr)
+        request = CommandRequestObject(cmd)
+        request.cid = cmd.get_request_cid()
+        with store.atomic_writes():
+            for version in cmd.get_new_object_versions():
+                processor.object_store[version] = cmd.get_object(
+                    version, processor.object_store)
+            processor.store_latest_payment_by_ref_id(cmd)
+            channel.command_sequence += [request]
+            channel.other_request_index[request.cid] = request
+        return request
+
+    # A payment that is aborted, and one in flight.
+    requests = [sequence(payment)]
+    aborted = payment.new_version(store=processor.object_store)
+    aborted.sender.change_status(StatusObject(Status.abort, 'code', 'msg'))
+    requests += [sequence(aborted)]
+
+    other_payment = PaymentObject(
+        payment.sender, payment.receiver, f'{payment.reference_id}_other',
+        None, 'Another payment.', payment.action)
+    requests += [sequence(other_payment)]
+
+    assert list(processor.finished_payments.keys()) == [payment.reference_id]
+    assert archiver.archive_payments() == 1
+    assert archiver.archive_payments() == 0
+
+    # Only the payment in flight is kept in the hot store.
+    assert len(processor.finished_payments) == 0
+    assert list(processor.reference_id_index.keys()) == [
+        other_payment.reference_id]
+    assert len(processor.object_store) == 1
+    assert [channel.command_sequence.is_evicted(i) for i in range(3)] == [
+        True, True, False]
+    assert archiver.cursors[other_addr.as_str()].get_value() == 2
+    assert len(channel.other_request_index) == 1
+
+    # Archived payments and requests are still readable.
+    latest = processor.get_latest_payment_by_ref_id(payment.reference_id)
+    assert latest.sender.status.as_status() == Status.abort
+    history = list(processor.get_payment_history_by_ref_id(
+        payment.reference_id))
+    assert [p.get_version() for p in history] == [
+        aborted.get_version(), payment.get_version()]
+    assert list(channel.command_sequence) == requests
+    assert requests[0].cid in channel.other_request_index
+    assert channel.other_request_index[requests[1].cid] == requests[1]
+
+
+def test_archive_payments_finished_before(payment, loop):
+    store = StorableFactory({})
+    cold_store = StorableFactory({})
+    my_addr = LibraAddress.from_bytes(b'B'*16)
+    processor = PaymentProcessor(TestBusinessContext(my_addr), store, loop)
+    vasp = OffChainVASP(my_addr, processor, store, MagicMock(spec=VASPInfo))
+
+    def store_payment(new_payment):
+        cmd = PaymentCommand(new_payment)
+        with store.atomic_writes():
+            for version in cmd.get_new_object_versions():
+                processor.object_store[version] = cmd.get_object(
+                    version, processor.object_store)
+            processor.store_latest_payment_by_ref_id(cmd)
+
+    # A payment aborted before the archiver is attached.
+    store_payment(payment)
+    aborted = payment.new_version(store=processor.object_store)
+    aborted.sender.change_status(StatusObject(Status.abort, 'code', 'msg'))
+    store_payment(aborted)
+
+    archiver = PaymentArchiver(vasp, cold_store, batch_size=1)
+    assert len(processor.finished_payments) == 0
+    assert loop.run_until_complete(archiver.scan_finished_payments()) == 1
+    assert loop.run_until_complete(archiver.scan_finished_payments()) == 0
+    assert archiver.archive_payments() == 1
+    assert len(processor.reference_id_index) == 0
+    latest = processor.get_latest_payment_by_ref_id(payment.reference_id)
+    assert latest.sender.status.as_status() == Status.abort
+
+
+def test_compact_storage(payment, loop):
+    store = StorableFactory({})
+    my_addr = LibraAddress.from_bytes(b'B'*16)
+    other_addr = LibraAddress.from_bytes(b'A'*16)
+    processor = PaymentProcessor(
+        TestBusinessContext(my_addr), store, loop, log_stores=True)
+    vasp = OffChainVASP(my_addr, processor, store, MagicMock(spec=VASPInfo))
+    channel = vasp.get_channel(other_addr)
+    compactor = StorageCompactor(vasp, retention=10.0)
+
+    with store.atomic_writes():
+        channel.object_locks['used'] = 'False'
+        channel.object_locks['ready'] = 'True'
+        for seq in range(5):
+            processor.persist_command_obligation(
+                'other', seq, PaymentCommand(payment))
+        for seq in range(4):
+            processor.release_command_obligation('other', seq)
+
+    # Consumed locks are kept for the retention, while the index of the
+    # command cache, with 4 deleted keys for 1 live one, is rewritten.
+    report = loop.run_until_complete(compactor.compact(now=100.0))
+    assert report['locks'] == 0 and report['index_entries'] == 4
+    assert processor.command_cache.next_index.get_value() == 1
+    assert list(processor.command_cache.keys()) == ['other_4']
+    assert processor.command_cache['other_4'] == PaymentCommand(payment)
+
+    report = loop.run_until_complete(compactor.compact(now=111.0))
+    assert report == {'locks': 1, 'index_entries': 0, 'blobs': 0, 'bytes': 0}
+    assert list(channel.object_locks.keys()) == ['ready']
+    assert channel.object_locks.is_used('used')
+    assert channel.object_locks.is_collected('used')
+    assert channel.collected_locks == 1
+    assert compactor.collected_locks == 1
@@ -81,6 +81,6 @@ def test_logic_protocol_process_start(payment_sender_init, loop):
     _ = loop.run_until_complete(asyncio.all_tasks(loop).pop())
     assert len(net.method_calls) > 0
 
-    assert net.method_calls[0][0] == 'sequence_command'
-    cmd_response = net.method_calls[0].args[1]
+    assert net.method_calls[1][0] == 'sequence_command_local'
+    cmd_response = net.method_calls[1].args[1]
     assert isinstance(cmd_response, PaymentCommand)
@@ -3,19 +3,21 @@
 
 from ..protocol import VASPPairChannel, make_protocol_error, DependencyException
 from ..protocol_messages import CommandRequestObject, CommandResponseObject, \
-    OffChainProtocolError, OffChainException
+    CommandBatchObject, OffChainProtocolError, OffChainException
 from ..errors import OffChainErrorCode
 from ..sample.sample_command import SampleCommand
 from ..command_processor import CommandProcessor
 from ..utils import JSONSerializable, JSONFlag
 from ..storage import StorableFactory
 from ..crypto import OffChainInvalidSignature
+from ..object_locks import LockState
 
 from copy import deepcopy
 import random
 from unittest.mock import MagicMock
 import pytest
 import json
+import asyncio
 
 
 class RandomRun(object):
@@ -152,6 +154,93 @@ def test_create_channel_to_myself(three_addresses, vasp):
         channel = VASPPairChannel(a0, a0, vasp, store, command_processor)
 
 
+def test_create_channel_no_storage_io(three_addresses, vasp):
+    a0, a1, _ = three_addresses
+    db = {}
+    store = StorableFactory(db)
+    command_processor = MagicMock(spec=CommandProcessor)
+    channel = VASPPairChannel(a0, a1, vasp, store, command_processor)
+
+    # Nothing is written until the channel is used.
+    assert len(db) == 0
+    assert len(channel.command_sequence) == 0
+    assert len(channel.object_locks) == 0
+    assert list(channel.pending_response.keys()) == []
+    assert len(db) == 0
+
+
+def test_object_lock_table(three_addresses, vasp):
+    a0, a1, _ = three_addresses
+    store = StorableFactory({})
+    command_processor = MagicMock(spec=CommandProcessor)
+    server = VASPPairChannel(a0, a1, vasp, store, command_processor)
+    client = VASPPairChannel(a1, a0, vasp, store, command_processor)
+
+    request = client.sequence_command_local(SampleCommand('Hello'))
+    client.handle_response(server.handle_request(request))
+    request = client.sequence_command_local(
+        SampleCommand('World', deps=['Hello']))
+
+    # Locks are held in memory, and written through to storage.
+    locks = client.object_locks
+    assert locks.get('Hello') == request.cid.encode()
+    assert locks.is_locked_by('Hello', request.cid)
+    assert locks.store['Hello'] == request.cid
+    assert locks['Hello'] == request.cid
+    client.handle_response(server.handle_request(request))
+    assert locks.get('Hello') is LockState.USED
+    assert locks.get('World') is LockState.FREE
+    assert locks.store['Hello'] == 'False'
+    assert locks.get('Other') is None
+
+    # A channel opened on the same storage loads the same locks.
+    client2 = VASPPairChannel(a1, a0, vasp, store, command_processor)
+    assert client2.object_locks.get('Hello') is LockState.USED
+    assert client2.object_locks.is_free('World')
+    assert sorted(client2.object_locks.keys()) == ['Hello', 'World']
+
+    with store.atomic_writes():
+        del client2.object_locks['Hello']
+    assert 'Hello' not in client2.object_locks
+    assert 'Hello' not in client2.object_locks.store
+
+
+def test_collected_object_locks(three_addresses, vasp):
+    a0, a1, _ = three_addresses
+    store = StorableFactory({})
+    command_processor = MagicMock(spec=CommandProcessor)
+    server = VASPPairChannel(a0, a1, vasp, store, command_processor)
+    client = VASPPairChannel(a1, a0, vasp, store, command_processor)
+
+    hello = client.sequence_command_local(SampleCommand('Hello'))
+    client.handle_response(server.handle_request(hello))
+    world = client.sequence_command_local(
+        SampleCommand('World', deps=['Hello']))
+    client.handle_response(server.handle_request(world))
+
+    # Only consumed locks are collected, out of the table.
+    with store.atomic_writes():
+        assert not server.object_locks.collect('World')
+        assert server.object_locks.collect('Hello')
+    assert not server.object_locks.collect('Hello')
+    assert sorted(server.object_locks.keys()) == ['World']
+    assert 'Hello' not in server.object_locks.store
+
+    # A channel reopened on the same storage still sees the version used.
+    server2 = VASPPairChannel(a0, a1, vasp, store, command_processor)
+    assert 'Hello' in server2.object_locks
+    assert server2.object_locks.is_used('Hello')
+    assert server2.object_locks.is_collected('Hello')
+
+    # Retransmitted requests still get their response ...
+    assert server2.handle_request(hello).status == 'success'
+
+    # ... and new requests depending on the version a conflict.
+    request = CommandRequestObject(SampleCommand('Again', deps=['Hello']))
+    response = server2.handle_request(request)
+    assert response.error.code == OffChainErrorCode.used_dependencies
+
+
 def test_client_server_role_definition(three_addresses, vasp):
     a0, a1, a2 = three_addresses
     command_processor = MagicMock(spec=CommandProcessor)
@@ -372,6 +461,138 @@ async def test_protocol_conflict2(two_channels):
     assert not await client.parse_handle_response(sresp)
 
 
+async def test_protocol_batch(two_channels, key):
+    server, client = two_channels
+
+    requests = [client.sequence_command_local(SampleCommand(item))
+                for item in ['Hello', 'World']]
+    # A request the server has to wait for.
+    requests += [CommandRequestObject(SampleCommand('Wait', deps=['Later']))]
+
+    msg = await client.package_requests(requests)
+    assert msg.type is CommandBatchObject
+    resp = await server.parse_handle_request(msg.content)
+    assert resp.type is CommandBatchObject
+    assert [r.status for r in resp.raw] == ['success', 'success', 'failure']
+
+    results = await client.parse_handle_batch_response(resp.content)
+    assert results[:2] == [True, True]
+    assert isinstance(results[2], OffChainProtocolError)
+    assert len(client.get_final_sequence()) == 2
+    assert not client.would_retransmit()
+
+    # A malformed item does not affect the others of the batch.
+    request = client.sequence_command_local(SampleCommand('Again'))
+    batch = {'batch': [{}, request.get_json_data_dict(JSONFlag.NET)]}
+    CommandBatchObject.add_object_type(batch)
+    resp = await server.parse_handle_request(
+        await key.sign_message(json.dumps(batch)))
+    assert resp.raw.items[0].error.code == OffChainErrorCode.parsing_error
+    assert resp.raw.items[1].status == 'success'
+    assert len(server.get_final_sequence()) == 3
+
+
+async def test_protocol_park_blocked_request(two_channels):
+    server, client = two_channels
+    server.park_timeout = 5.0
+
+    # A request for a missing dependency is held until it is created.
+    blocked = CommandRequestObject(SampleCommand('World', deps=['Hello']))
+    parked = asyncio.ensure_future(server.parse_handle_request(
+        (await client.package_request(blocked)).content))
+    await asyncio.sleep(0.01)
+    assert not parked.done()
+    assert server.parked_requests == 1 and 'Hello' in server.parked
+
+    hello = client.sequence_command_local(SampleCommand('Hello'))
+    resp = await server.parse_handle_request(
+        (await client.package_request(hello)).content)
+    assert await client.parse_handle_response(resp.content)
+
+    resp = await asyncio.wait_for(parked, 1.0)
+    assert resp.raw.status == 'success'
+    assert server.object_locks.is_used('Hello')
+    assert server.parked == {}
+
+    # A request locked by a server request is answered once it is done.
+    base = client.sequence_command_local(SampleCommand('Base'))
+    client.handle_response(server.handle_request(base))
+    server_request = server.sequence_command_local(
+        SampleCommand('Server', deps=['Base']))
+    client_request = CommandRequestObject(
+        SampleCommand('Client', deps=['Base']))
+    parked = asyncio.ensure_future(server.parse_handle_request(
+        (await client.package_request(client_request)).content))
+    await asyncio.sleep(0.01)
+    assert not parked.done()
+
+    server.handle_response(client.handle_request(server_request))
+    resp = await asyncio.wait_for(parked, 1.0)
+    assert resp.raw.error.code == OffChainErrorCode.used_dependencies
+
+    # Without the dependency, the request gets a wait after the timeout.
+    server.park_timeout = 0.05
+    never = CommandRequestObject(SampleCommand('Never', deps=['Nope']))
+    resp = await server.parse_handle_request(
+        (await client.package_request(never)).content)
+    assert resp.raw.error.code == OffChainErrorCode.wait
+    assert server.parked == {}
+
+
+async def test_protocol_park_only_single_server_requests(two_channels, key):
+    server, client = two_channels
+    server.park_timeout = client.park_timeout = 5.0
+
+    # A blocked request of a batch gets a wait at once, without holding
+    # back the other requests of the batch.
+    blocked = CommandRequestObject(SampleCommand('World', deps=['Nope']))
+    hello = client.sequence_command_local(SampleCommand('Hello'))
+    batch = {'batch': [blocked.get_json_data_dict(JSONFlag.NET),
+                       hello.get_json_data_dict(JSONFlag.NET)]}
+    CommandBatchObject.add_object_type(batch)
+    resp = await asyncio.wait_for(server.parse_handle_request(
+        await key.sign_message(json.dumps(batch))), 1.0)
+    assert resp.raw.items[0].error.code == OffChainErrorCode.wait
+    assert resp.raw.items[1].status == 'success'
+    assert server.parked_requests == 0
+
+    # The client, that does not sequence requests, answers at once.
+    blocked = CommandRequestObject(SampleCommand('Other', deps=['Nope']))
+    resp = await asyncio.wait_for(client.parse_handle_request(
+        (await server.package_request(blocked)).content), 1.0)
+    assert resp.raw.error.code == OffChainErrorCode.wait
+    assert client.parked_requests == 0
+
+
+async def test_protocol_waits_for_other_tasks(two_channels):
+    server, client = two_channels
+
+    # Requests and responses wait for the transaction another task holds
+    # across an await, rather than failing.
+    order = []
+
+    async def hold():
+        async with server.storage.atomic_writes_async():
+            await asyncio.sleep(0.01)
+            order.append('held')
+
+    request = client.sequence_command_local(SampleCommand('Hello'))
+    signed = (await client.package_request(request)).content
+    holder = asyncio.ensure_future(hold())
+    await asyncio.sleep(0)
+    resp = await server.parse_handle_request(signed)
+    order.append('handled')
+    await holder
+    assert resp.raw.status == 'success'
+
+    holder = asyncio.ensure_future(hold())
+    await asyncio.sleep(0)
+    assert await client.parse_handle_response(resp.content)
+    order.append('handled')
+    await holder
+    assert order == ['held', 'handled', 'held', 'handled']
+
+
 
 def test_protocol_server_client_interleaved_swapped_reply(two_channels):
     server, client = two_channels
@@ -538,6 +759,16 @@ def test_VASProot_diff_object(vasp, three_addresses):
     assert vasp.get_channel(b1) is vasp.get_channel(b2)
 
 
+def test_VASProot_partition_channels(three_addresses, vasp, store):
+    _, a1, a2 = three_addresses
+    vasp.partition_channels = True
+
+    # Each channel has its own storage partition.
+    assert vasp.get_channel(a1).storage is store.partition(a1.as_str())
+    assert vasp.get_channel(a2).storage is store.partition(a2.as_str())
+    assert vasp.get_channel(a1).storage is not vasp.get_channel(a2).storage
+
+
 def test_real_address(three_addresses):
     from os import urandom
     A, _, B = three_addresses
@@ -191,7 +191,9 @@ def test_vasp_simple(json_request, vasp, other_addr, loop):
         vasp.pp.loop.run_until_complete(fut)
         fut.result()
 
-    assert len(net.method_calls) == 2
+    assert [call[0] for call in net.method_calls] == [
+        'atomic_writes_async', 'sequence_command_local', 'package_sequenced',
+        'send_request']
 
 
 async def test_vasp_simple_wrong_VASP(json_request, other_addr, loop, key):
@@ -2,13 +2,27 @@
 # SPDX-License-Identifier: Apache-2.0
 
 # Tests for the storage framework
-from ..storage import StorableDict, StorableList, StorableValue, StorableFactory
-from ..payment_logic import PaymentCommand
+from ..storage import StorableDict, StorableList, StorableValue, StorableFactory, \
+    StorableLogDict, AsyncStorableFactory, journal_key, key_join, Durability, \
+    DEFAULT_GROUP_COMMIT_WINDOW
+from ..sqlite_storage import SQLiteStorage
+from ..log_storage import LogStorage
+from ..storage_stats import StorageStatsAggregator, OTHER
+from ..bloom import BloomFilter
+from ..payment_logic import PaymentCommand, PaymentProcessor
 from ..protocol_messages import make_success_response, CommandRequestObject, \
     make_command_error
 from ..errors import OffChainErrorCode
+from ..payment import PaymentObject, KYC_BLOB_FIELDS
+from ..utils import JSONFlag
 
 import pytest
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+import time
 
 def test_dict(db):
     D = StorableDict(db, 'mary', int)
@@ -114,8 +128,9 @@ def test_value(db):
     # Test default
     val0 = StorableValue(db, 'counter_zero', int, default=0)
     assert val0.get_value() == 0
-    assert val0.exists()
+    assert val0.exists() is False
     val0.set_value(10)
+    assert val0.exists() is True
     assert val0.get_value() == 10
 
     val = StorableValue(db, 'counter', int)
@@ -128,6 +143,28 @@ def test_value(db):
     assert val2.get_value() == 10
 
 
+def test_lazy_values():
+    db = CountingDB()
+    store = StorableFactory(db)
+    root = store.make_value('root', None)
+    D = store.make_dict('D', int, root)
+    L = store.make_list('L', int, root)
+    V = store.make_value('V', int, root, default=5)
+    assert db.reads == 0 and len(db) == 0
+
+    # Defaults are read, but only written on first mutation.
+    assert len(D) == 0 and len(L) == 0 and V.get_value() == 5
+    assert len(db) == 0
+    with store.atomic_writes():
+        L += [1]
+        V.set_value(V.get_value() + 1)
+    store2 = StorableFactory(db)
+    root2 = store2.make_value('root', None)
+    assert len(store2.make_list('L', int, root2)) == 1
+    assert store2.make_value('V', int, root2, default=5).get_value() == 6
+    assert len(store2.make_dict('D', int, root2)) == 0
+
+
 def test_value_dict():
     db = {}
     val = StorableValue(db, 'counter', int)
@@ -281,3 +318,1035 @@ def test_dict_trans():
 
     assert len(eg) == 3
     assert set(eg.keys()) == set(['x', 'y', 'z'])
+
+
+def test_sqlite_transaction(tmp_path):
+    db_path = tmp_path / 'sqlite.db'
+    db = SQLiteStorage(db_path)
+    store = StorableFactory(db)
+
+    with store.atomic_writes():
+        eg = store.make_dict('eg', int, None)
+        eg['x'] = 10
+        eg['y'] = 20
+
+    with store.atomic_writes():
+        del eg['x']
+        eg['z'] = 30
+
+    # Native transactions need no recovery backup.
+    assert '__backup_recovery' not in db
+    db.close()
+
+    # All committed data persists across re-opening the database.
+    db2 = SQLiteStorage(db_path)
+    store2 = StorableFactory(db2)
+    with store2.atomic_writes():
+        eg2 = store2.make_dict('eg', int, None)
+    assert set(eg2.keys()) == {'y', 'z'}
+    assert eg2['z'] == 30
+    assert len(eg2) == 2
+
+
+def test_sqlite_failed_commit_is_atomic(tmp_path):
+    db = SQLiteStorage(tmp_path / 'sqlite.db')
+    store = StorableFactory(db)
+
+    with store.atomic_writes():
+        store['1'] = '1'
+        store['2'] = '2'
+
+    store.__enter__()
+    store['1'] = '10'
+    store['3'] = '30'
+    del store['2']
+    # A value SQLite cannot store aborts the whole transaction.
+    store['4'] = object()
+    with pytest.raises(Exception):
+        store.__exit__(None, None, None)
+
+    assert set(db.keys()) == {'1', '2'}
+    assert db['1'] == '1'
+
+
+def test_log_storage_recovery(tmp_path):
+    db_path = tmp_path / 'log.db'
+    db = LogStorage(db_path)
+    store = StorableFactory(db)
+
+    with store.atomic_writes():
+        eg = store.make_dict('eg', int, None)
+        eg['x'] = 10
+        eg['y'] = 20
+
+    with store.atomic_writes():
+        del eg['x']
+        eg['z'] = 30
+
+    assert '__backup_recovery' not in db
+    db.close()
+    committed_size = db_path.stat().st_size
+
+    # A batch torn by a crash, without a valid commit record.
+    with open(db_path, 'ab') as log_file:
+        log_file.write(b'\x01\x03\x00\x00\x00\x02\x00\x00\x00key')
+
+    db2 = LogStorage(db_path)
+    assert db_path.stat().st_size == committed_size
+    store2 = StorableFactory(db2)
+    with store2.atomic_writes():
+        eg2 = store2.make_dict('eg', int, None)
+    assert set(eg2.keys()) == {'y', 'z'}
+    assert eg2['z'] == 30
+    assert len(eg2) == 2
+    db2.close()
+
+
+def test_log_storage_compaction(tmp_path):
+    db_path = tmp_path / 'log.db'
+    db = LogStorage(db_path, compact_min_size=10000)
+
+    for i in range(1000):
+        db.write_batch({f'key{i % 10}': f'value{i}' * 10,
+                        f'other{i}': 'x'}, [f'other{i - 1}'])
+    db.close()
+    assert db.compactions > 0
+    assert db_path.stat().st_size < 20000
+
+    db2 = LogStorage(db_path)
+    assert set(db2.keys()) == {f'key{i}' for i in range(10)} | {'other999'}
+    assert db2['key3'] == 'value993' * 10
+    db2.close()
+
+
+def test_group_commit_by_size():
+    db = {}
+    store = StorableFactory(db, group_commit_window=60.0, group_commit_size=3)
+
+    with store.atomic_writes():
+        store['1'] = '1'
+    with store.atomic_writes():
+        store['2'] = '2'
+        store['1'] = '10'
+
+    # Completed transactions are visible but not yet written.
+    assert db == {}
+    assert store['1'] == '10'
+    assert '2' in store
+    first = store.durable()
+    assert not first.done()
+
+    with store.atomic_writes():
+        del store['1']
+        store['3'] = '3'
+
+    # The third transaction completes the group.
+    assert first.done()
+    assert store.durable().done()
+    assert db == {'2': '2', '3': '3'}
+    assert '1' not in store
+    assert store.flush_timer is None
+
+
+def test_group_commit_by_window():
+    db = {}
+    store = StorableFactory(db, group_commit_window=0.01)
+
+    with store.atomic_writes():
+        eg = store.make_dict('eg', int, None)
+        eg['x'] = 10
+
+    async def wait():
+        await store.wait_durable()
+
+    asyncio.run(wait())
+    assert store.pending == {}
+    assert eg['x'] == 10
+    assert len(db) > 0
+
+
+def test_group_commit_flush():
+    db = {}
+    store = StorableFactory(db, group_commit_window=60.0)
+    with store.atomic_writes():
+        store['1'] = '1'
+    assert db == {}
+    store.flush()
+    assert db == {'1': '1'}
+    assert store.durable().result() is True
+
+
+class BlockingDB(dict):
+    ''' A dict that blocks all writes until released. '''
+
+    def __init__(self):
+        dict.__init__(self)
+        self.gate = threading.Event()
+
+    def write_batch(self, writes, deletes):
+        self.gate.wait()
+        self.update(writes)
+        for key in deletes:
+            self.pop(key, None)
+
+
+def test_async_factory():
+    db = BlockingDB()
+    store = AsyncStorableFactory(db)
+
+    async def run():
+        with store.atomic_writes():
+            eg = store.make_dict('eg', int, None)
+            eg['x'] = 10
+
+        # The commit does not block, and is visible while written.
+        assert db == {}
+        assert eg['x'] == 10
+        assert not store.durable().done()
+
+        db.gate.set()
+        async with store.atomic_writes_async():
+            eg['y'] = 20
+            store['k'] = 'v'
+        assert store.durable().done()
+        assert store.pending == {} and store.flushing == {}
+        assert db['k'] == 'v'
+        assert await store.read_async('k') == 'v'
+        with pytest.raises(KeyError):
+            await store.read_async('missing')
+        return eg
+
+    eg = asyncio.run(run())
+    assert set(eg.keys()) == {'x', 'y'}
+    assert len(db) > 0
+    store.close()
+
+
+def test_flush_does_not_hold_transaction_lock():
+    db = BlockingDB()
+    store = StorableFactory(db, group_commit_window=60.0)
+    with store.atomic_writes():
+        store['1'] = '1'
+
+    flusher = threading.Thread(target=store.flush)
+    flusher.start()
+    while store.flushing == {}:
+        time.sleep(0.001)
+
+    # Transactions proceed, and read the group, while it is written.
+    with store.atomic_writes():
+        assert store['1'] == '1'
+        store['2'] = '2'
+
+    db.gate.set()
+    flusher.join()
+    store.flush()
+    assert db == {'1': '1', '2': '2'}
+
+
+def test_partition_transactions():
+    db = {}
+    store = StorableFactory(db)
+    part_a = store.partition('A')
+    part_b = store.partition('B')
+    assert store.partition('A') is part_a
+
+    with part_a.atomic_writes():
+        A = part_a.make_dict('A', int, None)
+    with part_b.atomic_writes():
+        B = part_b.make_dict('B', int, None)
+
+    entered, committed = threading.Event(), threading.Event()
+
+    def write_a():
+        with part_a.atomic_writes():
+            A['x'] = 1
+            entered.set()
+            committed.wait()
+
+    writer = threading.Thread(target=write_a)
+    writer.start()
+    entered.wait()
+
+    # A transaction of another partition does not wait for, or commit,
+    # the open transaction of partition A.
+    try:
+        with part_b.atomic_writes():
+            B['y'] = 2
+        assert B['y'] == 2
+        assert part_a.cache != {}
+        assert not any('[1:x]' in key for key in db)
+    finally:
+        committed.set()
+        writer.join()
+    assert A['x'] == 1
+    assert store.durable().result() is True
+
+
+def test_partition_joins_outer_transaction():
+    db = {}
+    store = StorableFactory(db)
+    part = store.partition('A')
+    with store.atomic_writes():
+        shared = store.make_dict('shared', int, None)
+    with part.atomic_writes():
+        local = part.make_dict('local', int, None)
+
+    # Writes to objects of the root factory join the partition transaction.
+    keys = len(db)
+    with part.atomic_writes():
+        local['x'] = 1
+        shared['x'] = 1
+        assert shared['x'] == 1
+        assert store.cache == {}
+        assert len(db) == keys
+    assert shared['x'] == 1 and local['x'] == 1
+
+    # So do transactions of the root factory opened within it.
+    keys = len(db)
+    with part.atomic_writes():
+        local['y'] = 2
+        with store.atomic_writes():
+            shared['y'] = 2
+        assert store.cache == {}
+        assert len(db) == keys
+    assert shared['y'] == 2 and local['y'] == 2
+
+    # Transactions of the root factory only read the objects of partitions.
+    with store.atomic_writes():
+        assert local['y'] == 2
+        with pytest.raises(RuntimeError):
+            local['z'] = 3
+        with pytest.raises(RuntimeError):
+            with part.atomic_writes():
+                pass
+
+    with pytest.raises(RuntimeError):
+        shared['z'] = 3
+
+
+def test_partition_writers_share_root_objects():
+    db = {}
+    store = StorableFactory(db)
+    with store.atomic_writes():
+        shared = store.make_dict('shared', int, None)
+    parts = [store.partition(name) for name in 'AB']
+    barrier = threading.Barrier(len(parts))
+
+    def write(part, name):
+        barrier.wait()
+        for i in range(50):
+            with part.atomic_writes():
+                shared[f'{name}{i}'] = i
+                # Let the other writer run within the transaction.
+                time.sleep(0)
+                if i % 5 == 0:
+                    del shared[f'{name}{i}']
+
+    writers = [threading.Thread(target=write, args=(part, part.name))
+               for part in parts]
+    for writer in writers:
+        writer.start()
+    for writer in writers:
+        writer.join()
+
+    # The length, first key and linked list agree.
+    keys = list(shared.keys())
+    assert len(keys) == len(set(keys)) == 80
+    assert len(shared) == 80
+    first_key = shared.first_key.get_value()
+    assert json.loads(db[first_key])[3] == keys[0]
+    assert all(shared[key] == int(key[1:]) for key in keys)
+
+
+def test_partition_reads_committed_state():
+    store = StorableFactory({})
+    part = store.partition('A')
+    with store.atomic_writes():
+        shared = store.make_dict('shared', int, None)
+        shared['x'] = 1
+
+    entered, done = threading.Event(), threading.Event()
+
+    def write():
+        with store.atomic_writes():
+            shared['x'] = 2
+            shared['y'] = 2
+            entered.set()
+            done.wait()
+
+    writer = threading.Thread(target=write)
+    writer.start()
+    entered.wait()
+    try:
+        # Outside transactions, the root transaction in progress is not
+        # seen, through the partition or the root factory.
+        assert part.get_committed(shared.derive_keys('x')[0]) == '1'
+        assert shared['x'] == 1 and 'y' not in shared
+    finally:
+        done.set()
+        writer.join()
+    assert shared['x'] == 2 and shared['y'] == 2
+
+
+def test_async_transactions_per_task():
+    store = StorableFactory({})
+    with store.atomic_writes():
+        D = store.make_dict('D', int, None)
+
+    async def first(entered, resume):
+        async with store.atomic_writes_async():
+            D['a'] = 1
+            entered.set()
+            await resume.wait()
+            # The writes of the other task are not part of this one.
+            assert 'b' not in D
+            assert not any(key.endswith('[1:b]') for key in store.cache)
+
+    async def second(entered):
+        await entered.wait()
+        # Outside a transaction, the transaction of the other task is
+        # not seen, and joining it is not possible.
+        assert 'a' not in D
+        with pytest.raises(RuntimeError):
+            D['b'] = 2
+        with pytest.raises(RuntimeError):
+            with store.atomic_writes():
+                pass
+
+        # The transaction of this task waits for the other one.
+        async with store.atomic_writes_async():
+            assert D['a'] == 1
+            D['b'] = 2
+
+    async def run():
+        entered, resume = asyncio.Event(), asyncio.Event()
+        tasks = [asyncio.ensure_future(first(entered, resume)),
+                 asyncio.ensure_future(second(entered))]
+        await entered.wait()
+        await asyncio.sleep(0.01)
+        assert not tasks[1].done()
+        resume.set()
+        await asyncio.gather(*tasks)
+
+    asyncio.run(run())
+    assert D['a'] == 1 and D['b'] == 2
+    assert store.levels == 0 and store.cache == {}
+
+
+class CountingDB(dict):
+    ''' A dict that counts the reads of keys. '''
+
+    def __init__(self):
+        dict.__init__(self)
+        self.reads = 0
+
+    def __getitem__(self, key):
+        self.reads += 1
+        return dict.__getitem__(self, key)
+
+
+def test_checkpoint_restart():
+    db = CountingDB()
+    store = StorableFactory(db, checkpoint_interval=2)
+    with store.atomic_writes():
+        hot = store.make_dict('hot', str, None, hot=True)
+        cold = store.make_dict('cold', str, None)
+    for i in range(5):
+        with store.atomic_writes():
+            hot[f'{i}'] = 'True'
+            cold[f'{i}'] = 'x'
+    with store.atomic_writes():
+        hot['1'] = 'True'
+    with store.atomic_writes():
+        del hot['0']
+
+    # The journal holds the changes since the last snapshot.
+    assert '__checkpoint' in db
+    snapshot = json.loads(db['__checkpoint'])
+    assert store.snapshot_seq == snapshot['seq'] < store.journal_seq
+    assert all(journal_key(seq) in db for seq in range(
+        store.snapshot_seq + 1, store.journal_seq + 1))
+    assert journal_key(store.snapshot_seq) not in db
+
+    # On restart the hot state is read from the snapshot and journal.
+    store2 = StorableFactory(db, checkpoint_interval=2)
+    assert store2.hot_items == store.hot_items
+    db.reads = 0
+    with store2.atomic_writes():
+        hot2 = store2.make_dict('hot', str, None, hot=True)
+        cold2 = store2.make_dict('cold', str, None)
+        assert set(hot2.keys()) == {'1', '2', '3', '4'}
+        assert len(cold2) == 5
+    assert db.reads == 0
+    assert cold2['0'] == 'x'
+
+    # Closing writes a snapshot, that replaces the journal.
+    store2.close()
+    assert not any(key.startswith('__journal_') for key in db)
+    store3 = StorableFactory(db, checkpoint_interval=2)
+    assert store3.hot_items == store2.hot_items
+
+
+def test_checkpoint_existing_db(db):
+    store = StorableFactory(db)
+    with store.atomic_writes():
+        D = store.make_dict('D', int, None)
+        D['x'] = 1
+        L = store.make_list('L', int, None)
+        L += [1]
+
+    # Turning on checkpoints loads the hot state from the db.
+    store = StorableFactory(db, checkpoint_interval=10)
+    with store.atomic_writes():
+        D = store.make_dict('D', int, None, hot=True)
+        L = store.make_list('L', int, None)
+        D['y'] = 2
+    assert set(D.keys()) == {'x', 'y'} and len(L) == 1
+    assert any(key.endswith('[1:x]') for key in store.hot_items)
+
+
+def test_dict_value_cache(payment):
+    store = StorableFactory({}, cache_size=2)
+    with store.atomic_writes():
+        D = store.make_dict('payments', payment.__class__, None, cached=True)
+        D['a'] = payment
+
+        # Values written by an uncommitted transaction are not cached.
+        assert D['a'] == payment
+        assert len(D.value_cache) == 0
+
+    assert D['a'] == payment
+    assert D['a'] == payment
+    assert (D.cache_hits, D.cache_misses) == (1, 2)
+
+    # Cached objects are returned as fresh copies.
+    p1 = D['a']
+    p1.add_recipient_signature('sig')
+    assert 'recipient_signature' not in D['a']
+    assert D['a'] == payment
+
+    # Writes and deletes invalidate the cache.
+    new_payment = payment.new_version()
+    with store.atomic_writes():
+        D['a'] = new_payment
+    assert D['a'] == new_payment
+    with store.atomic_writes():
+        del D['a']
+    assert 'a' not in D
+    with pytest.raises(KeyError):
+        D['a']
+
+    # Membership tests see deletes made through other instances.
+    with store.atomic_writes():
+        D['b'] = payment
+    assert D['b'] == payment and 'b' in D.value_cache
+    D2 = store.make_dict('payments', payment.__class__, None, cached=True)
+    with store.atomic_writes():
+        del D2['b']
+    assert 'b' not in D
+
+    # The cache is bounded.
+    with store.atomic_writes():
+        for key in 'xyz':
+            D[key] = payment
+    for key in 'xyz':
+        D[key]
+    assert list(D.value_cache) == ['y', 'z']
+
+
+def test_dict_value_cache_off_by_default():
+    store = StorableFactory({}, cache_size=10)
+    with store.atomic_writes():
+        D = store.make_dict('eg', int, None)
+        D['x'] = 1
+    assert D['x'] == 1
+    assert len(D.value_cache) == 0
+
+
+def test_log_dict(db):
+    store = StorableFactory(db)
+    with store.atomic_writes():
+        D = store.make_log_dict('log', int, None)
+        assert list(D.keys()) == []
+        for i, key in enumerate('abcde'):
+            D[key] = i
+        D['a'] = 10
+        assert len(D) == 5
+        assert D['a'] == 10
+
+    with store.atomic_writes():
+        del D['b']
+        del D['e']
+        with pytest.raises(KeyError):
+            del D['b']
+        D['f'] = 5
+
+    assert 'b' not in D
+    assert 'f' in D
+    assert len(D) == 4
+    assert list(D.keys()) == ['a', 'c', 'd', 'f']
+    assert list(D.key_chunks(3)) == [['a', 'c', 'd'], ['f']]
+    assert list(D.values()) == [10, 2, 3, 5]
+
+    # Deleted keys can be added again.
+    with store.atomic_writes():
+        D['b'] = 1
+    assert list(D.keys()) == ['a', 'c', 'd', 'f', 'b']
+
+
+def test_log_dict_migration(payment):
+    db = {}
+    store = StorableFactory(db)
+    with store.atomic_writes():
+        D = store.make_dict('store', payment.__class__, None)
+        D['x'] = payment
+        D['y'] = payment
+        D['z'] = payment
+        del D['y']
+
+    with store.atomic_writes():
+        L = store.make_log_dict('store', payment.__class__, None)
+    assert list(L.keys()) == ['x', 'z']
+    assert len(L) == 2
+    assert L['z'] == payment
+    assert not any('[2:LL]' in key or '__META' in key for key in db)
+
+    # Re-opening does not migrate again.
+    with store.atomic_writes():
+        L = store.make_log_dict('store', payment.__class__, None)
+        L['w'] = payment
+    assert list(L.keys()) == ['x', 'z', 'w']
+
+
+def test_processor_log_stores(processor, payment):
+    store = processor.storage_factory
+    with store.atomic_writes():
+        processor.object_store[payment.version] = payment
+
+    processor2 = PaymentProcessor(processor.business, store, log_stores=True)
+    assert isinstance(processor2.object_store, StorableLogDict)
+    assert processor2.object_store[payment.version] == payment
+    assert list(processor2.object_store.keys()) == [payment.version]
+
+
+def test_compact_keys(db):
+    address = 'a' * 50
+    store = StorableFactory(db, compact_keys=True)
+    with store.atomic_writes():
+        root = store.make_value(address, None)
+        D = store.make_dict('object_locks', str, root)
+        L = store.make_list('command_sequence', str, root)
+        D['x'] = 'True'
+        L += ['y']
+
+    # Only the table of interned prefixes holds the paths.
+    keys = [key.decode() if isinstance(key, bytes) else key
+            for key in db.keys()]
+    assert D.prefix.startswith('#') and L.prefix.startswith('#')
+    assert all(key.startswith('[8:__PREFIX]') or address not in key
+               for key in keys)
+
+    # The prefixes are used whenever the db is opened.
+    store2 = StorableFactory(db)
+    with store2.atomic_writes():
+        root2 = store2.make_value(address, None)
+        D2 = store2.make_dict('object_locks', str, root2)
+        L2 = store2.make_list('command_sequence', str, root2)
+    assert (D2.prefix, L2.prefix) == (D.prefix, L.prefix)
+    assert list(D2.keys()) == ['x']
+    assert list(L2) == ['y']
+
+
+def test_compact_keys_existing_db():
+    db = {}
+    store = StorableFactory(db)
+    with store.atomic_writes():
+        old = store.make_dict('old', str, None)
+        old['x'] = '1'
+
+    # Containers with data keep their full path, new ones are compact.
+    store2 = StorableFactory(db, compact_keys=True)
+    with store2.atomic_writes():
+        old2 = store2.make_dict('old', str, None)
+        new2 = store2.make_dict('new', str, None)
+        old2['y'] = '2'
+        new2['z'] = '3'
+    assert old2.prefix == key_join(['', 'old'])
+    assert new2.prefix == '#0'
+    assert set(old2.keys()) == {'x', 'y'}
+    assert db['#0||[1:z]'] == '"3"'
+
+
+def test_dict_keys_prefix_scan(tmp_path):
+
+    class CountingSQLiteStorage(SQLiteStorage):
+        reads = 0
+
+        def __getitem__(self, key):
+            self.reads += 1
+            return SQLiteStorage.__getitem__(self, key)
+
+    db = CountingSQLiteStorage(tmp_path / 'sqlite.db')
+    store = StorableFactory(db)
+    assert store.can_scan()
+
+    with store.atomic_writes():
+        D = store.make_dict('eg', int, None)
+        other = store.make_dict('eg2', int, None)
+        other['x'] = 0
+        for i in range(20):
+            D[str(i)] = i
+
+    db.reads = 0
+    assert set(D.keys()) == set(str(i) for i in range(20))
+    assert db.reads < 5
+
+    # Scans reflect uncommitted and group committed changes.
+    with store.atomic_writes():
+        del D['5']
+        D['new'] = 100
+        assert set(D.keys()) == set(str(i) for i in range(20) if i != 5) \
+            | {'new'}
+
+    with store.atomic_writes():
+        L = store.make_log_dict('log', int, None)
+        for i in range(15):
+            L[str(i)] = i
+        del L['3']
+    assert list(L.keys()) == [str(i) for i in range(15) if i != 3]
+    assert [len(c) for c in L.key_chunks(10)] == [10, 4]
+
+
+def test_dict_keys_order(db):
+    store = StorableFactory(db)
+    with store.atomic_writes():
+        D = store.make_dict('eg', int, None)
+        for i, key in enumerate(['b', 'a', 'c', '10', '9']):
+            D[key] = i
+        del D['a']
+        D['d'] = 5
+
+    # Keys come in the order of the linked list, whether the db scans.
+    assert list(D.keys()) == ['d', '9', '10', 'c', 'b']
+
+
+def test_prefix_scan_fallback():
+    store = StorableFactory({})
+    assert not store.can_scan()
+    with store.atomic_writes():
+        D = store.make_dict('eg', int, None)
+        D['x'] = 1
+    assert list(D.keys()) == ['x']
+
+
+def test_storage_stats(db):
+    stats = StorageStatsAggregator()
+    store = StorableFactory(db, stats=stats)
+    with store.atomic_writes():
+        root = store.make_value('processor', None)
+        locks = store.make_dict('object_locks', str, root)
+        values = store.make_list('values', int, root)
+    stats.reset()
+
+    with store.atomic_writes():
+        locks['a'] = 'True'
+        locks['b'] = 'False'
+        values += [1]
+
+    summary = stats.summary()
+    assert summary['transactions'] == 1
+    assert summary['commit_time_us']['count'] == 1
+    lock_stats = summary['containers']['object_locks']
+    # The value and linked list entry of each key, the metadata, and
+    # the length of the dict.
+    assert lock_stats['writes'] == 6
+    assert lock_stats['deletes'] == 0
+    assert lock_stats['bytes_encoded'] > 0
+    assert lock_stats['per_transaction']['writes']['count'] == 1
+    assert summary['containers']['values']['writes'] == 2
+    assert summary['containers']['*']['writes'] == 8
+
+    stats.reset()
+    assert locks['a'] == 'True'
+    assert 'b' in locks
+    with store.atomic_writes():
+        del locks['a']
+    store.close()
+
+    summary = stats.summary()
+    assert summary['transactions'] == 1
+    lock_stats = summary['containers']['object_locks']
+    assert lock_stats['deletes'] == 2
+    # Reads outside transactions also count.
+    assert lock_stats['reads'] > 2
+    assert 0 < lock_stats['db_reads'] <= lock_stats['reads']
+    assert lock_stats['bytes_decoded'] > 0
+    assert OTHER not in summary['containers']
+
+    # Without a sink nothing is recorded.
+    store = StorableFactory({})
+    with store.atomic_writes():
+        D = store.make_dict('eg', int, None)
+        D['x'] = 1
+    assert store.transaction_stats is None
+    assert not store.container_labels
+
+
+def test_snapshot(db):
+    store = StorableFactory(db)
+    with store.atomic_writes():
+        D = store.make_dict('D', int, None, cached=True)
+        D['x'] = 1
+        D['y'] = 2
+
+    snapshot = store.snapshot()
+    with store.atomic_writes():
+        D['x'] = 10
+        del D['y']
+        D['z'] = 3
+        # Uncommitted writes are not in the snapshot.
+        x_key, _ = D.derive_keys('x')
+        assert json.loads(snapshot[x_key]) == 1
+        assert D.derive_keys('z')[0] not in snapshot
+
+    # Neither are writes committed after it was taken.
+    assert D['x'] == 10
+    with snapshot:
+        assert D['x'] == 1 and D['y'] == 2
+        assert 'z' not in D
+        assert set(D.keys()) == {'x', 'y'}
+        assert len(D) == 2
+        with pytest.raises(RuntimeError):
+            with store.atomic_writes():
+                D['w'] = 0
+    assert snapshot.closed and not store.snapshots
+    with pytest.raises(RuntimeError):
+        snapshot[D.key('x')]
+
+    with store.snapshot():
+        assert set(D.keys()) == {'x', 'z'}
+        assert D['x'] == 10
+
+
+def test_kyc_blobs(payment, kyc_data):
+    db = {}
+    store = StorableFactory(db, blob_fields=KYC_BLOB_FIELDS)
+    payment.sender.add_kyc_data(kyc_data)
+    payment.receiver.add_kyc_data(kyc_data)
+    net_data = payment.get_json_data_dict(JSONFlag.NET)
+    with store.atomic_writes():
+        D = store.make_dict('payments', PaymentObject, None)
+        D['v0'] = payment
+        D['v1'] = payment.new_version()
+
+    # The KYC data of all versions and actors is stored once.
+    blob_keys = [k for k in db if k.startswith(key_join(['__BLOB']))]
+    assert len(blob_keys) == 1
+    stored = json.loads(db[D.derive_keys('v0')[0]])
+    assert '_Blob' in stored['sender']['kyc_data']
+    assert D['v0'] == payment
+    assert D['v1'].sender.kyc_data == kyc_data
+    assert payment.get_json_data_dict(JSONFlag.NET) == net_data
+
+    # The blob fields are recorded in the db.
+    store2 = StorableFactory(db)
+    assert store2.blob_fields == set(KYC_BLOB_FIELDS)
+    D2 = store2.make_dict('payments', PaymentObject, None)
+    assert D2['v1'].receiver.kyc_data == kyc_data
+
+
+def test_collect_blobs(db, payment, kyc_data):
+    store = StorableFactory(db, blob_fields=KYC_BLOB_FIELDS)
+    payment.sender.add_kyc_data(kyc_data)
+    with store.atomic_writes():
+        D = store.make_dict('payments', PaymentObject, None)
+        D['v0'] = payment
+        D['v1'] = payment.new_version()
+    blob_keys = [k for k in store.committed_keys()
+                 if k.startswith(key_join(['__BLOB']) + '||')]
+    assert len(blob_keys) == 1
+
+    # A blob is kept while a stored object refers to it.
+    assert store.collect_blobs() == 0
+    with store.atomic_writes():
+        del D['v0']
+    assert store.collect_blobs() == 0
+    assert D['v1'].sender.kyc_data == kyc_data
+    with store.atomic_writes():
+        del D['v1']
+    assert store.collect_blobs() == 1
+    assert not store.contains_committed(blob_keys[0])
+
+    # A blob stored again is written again, and is kept by the first
+    # sweep after it was used.
+    with store.atomic_writes():
+        D['v2'] = payment
+    assert store.contains_committed(blob_keys[0])
+    assert D['v2'].sender.kyc_data == kyc_data
+    with store.atomic_writes():
+        del D['v2']
+    assert store.collect_blobs() == 0
+    assert store.collect_blobs() == 1
+
+
+@pytest.mark.parametrize('make', ['make_dict', 'make_log_dict'])
+def test_delta_versions(db, payment, make):
+    store = StorableFactory(db)
+    with store.atomic_writes():
+        D = getattr(store, make)(
+            'object_store', PaymentObject, None, delta_interval=3)
+        versions = [payment]
+        D[payment.version] = payment
+        for i in range(4):
+            new_payment = versions[-1].new_version(store=D)
+            new_payment.sender.add_metadata(f'step{i}')
+            D[new_payment.version] = new_payment
+            versions += [new_payment]
+
+    # Versions are stored as deltas, with a full version every 3.
+    depths = []
+    for version in versions:
+        data = D._stored_json(db[D.derive_keys(version.version)[0]])
+        depths += [json.loads(data).get('_Depth', 0)]
+    assert depths == [0, 1, 2, 0, 1]
+
+    # They decode without the cache, and with delta encoding off.
+    D2 = getattr(store, make)('object_store', PaymentObject, None)
+    for version in versions:
+        assert D2[version.version] == version
+    assert D2[versions[-1].version].sender.metadata == [
+        f'step{i}' for i in range(4)]
+
+
+def test_bloom_filter():
+    bloom = BloomFilter(capacity=100, error_rate=0.01)
+    for i in range(1000):
+        bloom.add(f'key{i}')
+    assert len(bloom) == 1000 and len(bloom.stages) > 1
+    assert all(f'key{i}' in bloom for i in range(1000))
+    false_positives = sum(f'other{i}' in bloom for i in range(10000))
+    assert false_positives < 300
+
+
+def test_dict_bloom(db):
+    stats = StorageStatsAggregator()
+    store = StorableFactory(db, stats=stats, bloom_filters=True)
+    with store.atomic_writes():
+        D = store.make_dict('object_locks', str, None, bloom=True)
+        D['a'] = 'True'
+
+    # A new instance loads the filter from the db on first use.
+    D = store.make_dict('object_locks', str, None, bloom=True)
+    assert D.bloom is not None and not D.bloom_loaded
+    stats.reset()
+    with store.atomic_writes():
+        assert 'a' in D
+        assert all(f'x{i}' not in D for i in range(100))
+        D['b'] = 'False'
+        del D['a']
+    assert 'b' in D and 'a' not in D and len(D) == 1
+
+    assert D.bloom_negatives + D.bloom_false_positives == 102
+    assert D.bloom_false_positive_rate() < 0.1
+    lock_stats = stats.summary()['containers']['object_locks']
+    assert lock_stats['bloom_negatives'] == D.bloom_negatives
+    assert 'bloom_false_positive_rate' in lock_stats
+
+    # Filters are off unless enabled on the factory.
+    store = StorableFactory({})
+    with store.atomic_writes():
+        assert store.make_dict('eg', int, None, bloom=True).bloom is None
+
+
+class SyncedDict(dict):
+    # A db that counts the calls to sync it.
+    syncs = 0
+
+    def sync(self):
+        self.syncs += 1
+
+
+def test_durability(tmp_path):
+    db = SyncedDict()
+    store = StorableFactory(db, durability=Durability.SYNC)
+    with store.atomic_writes():
+        D = store.make_dict('eg', int, None)
+        D['x'] = 1
+    # The backup, the writes and the removal of the backup are synced.
+    assert db.syncs == 3 and store.group_commit_window == 0
+
+    db = SyncedDict()
+    store = StorableFactory(db, durability=Durability.NONE,
+                            group_commit_window=1.0)
+    with store.atomic_writes():
+        store.make_dict('eg', int, None)['x'] = 1
+    assert db.syncs == 0 and store.group_commit_window == 0
+    assert json.loads(db[store.make_dict('eg', int, None).key('x')]) == 1
+
+    store = StorableFactory({}, durability=Durability.GROUP)
+    assert store.group_commit_window == DEFAULT_GROUP_COMMIT_WINDOW
+
+    # Backends that control their own syncing are set.
+    sqlite_db = SQLiteStorage(tmp_path / 'test.db')
+    StorableFactory(sqlite_db, durability=Durability.NONE)
+    assert sqlite_db.conn.execute('PRAGMA synchronous').fetchone()[0] == 0
+    StorableFactory(sqlite_db, durability=Durability.GROUP)
+    assert sqlite_db.conn.execute('PRAGMA synchronous').fetchone()[0] == 2
+    sqlite_db.close()
+
+    log_db = LogStorage(tmp_path / 'log.db')
+    StorableFactory(log_db, durability=Durability.NONE)
+    assert not log_db.sync
+    log_db.close()
+
+
+def test_log_dict_compact(db):
+    store = StorableFactory(db)
+    with store.atomic_writes():
+        D = store.make_log_dict('eg', int, None)
+        for i in range(10):
+            D[str(i)] = i
+        for i in range(0, 10, 3):
+            del D[str(i)]
+        assert D.compact() == 4
+    assert D.compact() == 0
+    assert list(D.keys()) == ['1', '2', '4', '5', '7', '8']
+    assert [D[k] for k in D.keys()] == [1, 2, 4, 5, 7, 8]
+    assert len(D) == 6 and D.next_index.get_value() == 6
+    with store.atomic_writes():
+        D['10'] = 10
+        assert D.compact() == 0
+    assert list(D.keys())[-1] == '10'
+
+
+def test_sqlite_compact(tmp_path):
+    path = tmp_path / 'test.db'
+    db = SQLiteStorage(path)
+    assert db.conn.execute('PRAGMA auto_vacuum').fetchone()[0] == 2
+    db.write_batch({f'key{i}': 'x' * 1000 for i in range(1000)}, ())
+    db.conn.execute('PRAGMA wal_checkpoint(TRUNCATE)').fetchall()
+    size = os.path.getsize(path)
+    db.write_batch({}, {f'key{i}' for i in range(1000)})
+    assert db.compact() > 500000
+    assert os.path.getsize(path) < size - 500000
+    assert len(db) == 0
+    db.close()
+
+
+def test_sqlite_compact_converts_db(tmp_path):
+    path = tmp_path / 'test.db'
+    conn = sqlite3.connect(str(path))
+    conn.execute('CREATE TABLE kv (k PRIMARY KEY, v NOT NULL) WITHOUT ROWID')
+    conn.close()
+
+    # Databases without incremental auto vacuum are vacuumed once.
+    db = SQLiteStorage(path)
+    db.write_batch({f'key{i}': 'x' * 1000 for i in range(1000)}, ())
+    db.write_batch({}, {f'key{i}' for i in range(1000)})
+    db.conn.execute('PRAGMA wal_checkpoint(TRUNCATE)').fetchall()
+    size = os.path.getsize(path)
+    db.compact()
+    assert os.path.getsize(path) < size - 500000
+    assert db.conn.execute('PRAGMA auto_vacuum').fetchone()[0] == 2
+    db.close()
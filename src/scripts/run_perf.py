@@ -32,6 +32,23 @@ if __name__ == '__main__':
     parser.add_argument(
         '-x', '--xprofile', metavar='PROFILE', type=bool, default=False,
         help='Profile this run', dest='xprof')
+    parser.add_argument(
+        '-s', '--storage-stats', action='store_true',
+        help='Print the storage operations per container', dest='stats')
+    parser.add_argument(
+        '-d', '--durability', choices=['sync', 'group', 'none'],
+        default=None, dest='durability',
+        help='Store in SQLite files with this durability (default: memory)')
+    parser.add_argument(
+        '-b', '--batch-size', metavar='BATCH_SIZE', type=int, default=0,
+        help='Send requests in batches of up to this size', dest='batch')
+    parser.add_argument(
+        '-f', '--send-window', metavar='WINDOW', type=int, default=0,
+        help='Max requests in flight to the other VASP', dest='window')
+    parser.add_argument(
+        '-k', '--park-timeout', metavar='PARK_SEC', type=float, default=0.0,
+        help='Hold requests blocked on dependencies for up to this time',
+        dest='park')
 
     args = parser.parse_args()
 
@@ -52,7 +69,12 @@ if __name__ == '__main__':
     asyncio.run(local_benchmark.main_perf(
         messages_num=args.paym,
         wait_num=args.wait,
-        verbose=args.verb))
+        verbose=args.verb,
+        storage_stats=args.stats,
+        durability=args.durability,
+        batch_size=args.batch,
+        send_window=args.window,
+        park_timeout=args.park))
 
     if args.xprof:
 
@@ -0,0 +1,65 @@
+# Copyright (c) The Libra Core Contributors
+# SPDX-License-Identifier: Apache-2.0
+
+""" A simple script that runs local performance tests of the storage
+    subsystem. """
+
+import asyncio
+import argparse
+
+try:
+    from offchainapi.tests import storage_benchmark
+except:
+    print('Use Local Version... ')
+    import sys
+    sys.path += ['src/.']
+    from offchainapi.tests import storage_benchmark
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description='Storage Benchmarks for offchainapi.')
+    parser.add_argument(
+        '-t', '--transactions', metavar='TX_NUM', type=int, default=200,
+        help='number of transactions to commit', dest='txs')
+    parser.add_argument(
+        '-c', '--clients', metavar='CLIENT_NUM', type=int, default=10,
+        help='number of concurrent clients', dest='clients')
+    parser.add_argument(
+        '-d', '--delay', metavar='DELAY_MS', type=float, default=5.0,
+        help='simulated disk write latency (ms)', dest='delay')
+    parser.add_argument(
+        '-s', '--startup', metavar='ENTRIES_NUM', type=int, nargs='*',
+        help='measure the startup time for databases of these sizes',
+        dest='startup')
+    parser.add_argument(
+        '-m', '--matrix', metavar='KEYS_NUM', type=int, nargs='*',
+        help='compare the storage operations of the backends for these '
+             'numbers of keys', dest='matrix')
+    parser.add_argument(
+        '-b', '--backend', metavar='BACKEND', action='append',
+        choices=storage_benchmark.BACKENDS,
+        help='a database backend (dict, dbm, sqlite or log); may be '
+             'repeated for the matrix, which defaults to all available',
+        dest='backends')
+    parser.add_argument(
+        '-o', '--output', metavar='FILE', default=None,
+        help='a file to write the JSON report of the matrix to',
+        dest='output')
+
+    args = parser.parse_args()
+
+    if args.matrix is not None:
+        storage_benchmark.main_matrix(
+            sizes=args.matrix or (1000, 10000, 100000),
+            backends=args.backends,
+            report=args.output)
+    elif args.startup is not None:
+        storage_benchmark.main_startup(
+            sizes=args.startup or (1000, 10000, 100000),
+            backend=args.backends[0] if args.backends else 'dbm')
+    else:
+        asyncio.run(storage_benchmark.main_loop_lag_compare(
+            transactions_num=args.txs,
+            clients_num=args.clients,
+            write_delay=args.delay / 1000))